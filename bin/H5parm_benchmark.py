@@ -1,188 +1,257 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-# This tool comapre the performances of H5parm with parmdb.
+# This tool benchmarks the H5parm library and some operations on synthetic
+# solution-tables. Results are saved in JSON to compare different runs/releases.
 
 # Authors:
 # Francesco de Gasperin
 _author = "Francesco de Gasperin (fdg@hs.uni-hamurg.de)"
 
-import sys, os, time
+import sys, os, time, re
+import shutil, tempfile, platform, json
+import warnings
 import numpy as np
+import tables
 import logging
-import lofar.parmdb
 from losoto import _version
 from losoto import _logging
 from losoto.h5parm import h5parm, solFetcher, solWriter
 
-# Options
-import optparse
-opt = optparse.OptionParser(usage='%prog -p H5parm [-s solset] -g parmdb [-n 100]\n'\
-                +_author, version='%prog '+_version.__version__)
-opt.add_option('-p', '--h5parm', help='H5parm name', type='string', default='')
-opt.add_option('-g', '--parmdb', help='Parmdb name', type='string', default='')
-opt.add_option('-s', '--solset', help='Solution-set name (default=sol000)', type='string', default='sol000')
-opt.add_option('-n', '--numiter', help='Number of iterations (default=100)', type=int, default=100)
-(options, args) = opt.parse_args()
-
-_logging.setLevel('debug')
-
-n = options.numiter
-
-solset = options.solset
-h5parmFile = options.h5parm
-H5 = h5parm(h5parmFile, readonly=False)
-H = solFetcher(H5.getSoltab(solset,'rotation000'))
-logging.info("H5parm filename = "+h5parmFile)
-
-parmdbFile = options.parmdb
-P = lofar.parmdb.parmdb(parmdbFile)
-P2 = lofar.parmdb.parmdb('tmp.parmdb', create=True)
-logging.info("parmdb filename = "+parmdbFile)
-
-######################################################
-logging.info("### Read all frequencies for a pol/dir/station")
-
-start = time.clock()
-for i in xrange(n):
-    Pfreqs = P.getValuesGrid('RotationAngle:CS001LBA:3C196')['RotationAngle:CS001LBA:3C196']['freqs']
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='3C196',ant='CS001LBA')
-    Hfreqs = H.freq
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-#print "Equal?",(Pfreqs == Hfreqs).all()
-
-######################################################
-logging.info("### Read all times for a pol/dir/station")
-
-start = time.clock()
-for i in xrange(n):
-    Ptimes = P.getValuesGrid('RotationAngle:CS001LBA:3C196')['RotationAngle:CS001LBA:3C196']['times']
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='3C196',ant='CS001LBA')
-    Htimes = H.time
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-#print "Equal?",(Ptimes == Htimes).all()
-
-######################################################
-logging.info("### Read all rotations for 1 station (slice in time)")
-
-start = time.clock()
-for i in xrange(n):
-    Prot = P.getValuesGrid('CommonRotationAngle:CS001LBA',stime=Ptimes[30],etime=Ptimes[-30])['CommonRotationAngle:CS001LBA']['values'].transpose()[0]
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='pointing', ant='CS001LBA', time={'min':Htimes[31],'max':Htimes[-29]})
-    Hrot = H.getValues(retAxesVals = False)
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-#print "Equal?", (Prot == np.squeeze(Hrot)).all()
-
-######################################################
-logging.info("### Read all rotations for all station (slice in time)")
-
-start = time.clock()
-for i in xrange(n):
-    Protd = P.getValuesGrid('CommonRotationAngle:*',stime=Ptimes[30],etime=Ptimes[-30])
-    # construct the matrix
-    Prot = []
-    for ant in sorted(Protd.iterkeys()):
-        Prot.append(Protd[ant]['values'].transpose()[0])
-    Prot = np.array(Prot)
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='pointing', time={'min':Htimes[31],'max':Htimes[-29]})
-    Hrot = H.getValues(retAxesVals = False)
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-#print "Equal?", (Prot == np.squeeze(Hrot)).all()
-
-######################################################
-logging.info("### Read all rotations for remote stations (slice in ant)")
-
-start = time.clock()
-for i in xrange(n):
-    Protd = P.getValuesGrid('CommonRotationAngle:RS*')
-    # construct the matrix
-    Prot = []
-    for ant in sorted(Protd.iterkeys()):
-        Prot.append(Protd[ant]['values'].transpose()[0])
-    Prot = np.array(Prot)
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='pointing', ant='RS*')
-    Hrot = H.getValues(retAxesVals = False)
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-#print "Equal?", (Prot == np.squeeze(Hrot)).all()
-
-######################################################
-# read+write
-logging.info("### Read all rotations for a dir/station and write them back")
-Hw = solWriter(H5.getSoltab(solset,'rotation000'))
-
-start = time.clock()
-for i in xrange(n):
-    Prot = P.getValuesGrid('CommonRotationAngle:CS001LBA')
-    Prot = {'test'+str(i):Prot['CommonRotationAngle:CS001LBA']}
-    P2.addValues(Prot)
-    # parmdb write?
-elapsed = (time.clock() - start)
-logging.info("PARMDB -- "+str(elapsed)+" s.")
-
-start = time.clock()
-for i in xrange(n):
-    H.setSelection(dir='pointing', ant='CS001LBA')
-    Hrot = H.getValues(retAxesVals = False)
-    Hw.setSelection(dir='pointing', ant='CS001LBA')
-    Hw.setValues(Hrot)
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-######################################################
-# read whole file
-logging.info("### Read and tabulate the whole file")
-
-start = time.clock()
-val = P.getValuesGrid('')
-elapsed = (time.clock() - start)
-logging.info("parmdb -- "+str(elapsed)+" s.")
-
-start = time.clock()
-H.setSelection()
-val, axes = H.getValues()
-#print "Shape:", val.shape
-elapsed = (time.clock() - start)
-logging.info("H5parm -- "+str(elapsed)+" s.")
-
-
-
-
-del H
-del P
-del P2
-os.system('rm -r tmp.parmdb')
+# runs slower than the reference by more than this fraction (and by more
+# than _minDiff seconds, as very short timings are noisy) are reported
+_tolerance = 0.2
+_minDiff = 0.01
+
+def makeTestFile(h5parmFile, nant, ndir, npol, nfreq, ntime):
+    """
+    Create an H5parm with a phase and an amplitude synthetic table
+    and return their axes values
+    """
+    np.random.seed(0)
+    axesNames = ['pol','dir','ant','freq','time']
+    axesVals = [np.array(['XX','YY','XY','YX'][:npol]),
+                np.array(['dir%03i' % i for i in xrange(ndir)]),
+                np.array(['CS%03iHBA0' % i for i in xrange(nant//2)] + ['RS%03iHBA' % i for i in xrange(nant-nant//2)]),
+                np.linspace(120e6, 180e6, nfreq),
+                4.8e9 + 10.*np.arange(ntime)]
+    shape = [len(v) for v in axesVals]
+
+    # smooth solutions plus noise and a few outliers, ~5% flagged
+    t = np.linspace(0, 2*np.pi, ntime)
+    phases = np.sin(t) + 0.1*np.random.normal(size=shape)
+    phases[np.random.rand(*shape) < 0.001] += 5.
+    amps = 1. + 0.1*np.cos(t) + 0.01*np.random.normal(size=shape)
+    amps[np.random.rand(*shape) < 0.001] *= 10.
+    weights = (np.random.rand(*shape) > 0.05).astype(np.float16)
+
+    H5 = h5parm(h5parmFile, readonly=False)
+    solset = H5.makeSolset('sol000')
+    H5.makeSoltab(solset, 'phase', 'phase000', axesNames=axesNames, axesVals=axesVals, vals=phases, weights=weights)
+    H5.makeSoltab(solset, 'amplitude', 'amplitude000', axesNames=axesNames, axesVals=axesVals, vals=amps, weights=weights)
+    H5.close()
+    return dict(zip(axesNames, axesVals)), phases, weights
+
+
+def timeit(name, funct, numiter, setup=None):
+    """
+    Run funct numiter times and return the timings (wall-clock, as
+    operations may run in parallel)
+    setup -- function called (untimed) before each run
+    """
+    times = []
+    for i in xrange(numiter):
+        if setup is not None: setup()
+        start = time.time()
+        funct()
+        times.append(time.time() - start)
+    logging.info("%-28s min %8.4f s  mean %8.4f s" % (name, np.min(times), np.mean(times)))
+    return {'min':np.min(times), 'mean':np.mean(times), 'n':numiter}
+
+
+if __name__=='__main__':
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [-s 40] [-d 2] [-p 2] [-f 30] [-t 1000] [-n 3] [-o H5parm_benchmark.json] [-r reference.json]\n'\
+                    +_author, version='%prog '+_version.__version__)
+    opt.add_option('-s', '--nant', help='Number of stations (default=40)', type=int, default=40)
+    opt.add_option('-d', '--ndir', help='Number of directions (default=2)', type=int, default=2)
+    opt.add_option('-p', '--npol', help='Number of polarizations, max 4 (default=2)', type=int, default=2)
+    opt.add_option('-f', '--nfreq', help='Number of frequencies (default=30)', type=int, default=30)
+    opt.add_option('-t', '--ntime', help='Number of times (default=1000)', type=int, default=1000)
+    opt.add_option('-n', '--numiter', help='Number of runs of each benchmark, the minimum is the reference (default=3)', type=int, default=3)
+    opt.add_option('-c', '--ncpu', help='Number of CPUs used by the operations, 0 means all (default=0)', type=int, default=0)
+    opt.add_option('-b', '--bench', help='Run only benchmarks matching this regular expression (default=all)', type='string', default='')
+    opt.add_option('-o', '--output', help='JSON file where results are saved (default=H5parm_benchmark.json)', type='string', default='H5parm_benchmark.json')
+    opt.add_option('-r', '--reference', help='JSON file of a previous run to compare with (default=None)', type='string', default=None)
+    opt.add_option('-w', '--workdir', help='Directory for the temporary H5parms (default=system temp dir)', type='string', default=None)
+    opt.add_option('-v', '--verbose', help='Show also the log and warnings of the operations (default=False)', action='store_true', default=False)
+    (options, args) = opt.parse_args()
+
+    _logging.setLevel('info')
+    warnings.simplefilter('ignore', RuntimeWarning) # NaNs in the operations
+
+    if options.npol < 1 or options.npol > 4:
+        logging.critical('Number of polarizations must be between 1 and 4.')
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix='H5parm_benchmark', dir=options.workdir)
+    h5parmFile = os.path.join(workdir, 'test.h5')
+    h5parmOrigFile = os.path.join(workdir, 'orig.h5')
+    n = options.numiter
+    results = {}
+
+    def runBench(name, funct, setup=None):
+        """
+        Run a benchmark if selected by the user
+        """
+        if not re.search(options.bench, name): return
+        results[name] = timeit(name, funct, n, setup)
+
+    def restore():
+        """
+        Start from the original synthetic data
+        """
+        shutil.copy(h5parmOrigFile, h5parmFile)
+
+    try:
+        logging.info("Creating synthetic H5parm: %i stations, %i directions, %i pols, %i freqs, %i times" % \
+                (options.nant, options.ndir, options.npol, options.nfreq, options.ntime))
+        axes, phases, weights = makeTestFile(h5parmOrigFile, options.nant, options.ndir, options.npol, options.nfreq, options.ntime)
+        restore()
+        axesNames = ['pol','dir','ant','freq','time']
+        axesVals = [axes[axisName] for axisName in axesNames]
+        times = axes['time']
+
+        ######################################################
+        logging.info("### H5parm library")
+        H5 = h5parm(h5parmFile, readonly=False)
+        solset = H5.getSolset('sol000')
+        st = H5.getSoltab(solset, 'phase000')
+        sf = solFetcher(st)
+
+        def makeSoltab():
+            H5.makeSoltab(solset, 'phase', 'phaseBench', axesNames=axesNames, axesVals=axesVals, vals=phases, weights=weights)
+            H5.H.flush()
+        def delSoltab():
+            if 'phaseBench' in H5.getSoltabs(solset): H5.delSoltab(solset, 'phaseBench')
+        runBench('makeSoltab', makeSoltab, setup=delSoltab)
+        delSoltab()
+
+        def makeSoltabEmpty():
+            H5.makeSoltab(solset, 'phase', 'phaseBench', axesNames=axesNames, axesVals=axesVals)
+            H5.H.flush()
+        runBench('makeSoltab (empty)', makeSoltabEmpty, setup=delSoltab)
+        delSoltab()
+
+        def setSelection():
+            sf.setSelection(pol='XX', dir=['dir000'], ant='^RS', time={'min':times[10], 'max':times[-10], 'step':2})
+        runBench('setSelection', setSelection)
+
+        def getValues(**sel):
+            sf.setSelection(**sel)
+            sf.getValues(retAxesVals=False)
+        runBench('getValues (all)', lambda: getValues())
+        runBench('getValues (slice)', lambda: getValues(time={'min':times[len(times)//4], 'max':times[-len(times)//4]}))
+        runBench('getValues (list)', lambda: getValues(ant=list(axes['ant'][::3]), freq=list(axes['freq'][::2])))
+        runBench('getValues (regexp)', lambda: getValues(ant='^RS'))
+        runBench('getValues (1 station)', lambda: getValues(ant=axes['ant'][0]))
+
+        def getValuesIter(returnAxes):
+            sf.setSelection()
+            for vals, w, coord, selection in sf.getValuesIter(returnAxes=returnAxes, weight=True):
+                pass
+        runBench('getValuesIter (freq,time)', lambda: getValuesIter(['freq','time']))
+        runBench('getValuesIter (time)', lambda: getValuesIter(['time']))
+
+        def setValues(useCache):
+            # read and write back one station at a time
+            sw = solWriter(st, useCache=useCache)
+            for ant in axes['ant']:
+                sf.setSelection(ant=[ant])
+                sw.setSelection(ant=[ant])
+                sw.setValues(sf.getValues(retAxesVals=False))
+            if useCache: sw.flush()
+        runBench('setValues (no cache)', lambda: setValues(False))
+        runBench('setValues (cache)', lambda: setValues(True))
+        H5.close()
+
+        ######################################################
+        logging.info("### Operations")
+        try:
+            import lofar.parameterset
+            import losoto.operations as operations
+            from losoto.operations_lib import multiprocManager
+        except ImportError:
+            logging.warning("lofar.parameterset not available, operations not benchmarked.")
+            operations = None
+
+        if operations is not None:
+            parsetFile = os.path.join(workdir, 'benchmark.parset')
+            with open(parsetFile, 'w') as f:
+                f.write("LoSoTo.Ncpu = %i\n" % options.ncpu)
+                f.write("LoSoTo.Steps.flag.Operation = FLAG\n")
+                f.write("LoSoTo.Steps.flag.Soltab = [sol000/phase000]\n")
+                f.write("LoSoTo.Steps.flag.Axes = [time]\n")
+                f.write("LoSoTo.Steps.flag.Mode = smooth\n")
+                f.write("LoSoTo.Steps.smooth.Operation = SMOOTH\n")
+                f.write("LoSoTo.Steps.smooth.Soltab = [sol000/phase000]\n")
+                f.write("LoSoTo.Steps.smooth.Axes = [freq,time]\n")
+                f.write("LoSoTo.Steps.smooth.FWHM = [5,11]\n")
+                f.write("LoSoTo.Steps.clip.Operation = CLIP\n")
+                f.write("LoSoTo.Steps.clip.Soltab = [sol000/amplitude000]\n")
+                f.write("LoSoTo.Steps.clip.Axes = [time]\n")
+                f.write("LoSoTo.Steps.clip.ClipLevel = 5\n")
+            parset = lofar.parameterset.parameterset(parsetFile)
+
+            # start the worker pool (kept for all the runs) while no H5parm is open:
+            # workers forked with an open file would keep it locked
+            ncpu = options.ncpu
+            if ncpu == 0:
+                import multiprocessing
+                ncpu = multiprocessing.cpu_count()
+            multiprocManager.startPool(ncpu)
+
+            def runOp(step, op):
+                if not options.verbose: logging.root.setLevel(logging.ERROR)
+                H = h5parm(h5parmFile, readonly=False)
+                try:
+                    returncode = op.run(step, parset, H)
+                finally:
+                    _logging.setLevel('info')
+                    H.close()
+                if returncode != 0:
+                    logging.error("Operation "+step+" failed.")
+            runBench('FLAG', lambda: runOp('flag', operations.flag), setup=restore)
+            runBench('SMOOTH', lambda: runOp('smooth', operations.smooth), setup=restore)
+            runBench('CLIP', lambda: runOp('clip', operations.clip), setup=restore)
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    ######################################################
+    run = {'losoto':_version.__version__, 'h5parm':_version.__h5parmVersion__, 'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+           'host':platform.node(), 'python':platform.python_version(), 'numpy':np.__version__, 'tables':tables.__version__,
+           'nant':options.nant, 'ndir':options.ndir, 'npol':options.npol, 'nfreq':options.nfreq, 'ntime':options.ntime,
+           'ncpu':options.ncpu, 'results':results}
+    with open(options.output, 'w') as f:
+        json.dump(run, f, indent=1, sort_keys=True)
+    logging.info("Results saved in "+options.output)
+
+    # compare with a previous run
+    if options.reference is not None:
+        with open(options.reference) as f:
+            ref = json.load(f)
+        logging.info("### Comparison with %s (losoto %s, %s)" % (options.reference, ref['losoto'], ref['date']))
+        if [ref[k] for k in ['nant','ndir','npol','nfreq','ntime']] != [run[k] for k in ['nant','ndir','npol','nfreq','ntime']]:
+            logging.warning("Reference run used a different table size.")
+        slower = []
+        for name in sorted(results):
+            if not name in ref['results']: continue
+            tRef, tNew = ref['results'][name]['min'], results[name]['min']
+            logging.info("%-28s %8.4f s -> %8.4f s (x%.2f)" % (name, tRef, tNew, tNew/tRef))
+            if tNew > (1 + _tolerance)*tRef and tNew - tRef > _minDiff: slower.append(name)
+        if slower != []:
+            logging.warning("Slower than the reference: "+', '.join(slower))
+            sys.exit(1)
+
+    logging.info("Done.")
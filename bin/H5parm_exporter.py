@@ -16,6 +16,7 @@ import lofar.parmdb
 from losoto import _version
 from losoto import _logging
 from losoto.h5parm import h5parm, solWriter, solFetcher
+from losoto.operations_lib import multiprocManager
 try:
     import progressbar
 except ImportError:
@@ -192,6 +193,142 @@ def getSoltabFromSolType(solType, solTabs, parm='ampl'):
         return solTabList
 
 
+def fillParmdbValues(solType, data, solTabs):
+    """Fill the values of the parmdb entries of a solution type from the H5parm
+
+    solType - string defining solution type. E.g., "DirectionalGain"
+    data - parmdb entries as returned by parmdb.getValuesGrid(), the values
+           are replaced in place
+    solTabs - solution tables returned by h5parm.getSoltabs()
+
+    Every solution table is read only once, in the block of frequencies and
+    times covered by the entries, which are then taken from the block with
+    index maps of the ant/pol/dir names.
+    """
+    # find the solution table(s) of every entry, they depend only on the parm
+    entries = []
+    parmSolTabs = {}
+    for solEntry in data:
+
+        pol, dir, ant, parm = parmdbToAxes(solEntry)
+        if not parm in parmSolTabs:
+            solTabList = getSoltabFromSolType(solType, solTabs, parm=parm)
+            if solTabList is not None and len(solTabList) > 1:
+                logging.warning('More than one solution table found in H5parm '
+                        'matching parmdb entry "'+solType+'". Taking the first match: '+str(solTabList[0])+'.')
+            # If needed, Amp and Phase are converted to Real and Imag
+            solTabOther = None
+            if parm == 'Real':
+                solTabOther = getSoltabFromSolType(solType, solTabs, parm='phase')[0]
+            elif parm == 'Imag':
+                solTabOther = getSoltabFromSolType(solType, solTabs, parm='ampl')[0]
+            if solTabList is None: parmSolTabs[parm] = None
+            else: parmSolTabs[parm] = (solTabList[0], solTabOther)
+        if parmSolTabs[parm] is None:
+            continue
+        solTab, solTabOther = parmSolTabs[parm]
+
+        times = data[solEntry]['times']
+        # workaround for bbs and ndppp dealing differently with the last time slot when #timeslots%ntime != 0
+        # NDPPP has all intervals the same
+        # BBS has a maller interval in the last timeslot which is compensated here
+        if times[-1] - times[-2] < times[-2] - times[-3]: times[-1] = times[-2] + (times[-2] - times[-3])
+
+        entries.append([solEntry, pol, dir, ant, parm, solTab, solTabOther])
+
+    # read every solution table once, in the freq/time block of all its entries
+    blocks = {}
+    for solEntry, pol, dir, ant, parm, solTab, solTabOther in entries:
+        for st in [solTab, solTabOther]:
+            if st is None: continue
+            if not st._v_pathname in blocks:
+                blocks[st._v_pathname] = {'solTab':st, 'freqs':set(), 'tmin':np.inf, 'tmax':-np.inf, 'grids':{}}
+            block = blocks[st._v_pathname]
+            block['freqs'] |= set(data[solEntry]['freqs'])
+            block['tmin'] = min(block['tmin'], np.min(data[solEntry]['times']-0.1))
+            block['tmax'] = max(block['tmax'], np.max(data[solEntry]['times']+0.1))
+
+    for block in blocks.itervalues():
+        sf = solFetcher(block['solTab'])
+        parms = {}
+        if 'freq' in sf.getAxesNames(): parms['freq'] = sorted(block['freqs'])
+        if 'time' in sf.getAxesNames(): parms['time'] = {'min':block['tmin'], 'max':block['tmax']}
+        sf.setSelection(**parms)
+        block['axesNames'] = sf.getAxesNames()
+        block['vals'], block['axesVals'] = sf.getValues()
+        block['weights'] = sf.getValues(retAxesVals=False, weight=True)
+        # index maps of the names as written by parmdbToAxes()
+        for axisName in ['ant', 'pol', 'dir']:
+            if axisName in block['axesNames']:
+                block[axisName] = dict([(re.escape(axisVal), i) for i, axisVal in enumerate(block['axesVals'][axisName])])
+
+    def getBlockValues(st, solEntry, pol, dir, ant):
+        """Return values and weights of an entry from the block of a solution table"""
+        block = blocks[st._v_pathname]
+        freqs = data[solEntry]['freqs']
+        times = data[solEntry]['times']
+        # the freq/time indexes are the same for all the entries on the same grid
+        gridKey = (tuple(freqs), np.min(times), np.max(times))
+        if not gridKey in block['grids']:
+            grid = {}
+            for axisName, axisVals in block['axesVals'].iteritems():
+                if axisName == 'freq':
+                    freqIdx = [i for i, freq in enumerate(axisVals) if freq in freqs]
+                    if len(freqIdx) == 0: freqIdx = range(len(axisVals))
+                    grid[axisName] = np.array(freqIdx)
+                elif axisName == 'time':
+                    timeIdx = np.where((axisVals >= np.min(times-0.1)) & (axisVals <= np.max(times+0.1)))[0]
+                    grid[axisName] = np.arange(timeIdx[0], timeIdx[-1]+1)
+                elif not axisName in ['ant', 'pol', 'dir']:
+                    grid[axisName] = np.arange(len(axisVals))
+            block['grids'][gridKey] = grid
+        grid = block['grids'][gridKey]
+        idx = []
+        for axisName in block['axesNames']:
+            if axisName == 'ant': idx.append([block['ant'][ant]])
+            elif axisName == 'pol': idx.append([block['pol'][pol]])
+            elif axisName == 'dir': idx.append([block['dir'][dir]])
+            else: idx.append(grid[axisName])
+        idx = np.ix_(*idx)
+        return block['vals'][idx], block['weights'][idx]
+
+    for solEntry, pol, dir, ant, parm, solTab, solTabOther in entries:
+
+        val, weights = getBlockValues(solTab, solEntry, pol, dir, ant)
+        if parm == 'Real':
+            val_phase, weights2 = getBlockValues(solTabOther, solEntry, pol, dir, ant)
+            val = val * np.cos(val_phase)
+        elif parm == 'Imag':
+            val_amp, weights2 = getBlockValues(solTabOther, solEntry, pol, dir, ant)
+            val = val_amp * np.sin(val)
+
+        # etienne part; if it is borken, curse his name
+        # check whether this is clock or tec; if so, reshape properly to account for all freqs in the parmdb
+        # anyway these tables are freq-indep
+        if solType == "Clock":# or solType == "TEC" or solType == "RotationMeasure":
+            # find freq-dimensionality 
+            nfreq = data[solEntry]['freqs'].shape[0]
+            # reshape such that all freq arrays are filled properly
+            val = np.tile( val, np.append([nfreq], np.ones(len(val.shape),dtype=np.int) ) )
+            weights = np.tile( weights, np.append([nfreq], np.ones(len(weights.shape),dtype=np.int) ) )
+
+        # Apply flags
+        flags = (weights == 0)
+        if parm == 'Real' or parm == 'Imag':
+            flags |= (weights2 == 0)
+        np.putmask(val, flags, np.nan)
+
+        shape = data[solEntry]['values'].shape
+        try:
+            data[solEntry]['values'] = val.T.reshape(shape)
+        except ValueError, err:
+            # raised (not sys.exit()) as this may run in a worker process
+            raise ValueError('Mismatch between parmdb table and H5parm '
+            'solution table: Differing number of frequencies and/or times')
+
+    return data
+
+
 def makeTECparmdb(H, solset, TECsolTab, timewidths, freq, freqwidth):
     """Returns TEC screen parmdb parameters
 
@@ -202,7 +339,6 @@ def makeTECparmdb(H, solset, TECsolTab, timewidths, freq, freqwidth):
     freq - frequency of output parmdb
     freqwidth - frequency width of output parmdb
     """
-    global ipbar, pbar
 
     station_dict = H.getAnt(solset)
     station_names = station_dict.keys()
@@ -235,65 +371,32 @@ def makeTECparmdb(H, solset, TECsolTab, timewidths, freq, freqwidth):
     v['freqs'] = freqs
     v['freqwidths'] = freqwidths
 
-    for station_name in station_names:
-        for source_name in source_names:
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'Piercepoint:X:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'Piercepoint:Y:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'Piercepoint:Z:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'TECfit_white:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'TECfit_white:0:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-            v['values'] = np.zeros((N_times, N_freqs), dtype=np.double)
-            parmname = 'TECfit_white:1:%s:%s' % (station_name, source_name)
-            parms[parmname] = v.copy()
-
-    for k in range(N_times):
-        D = np.resize(pp[k, :, :], (N_piercepoints, N_piercepoints, 3))
-        D = np.transpose(D, ( 1, 0, 2 )) - D
-        D2 = np.sum(D**2, axis=2)
-        C = -(D2 / (r_0**2))**(beta / 2.0) / 2.0
-        tec_fit_white = np.dot(np.linalg.inv(C),
-            tec_screen[:, k, :].reshape(N_piercepoints))
-        pp_idx = 0
-        for src, source_name in enumerate(source_names):
-            for sta, station_name in enumerate(station_names):
-
-                parmname = 'Piercepoint:X:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = pp[k, pp_idx, 0]
-
-                parmname = 'Piercepoint:Y:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = pp[k, pp_idx, 1]
-
-                parmname = 'Piercepoint:Z:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = pp[k, pp_idx, 2]
-
-                parmname = 'TECfit_white:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = tec_fit_white[pp_idx]
-
-                parmname = 'TECfit_white:0:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = tec_fit_white[pp_idx]
-
-                parmname = 'TECfit_white:1:%s:%s' % (station_name, source_name)
-                parms[parmname]['values'][k, 0] = tec_fit_white[pp_idx]
-
-                pp_idx += 1
-        pbar.update(ipbar)
-        ipbar += 1
+    # whitened TEC: solve C.x = tec for all the timeslots at once (C has a zero
+    # diagonal, so it is not positive definite), in blocks of timeslots to limit
+    # the size of the stacked N_piercepoints x N_piercepoints matrices
+    pp = pp[:]
+    tec_fit_white = np.zeros((N_times, N_piercepoints))
+    blockLen = max(1, 2**24 // (5 * N_piercepoints**2))
+    for k0 in range(0, N_times, blockLen):
+        k1 = min(k0 + blockLen, N_times)
+        D2 = np.sum((pp[k0:k1, :, np.newaxis, :] - pp[k0:k1, np.newaxis, :, :])**2, axis=3)
+        C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
+        tec = tec_screen[:, k0:k1, :].transpose([1, 0, 2]).reshape((k1 - k0, N_piercepoints))
+        tec_fit_white[k0:k1] = np.linalg.solve(C, tec[:, :, np.newaxis])[:, :, 0]
+
+    # values of all the parms (parm x source x station x time x freq), the
+    # piercepoints are ordered by source then station
+    parmnames = ['Piercepoint:X:%s:%s', 'Piercepoint:Y:%s:%s', 'Piercepoint:Z:%s:%s',
+        'TECfit_white:%s:%s', 'TECfit_white:0:%s:%s', 'TECfit_white:1:%s:%s']
+    values = np.empty((len(parmnames), N_sources, N_stations, N_times, N_freqs), dtype=np.double)
+    values[0:3] = pp.reshape((N_times, N_sources, N_stations, 3)).transpose([3, 1, 2, 0])[..., np.newaxis]
+    values[3:6] = tec_fit_white.reshape((N_times, N_sources, N_stations)).transpose([1, 2, 0])[np.newaxis, ..., np.newaxis]
+
+    for src, source_name in enumerate(source_names):
+        for sta, station_name in enumerate(station_names):
+            for i, parmname in enumerate(parmnames):
+                v['values'] = values[i, src, sta]
+                parms[parmname % (station_name, source_name)] = v.copy()
 
     time_start = times[0] - timewidths[0]/2
     time_end = times[-1] + timewidths[-1]/2
@@ -316,6 +419,70 @@ def makeTECparmdb(H, solset, TECsolTab, timewidths, freq, freqwidth):
     return parms
 
 
+def exportParmdb(instrumentdbFile, out_instrumentdbFile, h5parmFile, solsetName,
+        solTabNames, solTypes, pdbSolTypes, len_sol, outQueue=None):
+    """Write an output instrumentdb with the solutions of the H5parm
+
+    instrumentdbFile - input instrumentdb, used as template
+    out_instrumentdbFile - output instrumentdb to create
+    h5parmFile - H5parm file name, it is opened read-only so that many
+                 instrumentdbs can be written in parallel
+    solsetName - name of the solution set to export
+    solTabNames - names of the solution tables to use
+    solTypes - solution types to export (including 'TECScreen')
+    pdbSolTypes - solution types found in the input parmdb
+    len_sol - number of entries of each solution type
+
+    Returns the name of the output instrumentdb.
+    """
+    h5parm_in = h5parm(h5parmFile, readonly = True)
+    solset = h5parm_in.getSolset(solsetName)
+    solTabs = dict([(name, st) for name, st in h5parm_in.getSoltabs(solset).iteritems() if name in solTabNames])
+    st_tec = None
+    for name, st in solTabs.iteritems():
+        if st._v_title == 'tecscreen':
+            st_tec = st
+
+    pdb_out = lofar.parmdb.parmdb(out_instrumentdbFile+'/', create=True)
+    pdb_in = lofar.parmdb.parmdb(instrumentdbFile)
+
+    # Add default values and steps
+    DefValues = pdb_in.getDefValues()
+    for k, v in DefValues.iteritems():
+        pdb_out.addDefValues({k: pdb_in.makeDefValue(v.item(0))})
+    pdb_out.setDefaultSteps(pdb_in.getDefaultSteps())
+
+    # all the entries of this instrument table are written at once
+    data_out = {}
+    for solType in solTypes:
+        if len_sol[solType] == 0: continue
+
+        if solType != 'TECScreen':
+            data = pdb_in.getValuesGrid(solType+':*')
+            data_out.update(fillParmdbValues(solType, data, solTabs))
+        else:
+            # Handle TECScreen parmdb
+            #
+            # Get timewidths, freqwidth and freq from first (non-TEC, phase)
+            # solentry
+            for nonTECsolType in pdbSolTypes:
+                if nonTECsolType != 'TECScreen' and 'Phase' in nonTECsolType:
+                    break
+            parmname = pdb_in.getNames(nonTECsolType+':*')[0]
+            grid = pdb_in.getValuesGrid(parmname)[parmname]
+            timewidths = grid['timewidths']
+            freqwidth = grid['freqwidths'][0]
+            freq = grid['freqs'][0]
+            data_out.update(makeTECparmdb(h5parm_in, solset, st_tec, timewidths, freq, freqwidth))
+
+    pdb_out.addValues(data_out)
+    del pdb_out, pdb_in
+    h5parm_in.close()
+
+    if outQueue is not None: outQueue.put(out_instrumentdbFile)
+    else: return out_instrumentdbFile
+
+
 if __name__=='__main__':
     # Options
     import optparse
@@ -336,8 +503,9 @@ if __name__=='__main__':
         '(default=instrument*)', type='string', default='instrument*')
     opt.add_option('-c', '--clobber', help='Clobber exising files '
         '(default=False)', action='store_true', default=False)
+    opt.add_option('-n', '--ncpu', help='Number of instrumentdbs written in parallel, '
+        '0 means all CPUs (default=0)', type='int', default=0)
     (options, args) = opt.parse_args()
-    global ipbar, pbar
 
     # Check options
     if len(args) != 2:
@@ -444,12 +612,10 @@ if __name__=='__main__':
             N_times = tec_sf.getAxisLen(axis='time')
             len_sol[solType] = N_times
 
-    cachedSolTabs = {}
+    # Remove existing instrumentdbs (if clobber)
+    jobs = []
     for instrumentdbFile in instrumentdbFiles:
         out_instrumentdbFile = out_globaldbFile + '/' + outroot + '_' + instrumentdbFile.split('/')[-1]
-        logging.info('Filling '+out_instrumentdbFile+':')
-
-        # Remove existing instrumentdb (if clobber) and create new one
         if os.path.exists(out_instrumentdbFile):
             if options.clobber:
                 shutil.rmtree(out_instrumentdbFile)
@@ -457,145 +623,40 @@ if __name__=='__main__':
                 logging.critical('Output instrumentdb file exists and '
                     'clobber = False.')
                 sys.exit(1)
-        pdb_out = lofar.parmdb.parmdb(out_instrumentdbFile+'/', create=True)
-
-        pbar = progressbar.ProgressBar(maxval=sum(len_sol.values())).start()
-        ipbar = 0
-
-        pdb_in = lofar.parmdb.parmdb(instrumentdbFile)
-
-        # Add default values and steps
-        DefValues = pdb_in.getDefValues()
-        for k, v in DefValues.iteritems():
-            pdb_out.addDefValues({k: pdb.makeDefValue(v.item(0))})
-        pdb_out.setDefaultSteps(pdb_in.getDefaultSteps())
-
-        for solType in solTypes:
-            if len_sol[solType] == 0: continue
-
-            if solType != 'TECScreen':
-                solEntries = pdb_in.getNames(solType+':*')
-                data = pdb_in.getValuesGrid(solType+':*')
-                data_out = data.copy()
-                for solEntry in solEntries:
-
-                    pol, dir, ant, parm = parmdbToAxes(solEntry)
-                    solTabList = getSoltabFromSolType(solType, solTabs, parm=parm)
-                    if solTabList is None:
-                        continue
-                    if len(solTabList) > 1:
-                        logging.warning('More than one solution table found in H5parm '
-                                'matching parmdb entry "'+solType+'". Taking the first match: '+str(solTabList[0])+'.')
-                    solTab = solTabList[0]
-
-                    # search in the cache for open soltab
-                    if not solTab._v_title in cachedSolTabs:
-                        sf = solFetcher(solTab, useCache=True)
-                        cachedSolTabs[solTab._v_title] = sf
-                    else:
-                        sf = cachedSolTabs[solTab._v_title]
-
-                    freqs = data[solEntry]['freqs']
-                    times = data[solEntry]['times']
-                    parms = {}
-                    if 'ant' in sf.getAxesNames(): parms['ant'] = [ant]
-                    if 'pol' in sf.getAxesNames(): parms['pol'] = [pol]
-                    if 'dir' in sf.getAxesNames(): parms['dir'] = [dir]
-                    if 'freq' in sf.getAxesNames(): parms['freq'] = freqs.tolist()
-                    # workaround for bbs and ndppp dealing differently with the last time slot when #timeslots%ntime != 0
-                    # NDPPP has all intervals the same
-                    # BBS has a maller interval in the last timeslot which is compensated here
-                    if times[-1] - times[-2] < times[-2] - times[-3]: times[-1] = times[-2] + (times[-2] - times[-3])
-                    if 'time' in sf.getAxesNames(): parms['time'] = {'min':np.min(times-0.1), 'max':np.max(times+0.1)}
-                    sf.setSelection(**parms)
-
-                    # If needed, convert Amp and Phase to Real and Imag
-                    if parm == 'Real':
-                        solTabList = getSoltabFromSolType(solType, solTabs, parm='phase')
-                        if not solTabList[0]._v_title in cachedSolTabs:
-                            sf_phase = solFetcher(solTabList[0], useCache=True)
-                            cachedSolTabs[solTabList[0]._v_title] = sf_phase
-                        else:
-                            sf_phase = cachedSolTabs[solTabList[0]._v_title]
-                        sf_phase.setSelection(ant=[ant], pol=[pol], dir=[dir], freq=freqs.tolist(),
-                            time={'min':np.min(times-0.1), 'max':np.max(times+0.1)})
-                        val_amp = sf.getValues()[0]
-                        val_phase = sf_phase.getValues()[0]
-                        val = val_amp * np.cos(val_phase)
-                    elif parm == 'Imag':
-                        solTabList = getSoltabFromSolType(solType, solTabs, parm='ampl')
-                        if not solTabList[0]._v_title in cachedSolTabs:
-                            sf_amp = solFetcher(solTabList[0], useCache=True)
-                            cachedSolTabs[solTabList[0]._v_title] = sf_amp
-                        else:
-                            sf_amp = cachedSolTabs[solTabList[0]._v_title]
-                        sf_amp.setSelection(ant=[ant], pol=[pol], dir=[dir], freq=freqs.tolist(),
-                            time={'min':np.min(times-0.1), 'max':np.max(times+0.1)})
-                        val_phase = sf.getValues()[0]
-                        val_amp = sf_amp.getValues()[0]
-                        val = val_amp * np.sin(val_phase)
-                    else:
-                        val = sf.getValues()[0]
-
-                    # Apply flags
-                    weights = sf.getValues(weight=True)[0]
-
-                    # etienne part; if it is borken, curse his name
-                    # check whether this is clock or tec; if so, reshape properly to account for all freqs in the parmdb
-                    # anyway these tables are freq-indep
-                    if solType == "Clock":# or solType == "TEC" or solType == "RotationMeasure":
-                        # find freq-dimensionality 
-                        nfreq = freqs.shape[0]
-                        #print val.shape
-                        # reshape such that all freq arrays are filled properly
-                        val = np.tile( val, np.append([nfreq], np.ones(len(val.shape),dtype=np.int) ) )
-                        #print val.shape
-                        weights = np.tile( weights, np.append([nfreq], np.ones(len(weights.shape),dtype=np.int) ) )
-
-                    flags = np.zeros(shape=weights.shape, dtype=bool)
-                    flags[np.where(weights == 0)] = True
-                    if parm == 'Real':
-                        weights2 = sf_phase.getValues(weight=True)[0]
-                        flags[np.where(weights2 == 0)] = True
-                    if parm == 'Imag':
-                        weights2 = sf_amp.getValues(weight=True)[0]
-                        flags[np.where(weights2 == 0)] = True
-                    np.putmask(val, flags, np.nan)
-
-                    shape = data_out[solEntry]['values'].shape
-                    #print "shape"
-                    #print 'parmdb', shape
-                    #print 'h5parm', val.shape
-                    #print sf.getAxesNames()
-                    #print sf.getType()
-                    #print "parmdb", times
-                    #for t in times: print '%.1f' % t
-                    #print "h5parm", sf.time
-                    #for t in sf.time: print '%.1f' % t
-                    try:
-                        data_out[solEntry]['values'] = val.T.reshape(shape)
-                    except ValueError, err:
-                        logging.critical('Mismatch between parmdb table and H5parm '
-                        'solution table: Differing number of frequencies and/or times')
-                        sys.exit(1)
-                ipbar += 1
-                pbar.update(ipbar)
-            else:
-                # Handle TECScreen parmdb
-                #
-                # Get timewidths, freqwidth and freq from first (non-TEC, phase)
-                # solentry
-                for nonTECsolType in pdbSolTypes:
-                    if nonTECsolType != 'TECScreen' and 'Phase' in nonTECsolType:
-                        break
-                parmname = pdb_in.getNames(nonTECsolType+':*')[0]
-                timewidths = pdb_in.getValuesGrid(parmname)[parmname]['timewidths']
-                freqwidth = pdb.getValuesGrid(parmname)[parmname]['freqwidths'][0]
-                freq = pdb.getValuesGrid(parmname)[parmname]['freqs'][0]
-                data_out = makeTECparmdb(h5parm_in, solset, st_tec, timewidths, freq, freqwidth)
-
-            pdb_out.addValues(data_out)
-
-        pbar.finish()
+        jobs.append([instrumentdbFile, out_instrumentdbFile, h5parmFile, solsetName, \
+                solTabs.keys(), solTypes, pdbSolTypes, len_sol])
+
+    # every output instrumentdb is independent: they are written in parallel,
+    # each worker opens the H5parm read-only (an HDF5 file open across fork()
+    # cannot be used by the children, so it is closed here)
+    h5parm_in.close()
+    ncpu = options.ncpu
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
+    if ncpu > 1:
+        mpm = multiprocManager(ncpu, exportParmdb)
+        results = mpm.imap(jobs, skipErrors=True)
+    else:
+        def serialJobs():
+            for job in jobs:
+                try:
+                    yield exportParmdb(*job)
+                except ValueError, err:
+                    logging.error(str(err))
+        results = serialJobs()
+
+    logging.info('Filling %i instrumentdbs.' % len(jobs))
+    pbar = progressbar.ProgressBar(maxval=len(jobs)).start()
+    ipbar = 0
+    for out_instrumentdbFile in results:
+        logging.debug('Filled '+out_instrumentdbFile+'.')
+        ipbar += 1
+        pbar.update(ipbar)
+    pbar.finish()
+
+    if ipbar != len(jobs):
+        logging.critical('Failed filling some instrumentdbs.')
+        sys.exit(1)
 
     logging.info('Done.')
@@ -15,21 +15,225 @@ import lofar.parmdb
 from losoto import _version
 from losoto import _logging
 import losoto.h5parm
+from losoto.operations_lib import multiprocManager
+
+# H5parm files opened read-only by readBlock(), kept open between the jobs of a worker
+_h5parms = {}
+
+def readBlock(parts, blockTo, outQueue=None):
+    """
+    Read the values and weights of a destination block from the inputs it overlaps
+    Keyword arguments:
+    parts -- list of (H5parm file name, solution-set name, solution-table name, block of the
+        input, position in the destination block), blocks and positions are tuples of slices
+    blockTo -- destination block, returned with the data
+    """
+    vals = weights = None
+    for h5parmFile, solsetName, soltabName, block, blockIn in parts:
+        if not h5parmFile in _h5parms:
+            _h5parms[h5parmFile] = losoto.h5parm.h5parm(h5parmFile)
+        soltab = _h5parms[h5parmFile].getSoltab(solsetName, soltabName)
+        if vals is None:
+            shape = [b.stop-b.start for b in blockTo]
+            vals = np.empty(shape, dtype=soltab.val.dtype)
+            weights = np.empty(shape, dtype=soltab.weight.dtype)
+        vals[blockIn] = soltab.val[block]
+        weights[blockIn] = soltab.weight[block]
+    if outQueue is not None: outQueue.put([blockTo, vals, weights])
+    else: return [blockTo, vals, weights]
+
+
+def planBlocks(dim, chunkShape, bufLen=2**22):
+    """
+    Return the list of blocks (tuples of slices) covering an array, made of whole
+    chunks and extended along the last axes while they fit in the buffer
+    Keyword arguments:
+    dim -- shape of the array
+    chunkShape -- chunk shape of the destination
+    bufLen -- maximum number of elements in a block
+    """
+    blockShape = list(chunkShape)
+    for i in reversed(xrange(len(dim))):
+        blockShape[i] = max(1, dim[i])
+        if np.prod(blockShape) > bufLen:
+            otherLen = int(np.prod(blockShape[:i]+blockShape[i+1:]))
+            blockShape[i] = max(chunkShape[i], (bufLen // otherLen) // chunkShape[i] * chunkShape[i])
+            break
+    return [tuple([slice(i*b, (i+1)*b) for i, b in zip(blockIdx, blockShape)]) \
+            for blockIdx in np.ndindex(*[int(np.ceil(d/float(b))) for d, b in zip(dim, blockShape)])]
+
+
+def concatSolsets(h5parmsFrom, h5parmToFile, solsetTo, axis, ncpu=0):
+    """
+    Concatenate the solution-tables of many solution-sets along an axis (e.g.
+    per-subband H5parms along freq) into a new solution-set. All the other axes
+    must match. Data are copied block by block, never loading a whole table in memory.
+    Keyword arguments:
+    h5parmsFrom -- list of (H5parm file, solset) to concatenate
+    h5parmToFile -- destination H5parm file
+    solsetTo -- destination solution-set
+    axis -- axis to concatenate along
+    ncpu -- number of processes reading the input blocks, 0 means all the CPUs
+    """
+    # check the inputs and plan the destination tables
+    soltabsInfo = {}
+    soltabNames = None
+    for h5parmFromFile, solsetFrom in h5parmsFrom:
+        hf = losoto.h5parm.h5parm(h5parmFromFile)
+        soltabs = hf.getSoltabs(solset=solsetFrom)
+        if soltabNames is None:
+            soltabNames = sorted(soltabs.keys())
+        elif sorted(soltabs.keys()) != soltabNames:
+            logging.critical('Different solution-tables in %s:%s.' % (h5parmFromFile, solsetFrom))
+            sys.exit(1)
+
+        for soltabName in soltabNames:
+            sf = losoto.h5parm.solFetcher(soltabs[soltabName])
+            axesNames = sf.getAxesNames()
+            if not axis in axesNames:
+                logging.critical('Solution-table %s has no axis "%s".' % (soltabName, axis))
+                sys.exit(1)
+            info = {'file':h5parmFromFile, 'solset':solsetFrom, 'shape':soltabs[soltabName].val.shape, \
+                    'axisVals':sf.getAxisValues(axis, ignoreSelection=True)}
+            if not soltabName in soltabsInfo:
+                attrs = dict([(attr, soltabs[soltabName]._v_attrs[attr]) for attr in soltabs[soltabName]._v_attrs._f_list('user')])
+                soltabsInfo[soltabName] = {'type':sf.getType(), 'axesNames':axesNames, 'attrs':attrs, \
+                        'axesVals':[sf.getAxisValues(axisName, ignoreSelection=True) for axisName in axesNames], 'inputs':[]}
+                extraNodes = [node for node in soltabs[soltabName]._v_children if not node in axesNames+['val','weight']]
+                if len(extraNodes) != 0:
+                    logging.warning('Solution-table %s: %s not concatenated.' % (soltabName, ', '.join(extraNodes)))
+            stInfo = soltabsInfo[soltabName]
+            if sf.getType() != stInfo['type'] or axesNames != stInfo['axesNames']:
+                logging.critical('Solution-table %s in %s:%s has a different type or axes.' % (soltabName, h5parmFromFile, solsetFrom))
+                sys.exit(1)
+            for axisName, axisVals in zip(stInfo['axesNames'], stInfo['axesVals']):
+                if axisName != axis and not np.array_equal(axisVals, sf.getAxisValues(axisName, ignoreSelection=True)):
+                    logging.critical('Solution-table %s in %s:%s: axis "%s" does not match.' % (soltabName, h5parmFromFile, solsetFrom, axisName))
+                    sys.exit(1)
+            stInfo['inputs'].append(info)
+        hf.close()
+
+    # inputs in the destination file are read through its (read-write) handle,
+    # and not by other processes while it is being written
+    sameFiles = [h5parmFromFile for h5parmFromFile, solsetFrom in h5parmsFrom \
+            if os.path.isfile(h5parmToFile) and os.path.samefile(h5parmFromFile, h5parmToFile)]
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
+    if sameFiles != [] and ncpu > 1:
+        logging.warning('The destination file is also an input, reading serially.')
+        ncpu = 1
+
+    # HDF5 files must not be open in the parent when the processes are started
+    if ncpu > 1:
+        mpm = multiprocManager(ncpu, readBlock)
+
+    ht = losoto.h5parm.h5parm(h5parmToFile, readonly=False)
+    if solsetTo in ht.getSolsets():
+        logging.critical('Destination solset already exists, quitting.')
+        sys.exit(1)
+    ssT = ht.makeSolset(solsetName = solsetTo, addTables=False)
+    for h5parmFromFile in sameFiles: _h5parms[h5parmFromFile] = ht
+    # antenna and source tables from the first input
+    if h5parmsFrom[0][0] in sameFiles: hf = ht
+    else: hf = losoto.h5parm.h5parm(h5parmsFrom[0][0])
+    ssF = hf.getSolset(solset=h5parmsFrom[0][1])
+    ssF._f_get_child('antenna')._f_copy(ssT)
+    ssF._f_get_child('source')._f_copy(ssT)
+    if hf is not ht: hf.close()
+
+    for soltabName in soltabNames:
+        stInfo = soltabsInfo[soltabName]
+        axisIdx = stInfo['axesNames'].index(axis)
+
+        # inputs in order along the concatenation axis, which must be increasing
+        inputs = sorted(stInfo['inputs'], key=lambda info: np.min(info['axisVals']))
+        axisVals = np.concatenate([info['axisVals'] for info in inputs])
+        if np.any(np.diff(axisVals) <= 0):
+            logging.critical('Solution-table %s: values along "%s" overlap or are not sorted.' % (soltabName, axis))
+            sys.exit(1)
+        axesVals = list(stInfo['axesVals'])
+        axesVals[axisIdx] = axisVals
+
+        logging.info('Concatenating %s along %s (%i inputs).' % (soltabName, axis, len(inputs)))
+        st = ht.makeSoltab(ssT, stInfo['type'], soltabName, axesNames=stInfo['axesNames'], axesVals=axesVals, \
+                parmdbType=stInfo['attrs'].get('parmdb_type'))
+        for attr, attrVal in stInfo['attrs'].iteritems():
+            if not attr in ['parmdb_type', 'chunk_axes', 'CLASS', 'TITLE', 'VERSION']: st._v_attrs[attr] = attrVal
+
+        # blocks on the destination chunk grid, each one filled from all the inputs it
+        # overlaps, so that every destination chunk is written once
+        dim = st.val.shape
+        offsets = np.cumsum([0]+[info['shape'][axisIdx] for info in inputs])
+        jobs = []
+        for blockTo in planBlocks(dim, st.val.chunkshape):
+            # the last blocks along each axis may be shorter than planned
+            blockTo = tuple([slice(b.start, min(b.stop, d)) for b, d in zip(blockTo, dim)])
+            start, stop = blockTo[axisIdx].start, blockTo[axisIdx].stop
+            parts = []
+            for info, offset in zip(inputs, offsets):
+                partStart = max(start, offset)
+                partStop = min(stop, offset+info['shape'][axisIdx])
+                if partStart >= partStop: continue
+                block = list(blockTo)
+                block[axisIdx] = slice(partStart-offset, partStop-offset)
+                blockIn = [slice(None)]*len(dim)
+                blockIn[axisIdx] = slice(partStart-start, partStop-start)
+                parts.append((info['file'], info['solset'], soltabName, tuple(block), tuple(blockIn)))
+            jobs.append([parts, blockTo])
+        if ncpu > 1:
+            results = mpm.imap(jobs, skipErrors=True)
+        else:
+            results = (readBlock(*job) for job in jobs)
+
+        nBlocks = 0
+        for blockTo, vals, weights in results:
+            st.val[blockTo] = vals
+            st.weight[blockTo] = weights
+            nBlocks += 1
+        if nBlocks != len(jobs):
+            logging.critical('Failed reading some blocks of %s.' % soltabName)
+            sys.exit(1)
+
+        sw = losoto.h5parm.solWriter(st)
+        sw.addHistory('MERGE (concatenated along {0} from {1})'.format(axis, \
+                ', '.join(['{0}:{1}'.format(info['file'], info['solset']) for info in inputs])))
+
+    for hf in _h5parms.values():
+        if hf is not ht: hf.close()
+    ht.close()
+
 
 if __name__=='__main__':
     # Options
     import optparse
     opt = optparse.OptionParser(usage='%prog [-v] <H5parm:solset> <H5parm:solset> \n'\
+                            +'       %prog [-v] -a <axis> [-n <ncpu>] <H5parm:solset> [<H5parm:solset> ...] <H5parm:solset> \n'\
                             +_author, version='%prog '+_version.__version__)
     opt.add_option('-v', '--verbose', help='Go VERBOSE! (default=False)', action='store_true', default=False)
+    opt.add_option('-a', '--axis', help='Concatenate the solution-tables of all the input solsets along this axis (e.g. freq or time) into the last solset (default=copy the first solset into the second)', type='string', default=None)
+    opt.add_option('-n', '--ncpu', help='Number of processes reading the inputs when concatenating, 0 means all CPUs (default=0)', type='int', default=0)
     (options, args) = opt.parse_args()
 
     # Check options
-    if len(args) != 2:
+    if len(args) < 2 or (options.axis is None and len(args) != 2):
         opt.print_help()
         sys.exit()
     if options.verbose: _logging.setLevel("debug")
 
+    if options.axis is not None:
+        h5parmsFrom = [h5parmFrom.split(':') for h5parmFrom in args[:-1]]
+        h5parmToFile, solsetTo = args[-1].split(':')
+        for h5parmFromFile, solsetFrom in h5parmsFrom:
+            logging.info("H5parm origin = "+h5parmFromFile+':'+solsetFrom)
+            if not os.path.isfile(h5parmFromFile):
+                logging.critical("Missing H5parm file.")
+                sys.exit(1)
+        logging.info("H5parm destination = "+args[-1])
+        concatSolsets(h5parmsFrom, h5parmToFile, solsetTo, options.axis, options.ncpu)
+        logging.info("Done.")
+        sys.exit(0)
+
     h5parmFrom = args[0]
     h5parmTo = args[1]
 
@@ -23,7 +23,7 @@ class h5parm( object ):
         h5parmFile -- H5parm filename
         readonly -- if True the table is open in readonly mode (default=True)
         complevel -- compression level from 0 to 9 (default=5) when creating the file
-        complib -- library for compression: lzo, zlib, bzip2 (default=zlib)
+        complib -- library for compression: lzo, zlib, bzip2, blosc (default=zlib)
         """
         if os.path.isfile(h5parmFile):
             if not tables.is_hdf5_file(h5parmFile):
@@ -149,7 +149,7 @@ class h5parm( object ):
 
     def makeSoltab(self, solset=None, soltype=None, soltab=None,
             axesNames = [], axesVals = [], chunkShape=None, vals=None,
-            weights=None, parmdbType=None):
+            weights=None, parmdbType=None, accessAxes=None, fillVal=np.nan):
         """
         Create a solution-table into a specified solution-set
         Keyword arguments:
@@ -158,10 +158,12 @@ class h5parm( object ):
         soltab -- the solution-table name (String) if not specified is generated from the solution-type
         axesNames -- list with the axes names
         axesVals -- list with the axes values
-        chunkShape -- list with the chunk shape
-        vals --
-        weights -- 0->FLAGGED, 1->MAX_WEIGHT
+        chunkShape -- list with the chunk shape (default: planned from accessAxes, see _planChunkShape())
+        vals -- values, if None an empty table is created to be filled later (e.g. with solWriter)
+        weights -- 0->FLAGGED, 1->MAX_WEIGHT, if None the table is created fully flagged
         parmdbType -- original parmdb solution type
+        accessAxes -- axes which are usually read together, i.e. the returnAxes of getValuesIter() (default: freq and time)
+        fillVal -- value of the empty table if vals is None
         """
 
         if soltype is None:
@@ -198,40 +200,129 @@ class h5parm( object ):
         assert len(axesNames) == len(axesVals)
         dim = []
 
-#        newChunkShape = []
         for i, axisName in enumerate(axesNames):
-            #axis = self.H.create_carray('/'+solsetName+'/'+soltabName, axisName,\
-            #        obj=axesVals[i], chunkshape=[len(axesVals[i])])
             axis = self.H.create_array('/'+solsetName+'/'+soltabName, axisName, obj=axesVals[i])
             dim.append(len(axesVals[i]))
 
-#            # Put time/freq on max lenght for better performances
-#            if chunkShape == None:
-#                if axisName == 'time':
-#                    newChunkShape.append(100)
-#                elif axisName == 'freq':
-#                    newChunkShape.append(10)
-#                else:
-#                    newChunkShape.append(1)
-#        if chunkShape == None: chunkShape = newChunkShape
-#        logging.debug('Chunk shape: '+str(chunkShape))
-
         # check if the axes were in the proper order
-        assert dim == list(vals.shape)
-        assert dim == list(weights.shape)
-
-        # create the val/weight Carrays
-        #val = self.H.create_carray('/'+solsetName+'/'+soltabName, 'val', obj=vals.astype(np.float64), chunkshape=None, atom=tables.Float64Atom())
-        #weight = self.H.create_carray('/'+solsetName+'/'+soltabName, 'weight', obj=weights.astype(np.float16), chunkshape=None, atom=tables.Float16Atom())
-        # array do not have compression but are much faster
-        val = self.H.create_array('/'+solsetName+'/'+soltabName, 'val', obj=vals.astype(np.float64), atom=tables.Float64Atom())
-        weight = self.H.create_array('/'+solsetName+'/'+soltabName, 'weight', obj=weights.astype(np.float16), atom=tables.Float16Atom())
+        if vals is not None: assert dim == list(vals.shape)
+        if weights is not None: assert dim == list(weights.shape)
+
+        if chunkShape is None:
+            chunkShape = self._planChunkShape(axesNames, dim, accessAxes)
+        else:
+            accessAxes = []
+        assert len(chunkShape) == len(dim)
+        self._setChunkAxes(soltab, accessAxes)
+        logging.info('--Chunk shape: '+str(chunkShape)+' (access axes: '+soltab._v_attrs['chunk_axes']+').')
+
+        # create the val/weight CArrays, chunked and compressed with the file filters
+        # (values are not copied if already of the right type, unwritten chunks are set to the atom default)
+        if vals is not None: vals = vals.astype(np.float64, copy=False)
+        if weights is not None: weights = weights.astype(np.float16, copy=False)
+        val = self.H.create_carray('/'+solsetName+'/'+soltabName, 'val', obj=vals, shape=tuple(dim), \
+                chunkshape=chunkShape, atom=tables.Float64Atom(dflt=fillVal), filters=self.H.filters)
+        weight = self.H.create_carray('/'+solsetName+'/'+soltabName, 'weight', obj=weights, shape=tuple(dim), \
+                chunkshape=chunkShape, atom=tables.Float16Atom(dflt=0), filters=self.H.filters)
         val.attrs['AXES'] = ','.join([axisName for axisName in axesNames])
         weight.attrs['AXES'] = ','.join([axisName for axisName in axesNames])
 
         return soltab
 
 
+    def _planChunkShape(self, axesNames, dim, accessAxes=None, chunkLen=2**15):
+        """
+        Return a chunk shape suited for reading the table along accessAxes.
+        The access axes are kept as long as possible inside a chunk (halving the
+        longest one while the chunk is larger than chunkLen elements), the other axes
+        are one element wide, then the iterated axes are extended starting from the
+        fastest varying one (last in the table order) to fill the chunk, so that
+        consecutive iterations of getValuesIter() read the same chunks.
+        Keyword arguments:
+        axesNames -- list with the axes names
+        dim -- list with the axes lengths
+        accessAxes -- axes read together e.g. ['time'] to iterate over everything else (default: freq and time)
+        chunkLen -- maximum number of elements in a chunk
+        """
+        if accessAxes is None: accessAxes = ['freq','time']
+        if type(accessAxes) is str: accessAxes = [accessAxes]
+
+        chunkShape = [max(1, axisLen) if axisName in accessAxes else 1 for axisName, axisLen in zip(axesNames, dim)]
+        while np.prod(chunkShape) > chunkLen:
+            i = np.argmax(chunkShape)
+            chunkShape[i] = int(np.ceil(chunkShape[i]/2.))
+
+        for i in reversed(xrange(len(dim))):
+            if axesNames[i] in accessAxes: continue
+            grow = chunkLen // int(np.prod(chunkShape))
+            if grow <= 1: break
+            chunkShape[i] = max(1, min(dim[i], grow))
+
+        return chunkShape
+
+
+    def _setChunkAxes(self, soltab, accessAxes):
+        """
+        Store the access axes used to plan the chunk shape in the soltab attributes
+        Keyword arguments:
+        soltab -- a solution-table as Group instance
+        accessAxes -- list of axes (or None for the planner default)
+        """
+        if accessAxes is None: accessAxes = ['freq','time']
+        if type(accessAxes) is str: accessAxes = [accessAxes]
+        soltab._v_attrs['chunk_axes'] = ','.join(accessAxes)
+
+
+    def rechunkSoltab(self, solset=None, soltab=None, accessAxes=None, chunkShape=None):
+        """
+        Rewrite the val/weight arrays of a solution-table with a new chunk shape,
+        e.g. to switch a table flagged along time to a layout suited to plot per antenna.
+        Data are copied block by block, never loading the whole table in memory.
+        Keyword arguments:
+        solset -- a solution-set name (String) or instance (required if soltab is a string)
+        soltab -- a solution-table name (String) or instance
+        accessAxes -- axes which are read together, see _planChunkShape()
+        chunkShape -- list with the chunk shape (default: planned from accessAxes)
+        """
+        if soltab is None:
+            raise Exception("Solution-table not specified while rechunking a solution-table.")
+        if type(soltab) is str:
+            soltab = self.getSoltab(solset, soltab)
+
+        axesNames = soltab.val.attrs['AXES'].split(',')
+        dim = list(soltab.val.shape)
+        if chunkShape is None:
+            chunkShape = self._planChunkShape(axesNames, dim, accessAxes)
+        else:
+            accessAxes = []
+        assert len(chunkShape) == len(dim)
+        logging.info('Rechunking soltab '+soltab._v_name+' with chunk shape: '+str(chunkShape)+'.')
+
+        # copy whole chunks at a time, extending the block along the last axes while it fits in the buffer
+        bufLen = 2**22
+        blockShape = list(chunkShape)
+        for i in reversed(xrange(len(dim))):
+            blockShape[i] = max(1, dim[i])
+            if np.prod(blockShape) > bufLen:
+                otherLen = int(np.prod(blockShape[:i]+blockShape[i+1:]))
+                blockShape[i] = max(chunkShape[i], (bufLen // otherLen) // chunkShape[i] * chunkShape[i])
+                break
+
+        for name in ['val', 'weight']:
+            leaf = soltab._f_get_child(name)
+            newLeaf = self.H.create_carray(soltab, name+'_rechunk', atom=leaf.atom, shape=leaf.shape, \
+                    chunkshape=chunkShape, filters=self.H.filters)
+            for blockIdx in np.ndindex(*[int(np.ceil(d/float(b))) for d, b in zip(dim, blockShape)]):
+                block = tuple([slice(i*b, (i+1)*b) for i, b in zip(blockIdx, blockShape)])
+                newLeaf[block] = leaf[block]
+            leaf.attrs._f_copy(newLeaf)
+            leaf._f_remove()
+            newLeaf._f_rename(name)
+
+        self._setChunkAxes(soltab, accessAxes)
+        return soltab
+
+
     def delSoltab(self, solset=None, soltab=None):
         """
         Delete a solution-table of a specific solution-set
@@ -486,11 +577,13 @@ class solHandler( object ):
     axisName = {max: yyy} # to selct values lower or equal than yyy
     axisName = {min: xxx, max: yyy} # to selct values greater or equal than xxx and lower or equal than yyy
     """
-    def __init__(self, table, useCache = False, **args):
+    def __init__(self, table, useCache = False, maxMemory = None, **args):
         """
         Keyword arguments:
         table -- table object or solset/soltab string
         useCache -- cache all data in memory
+        maxMemory -- memory budget in MB, tables larger than this are not cached
+        but streamed from/to the disk in blocks (default: no limit)
         **args -- used to create a selection
         """
 
@@ -509,7 +602,12 @@ class solHandler( object ):
         self.selection = {}
         self.setSelection(**args)
 
+        self.maxMemory = maxMemory
         self.useCache = useCache
+        if self.useCache and self.maxMemory is not None and \
+                self.t.val.size_in_memory + self.t.weight.size_in_memory > self.maxMemory*1024**2:
+            logging.info("Table larger than the memory budget (%i MB), streaming from disk." % self.maxMemory)
+            self.useCache = False
         if self.useCache:
             logging.debug("Caching...")
             self.cacheWeight = np.copy(self.t.weight)
@@ -601,6 +699,118 @@ class solHandler( object ):
                 self.selection[idx] = slice(None)
 
 
+    def _getSelectionShape(self, selection=None):
+        """
+        Return the shape of the array selected by the current selection
+        Keyword arguments:
+        selection -- use this selection instead of the current one
+        """
+        if selection is None: selection = self.selection
+        shape = []
+        for axisName, sel in zip(self.getAxesNames(), selection):
+            if type(sel) is list: shape.append(len(sel))
+            else: shape.append(len(xrange(*sel.indices(len(self.getAxis(axisName))))))
+        return tuple(shape)
+
+
+    def _getSelectionIndexes(self, selection=None):
+        """
+        Return the current selection as a list of index arrays (one per axis), to be used with np.ix_()
+        Keyword arguments:
+        selection -- use this selection instead of the current one
+        """
+        if selection is None: selection = self.selection
+        indexes = []
+        for axisName, sel in zip(self.getAxesNames(), selection):
+            if type(sel) is list: indexes.append(np.array(sel, dtype=int))
+            else: indexes.append(np.arange(*sel.indices(len(self.getAxis(axisName)))))
+        return indexes
+
+
+    def _planSelection(self):
+        """
+        Split a selection with several lists (pytables accepts only one list per
+        indexing) into a small number of hyperslabs. Along every axis selected
+        with a list, the indexes are grouped into runs which are read as slices:
+        adjacent indexes are always merged, gaps are merged as long as at most
+        half of the run is over-read. Slices are kept as they are.
+        Return: a list of (hyperslab, localIdx, selIdx) where hyperslab is a tuple of slices
+        to apply to the table, localIdx and selIdx are lists of index arrays (for np.ix_())
+        which move the data between the hyperslab and the selected array
+        """
+        runsPerAxis = []
+        for axisName, sel in zip(self.getAxesNames(), self.selection):
+            if type(sel) is list:
+                order = np.argsort(sel, kind='mergesort')
+                idx = np.array(sel, dtype=int)[order]
+                runs = []
+                start = 0
+                for i in xrange(1, len(idx)+1):
+                    if i == len(idx) or idx[i]-idx[start]+1 > 2*(i-start+1):
+                        runs.append( (slice(idx[start], idx[i-1]+1), idx[start:i]-idx[start], order[start:i]) )
+                        start = i
+                runsPerAxis.append(runs)
+            else:
+                selLen = len(xrange(*sel.indices(len(self.getAxis(axisName)))))
+                runsPerAxis.append( [(sel, np.arange(selLen), np.arange(selLen))] )
+
+        return [ (tuple([run[0] for run in runs]), [run[1] for run in runs], [run[2] for run in runs]) \
+                    for runs in itertools.product(*runsPerAxis) ]
+
+
+    def _readSelection(self, dataVals):
+        """
+        Return the values of the current selection
+        Keyword arguments:
+        dataVals -- a table array (val/weight) or its cached copy
+        """
+        # NOTE: pytables has a nasty limitation that only one list can be applied when selecting.
+        # Conversely, one can apply how many slices he wants.
+        # Single values/contigous values are converted in slices in h5parm.
+        if len([sel for sel in self.selection if type(sel) is list]) <= 1:
+            return dataVals[tuple(self.selection)]
+        elif isinstance(dataVals, np.ndarray):
+            return dataVals[np.ix_(*self._getSelectionIndexes())]
+
+        logging.debug('Optimizing selection reading '+str(self.selection))
+        vals = np.empty(self._getSelectionShape(), dtype=dataVals.dtype)
+        for hyperslab, localIdx, selIdx in self._planSelection():
+            vals[np.ix_(*selIdx)] = dataVals[hyperslab][np.ix_(*localIdx)]
+        return vals
+
+
+    def _writeSelection(self, dataVals, vals):
+        """
+        Write values in the current selection
+        Keyword arguments:
+        dataVals -- a table array (val/weight) or its cached copy
+        vals -- an array with the selection shape (or a float to set all values)
+        """
+        # the float check allows quick reset of large arrays to a single value
+        isScalar = isinstance(vals, (np.floating, float))
+        # the reshape is needed when saving e.g. [512] (vals shape) into [512,1,1] (selection output)
+        if not isScalar: vals = np.reshape(vals, self._getSelectionShape())
+
+        if len([sel for sel in self.selection if type(sel) is list]) <= 1:
+            dataVals[tuple(self.selection)] = vals
+            return
+        elif isinstance(dataVals, np.ndarray):
+            dataVals[np.ix_(*self._getSelectionIndexes())] = vals
+            return
+
+        logging.debug('Optimizing selection writing '+str(self.selection))
+        for hyperslab, localIdx, selIdx in self._planSelection():
+            if isScalar: block = vals
+            else: block = vals[np.ix_(*selIdx)]
+            # runs without gaps are written directly, the others need a read-modify-write
+            if all([len(idx) == 0 or idx[-1]+1 == len(idx) for idx in localIdx]):
+                dataVals[hyperslab] = block
+            else:
+                hyperslabVals = dataVals[hyperslab]
+                hyperslabVals[np.ix_(*localIdx)] = block
+                dataVals[hyperslab] = hyperslabVals
+
+
     def getType(self):
         """
         return the type of the solution-tables (it is stored in an attrs)
@@ -719,12 +929,19 @@ class solHandler( object ):
 
 class solWriter(solHandler):
 
-    def __init__(self, table, useCache = False, **args):
+    # bytes of values kept by bufferValues() when there is no memory budget
+    maxBuffer = 2**26
+
+    def __init__(self, table, useCache = False, maxMemory = None, **args):
         """
         useCache -- write the data on a local copy of the table,
         use flush() to write them on the disk, speeds up writing
+        maxMemory -- memory budget in MB, values stored with bufferValues()
+        are written as soon as they exceed half of it (default: no limit)
         """
-        solHandler.__init__(self, table=table, useCache=useCache, **args)
+        solHandler.__init__(self, table=table, useCache=useCache, maxMemory=maxMemory, **args)
+        self.buffer = {False: [], True: []}
+        self.bufferSize = 0
 
     def setAxisValues(self, axis=None, vals=None):
         """
@@ -755,37 +972,118 @@ class solWriter(solHandler):
             if weight: dataVals = self.t.weight
             else: dataVals = self.t.val
 
-        # NOTE: pytables has a nasty limitation that only one list can be applied when selecting.
-        # Conversely, one can apply how many slices he wants.
-        # Single values/contigous values are converted in slices in h5parm.
-        # This try/except implements a workaround for this limitation. Once the pytables will be updated, the except can be removed.
-        try:
-            # the float check allows quick reset of large arrays to a single value
-            if isinstance(vals, (np.floating, float)): dataVals[tuple(self.selection)] = vals
-            # the reshape is needed when saving e.g. [512] (vals shape) into [512,1,1] (selection output)
-            else: dataVals[tuple(self.selection)] = np.reshape(vals, dataVals[tuple(self.selection)].shape)
-        except:
-            logging.debug('Optimizing selection writing '+str(self.selection))
-            selectionListsIdx = [i for i, s in enumerate(self.selection) if type(s) is list]
-            subSelection = self.selection[:]
-            # create a subSelection also for the "vals" array
-            subSelectionForVals = [slice(None) for i in xrange(len(subSelection))]
-            # cycle across lists and save data index by index
-            for selectionListValsIter in itertools.product(*[self.selection[selectionListIdx] for selectionListIdx in selectionListsIdx[1:]]):
-                for i, selectionListIdx in enumerate(selectionListsIdx[1:]):
-                    # this is the sub selection which has a slice for every slice and a single value for every list
-                    subSelection[selectionListIdx] = selectionListValsIter[i]
-                    subSelectionForVals[selectionListIdx] = i
-                if type(vals) == float: dataVals[tuple(subSelection)] = vals
-                else: dataVals[tuple(subSelection)] = vals[tuple(subSelectionForVals)]
+        self._writeSelection(dataVals, vals)
+
+    def setValuesBatch(self, vals, selections=None, weight=False):
+        """
+        Save many values at once, e.g. all the matrices produced by getValuesIter().
+        Selections which differ only on the axes selected with a single index (the
+        iterated axes of getValuesIter()) share the same layout and are written with one
+        vectorized assignment (on the file: one read and one write of their bounding box).
+        Selections are assumed not to overlap.
+        Keyword arguments:
+        vals -- a stack of values (first axis runs along selections) or,
+        if selections is None, an iterable of (vals, selection) pairs
+        selections -- list of selections, one per element of the vals stack
+        weight -- if true store in the weights instead that in the vals (default: False)
+        """
+        if self.useCache:
+            if weight: dataVals = self.cacheWeight
+            else: dataVals = self.cacheVal
+        else:
+            if weight: dataVals = self.t.weight
+            else: dataVals = self.t.val
+
+        if selections is None: items = vals
+        else: items = itertools.izip(vals, selections)
+
+        # group the selections by layout, a single index axis is marked with None
+        layouts = {}
+        for v, sel in items:
+            layout = tuple([None if type(s) is list and len(s) == 1 else \
+                    (tuple(s) if type(s) is list else (s.start, s.stop, s.step)) for s in sel])
+            if not layout in layouts: layouts[layout] = (sel, [], [])
+            layouts[layout][1].append([s[0] for s in sel if type(s) is list and len(s) == 1])
+            layouts[layout][2].append(v)
+
+        for layout, (sel, varIdx, layoutVals) in layouts.iteritems():
+            varPos = [j for j, l in enumerate(layout) if l is None]
+            fixPos = [j for j, l in enumerate(layout) if not l is None]
+            selIdx = self._getSelectionIndexes(sel)
+            fixShape = [len(selIdx[j]) for j in fixPos]
+            nSel = len(layoutVals)
+
+            block = np.empty([nSel]+fixShape, dtype=dataVals.dtype)
+            for i, v in enumerate(layoutVals):
+                # the float check allows quick reset to a single value
+                if isinstance(v, (np.floating, float)): block[i] = v
+                else: block[i] = np.reshape(v, fixShape)
+
+            # broadcastable index arrays with shape (nSel, fixShape...)
+            varIdx = np.array(varIdx, dtype=int).reshape(nSel, len(varPos))
+            index = [None]*len(layout)
+            for k, j in enumerate(varPos): index[j] = varIdx[:,k].reshape([nSel]+[1]*len(fixPos))
+            for k, j in enumerate(fixPos): index[j] = selIdx[j].reshape([1]+[1]*k+[-1]+[1]*(len(fixPos)-k-1))
+
+            if isinstance(dataVals, np.ndarray):
+                dataVals[tuple(index)] = block
+                continue
+
+            # on the file: read-modify-write the bounding box, unless it is mostly made of unselected data
+            boxStart = [int(np.min(idx)) for idx in index]
+            boxShape = [int(np.max(idx))+1-start for idx, start in zip(index, boxStart)]
+            if np.prod(boxShape) > 2*block.size:
+                logging.debug('Sparse batch of selections, writing one at a time.')
+                selectionStored = self.selection
+                for i, v in enumerate(layoutVals):
+                    self.selection = list(sel)
+                    for k, j in enumerate(varPos): self.selection[j] = [varIdx[i,k]]
+                    self._writeSelection(dataVals, v)
+                self.selection = selectionStored
+                continue
+
+            box = tuple([slice(start, start+l) for start, l in zip(boxStart, boxShape)])
+            boxVals = dataVals[box]
+            boxVals[tuple([idx-start for idx, start in zip(index, boxStart)])] = block
+            dataVals[box] = boxVals
+
+
+    def bufferValues(self, vals, selection, weight=False):
+        """
+        Store values to be written with setValuesBatch(), the buffer is written
+        when it exceeds half of the memory budget (or maxBuffer if there is no
+        budget) or by flush()
+        Keyword arguments:
+        vals -- values to write as an n-dimentional array which match the selection dimention
+        selection -- the selection where to write, as returned by getValuesIter()
+        weight -- if true store in the weights instead that in the vals (default: False)
+        """
+        self.buffer[weight].append((vals, selection))
+        self.bufferSize += np.size(vals) * 8
+        if self.maxMemory is not None: maxBuffer = self.maxMemory*1024**2/2
+        else: maxBuffer = self.maxBuffer
+        if self.bufferSize > maxBuffer:
+            self._writeBuffer()
+
+
+    def _writeBuffer(self):
+        """
+        Write the values stored with bufferValues()
+        """
+        for weight in [False, True]:
+            if self.buffer[weight] != []:
+                self.setValuesBatch(self.buffer[weight], weight=weight)
+                self.buffer[weight] = []
+        self.bufferSize = 0
+
 
     def flush(self):
         """
-        Copy cached values into the table
+        Write buffered values and copy cached values into the table
+        (without cache the other values are already on the disk)
         """
-        if not self.useCache:
-            logging.error("Flushing non cached data.")
-            sys.exit(1)
+        self._writeBuffer()
+        if not self.useCache: return
         logging.info("Writing results...")
         self.t.weight[:] = self.cacheWeight
         self.t.val[:] = self.cacheVal
@@ -793,8 +1091,8 @@ class solWriter(solHandler):
 
 class solFetcher(solHandler):
 
-    def __init__(self, table, useCache = False, **args):
-        solHandler.__init__(self, table = table, useCache = useCache, **args)
+    def __init__(self, table, useCache = False, maxMemory = None, **args):
+        solHandler.__init__(self, table = table, useCache = useCache, maxMemory = maxMemory, **args)
 
     def __getattr__(self, axis):
         """
@@ -838,27 +1136,7 @@ class solFetcher(solHandler):
             else: dataVals = self.t.val
 
         # apply the self.selection
-        # NOTE: pytables has a nasty limitation that only one list can be applied when selecting.
-        # Conversely, one can apply how many slices he wants.
-        # Single values/contigous values are converted in slices in h5parm.
-        # This try/except implements a workaround for this limitation. Once the pytables will be updated, the except can be removed.
-        try:
-            dataVals = dataVals[tuple(self.selection)]
-        except:
-            logging.debug('Optimizing selection reading '+str(self.selection))
-            # for performances is important to minimize the fetched data
-            # convert all lists other then the first (pytables allowes one!) to slices
-            selectionListsIdx = [i for i, s in enumerate(self.selection) if type(s) is list]
-            firstSelection = self.selection[:]
-            for i in selectionListsIdx[1:]:
-                firstSelection[i] = slice(None)
-            # create a second selection using np.ix_
-            secondSelection = []
-            for i, sel in enumerate(self.selection):
-                if i == selectionListsIdx[0]: secondSelection.append(xrange(self.getAxisLen(self.getAxesNames()[i], ignoreSelection=False)))
-                elif type(sel) is list: secondSelection.append(sel)
-                elif type(sel) is slice: secondSelection.append(xrange(self.getAxisLen(self.getAxesNames()[i], ignoreSelection=False)))
-            dataVals = dataVals[tuple(firstSelection)][np.ix_(*secondSelection)]
+        dataVals = self._readSelection(dataVals)
 
         if reference is not None:
             # TODO: flag when reference is flagged?
@@ -869,7 +1147,8 @@ class solFetcher(solHandler):
             elif not reference in self.getAxisValues('ant', ignoreSelection = True):
                 logging.error('Cannot find antenna '+reference+'. Ignore referencing.')
             else:
-                selection_stored = np.copy(self.selection)
+                selection_stored = self.selection
+                self.selection = list(self.selection)
                 antAxis = self.getAxesNames().index('ant')
                 self.selection[antAxis] = [list(self.getAxisValues('ant', ignoreSelection=True)).index(reference)]
                 dataValsRef = self.getValues(retAxesVals=False, reference=None)
@@ -892,59 +1171,121 @@ class solFetcher(solHandler):
         return dataVals, axisVals
 
 
-    def getValuesIter(self, returnAxes=[], weight=False, reference=None):
+    def getValuesIter(self, returnAxes=[], weight=False, reference=None, batchSize=None):
         """
         Return an iterator which yields the values matrix (with axes = returnAxes) iterating along the other axes.
         E.g. if returnAxes are ['freq','time'], one gets a interetion over all the possible NxM
         matrix where N are the freq and M the time dimensions. The other axes are iterated in the getAxesNames() order.
         Note that all the data are fetched in memory before returning them one at a time. This is quick.
+        If a memory budget is set (maxMemory), data are instead fetched in blocks of iterations
+        which use at most half of it.
+        The returned matrices are views of the fetched data (no copy) and the axes values/indexes
+        of the iterated axes are computed only once.
         Keyword arguments:
         returnAxes -- axes of the returned array, all others will be cycled
 
         weight -- if true return also the weights (default: False)
+        batchSize -- if given, yield stacks of (up to) batchSize matrices at a time, see Return
         Return:
         1) data ndarray of dim=dim(returnAxes) and with the axes ordered as in getAxesNames()
         2) (if weight == True) weigth ndarray of dim=dim(returnAxes) and with the axes ordered as in getAxesNames()
         3) a dict with axis values in the form:
         {'axisname1':[axisvals1],'axisname2':[axisvals2],...}
         4) a selection which should be used to write this data back using a solWriter
-        """
-        if weight: weigthVals = self.getValues(retAxesVals=False, weight=True, reference=None)
-        dataVals = self.getValues(retAxesVals=False, weight=False, reference=reference)
+        If batchSize is given 1) and 2) have an extra first axis of len <= batchSize
+        and 3) and 4) are lists with one element per matrix of the stack.
+        """
+        axesNames = self.getAxesNames()
+        iterAxesPos = [j for j, axisName in enumerate(axesNames) if not axisName in returnAxes]
+        returnAxesPos = [j for j, axisName in enumerate(axesNames) if axisName in returnAxes]
+
+        # index maps computed once: values and absolute indexes of the iterated axes
+        selectionIndexes = self._getSelectionIndexes()
+        iterAxesVals = [self.getAxisValues(axesNames[j]) for j in iterAxesPos]
+        iterAxesIdx = [selectionIndexes[j].tolist() for j in iterAxesPos]
+        returnAxesVals = dict([(axesNames[j], self.getAxisValues(axesNames[j])) for j in returnAxesPos])
+        iterAxesDim = [len(idx) for idx in iterAxesIdx]
+        returnAxesDim = [len(selectionIndexes[j]) for j in returnAxesPos]
+
+        # number of iterations fetched at once along each iterated axis: the inner axes are fetched whole,
+        # the first one which does not fit in the memory budget is fetched in parts, the outer ones one index at a time
+        # (so that the iterations are still yielded in the getAxesNames() order)
+        blockShape = list(iterAxesDim)
+        if self.maxMemory is not None:
+            iterBytes = int(np.prod(returnAxesDim)) * (self.t.val.dtype.itemsize + weight*self.t.weight.dtype.itemsize)
+            nIter = max(1, int(self.maxMemory*1024**2/2) // max(1, iterBytes))
+            blockShape = [1]*len(iterAxesDim)
+            for i in reversed(xrange(len(iterAxesDim))):
+                if iterAxesDim[i] > nIter:
+                    blockShape[i] = nIter
+                    break
+                blockShape[i] = max(1, iterAxesDim[i])
+                nIter //= max(1, iterAxesDim[i])
+            logging.debug('Fetching data in blocks of '+str(blockShape)+' iterations.')
 
-        # get dimensions of non-returned axis (in correct order)
-        iterAxesDim = [self.getAxisLen(axis) for axis in self.getAxesNames() if not axis in returnAxes]
+        def getCoordSelection(axisIdx):
+            """
+            Return axes values and writing selection of a combination of iterated axes
+            """
+            thisAxesVals = {}
+            returnSelection = list(self.selection)
+            for i, j in enumerate(iterAxesPos):
+                #TODO: the iteration axes are not into a 1 element array, is it a problem?
+                thisAxesVals[axesNames[j]] = iterAxesVals[i][axisIdx[i]]
+                returnSelection[j] = [iterAxesIdx[i][axisIdx[i]]]
+            for axisName, axisVals in returnAxesVals.iteritems():
+                # operations are allowed to modify the coordinates in place
+                thisAxesVals[axisName] = axisVals.copy()
+            return thisAxesVals, returnSelection
+
+        def getBlocks():
+            """
+            Fetch the data one block at a time, yield the block start and the data with the
+            iterated axes in front (a view: indexing with the iteration index returns a view)
+            """
+            for blockIdx in np.ndindex(*[int(np.ceil(d/float(b))) for d, b in zip(iterAxesDim, blockShape)]):
+                blockStart = [i*b for i, b in zip(blockIdx, blockShape)]
+                selectionStored = self.selection
+                if blockShape != iterAxesDim:
+                    self.selection = list(self.selection)
+                    for i, j in enumerate(iterAxesPos):
+                        idx = selectionIndexes[j][blockStart[i]:blockStart[i]+blockShape[i]]
+                        # contiguous indexes are fetched as a slice
+                        if np.all(np.diff(idx) == 1): self.selection[j] = slice(idx[0], idx[-1]+1)
+                        else: self.selection[j] = idx.tolist()
+                if weight: weigthVals = self.getValues(retAxesVals=False, weight=True, reference=None)
+                else: weigthVals = None
+                dataVals = self.getValues(retAxesVals=False, weight=False, reference=reference)
+                self.selection = selectionStored
+
+                dataVals = np.transpose(dataVals, iterAxesPos+returnAxesPos)
+                if weight: weigthVals = np.transpose(weigthVals, iterAxesPos+returnAxesPos)
+                yield blockStart, dataVals, weigthVals
 
         # generator to cycle over all the combinations of iterAxes
-        # it "simply" gets the indexes of this particular combination of iterAxes
-        # and use them to refine the selection.
         def g():
-            for axisIdx in np.ndindex(tuple(iterAxesDim)):
-                refSelection = []
-                returnSelection = []
-                thisAxesVals = {}
-                i = 0
-                for j, axisName in enumerate(self.getAxesNames()):
-                    if axisName in returnAxes:
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)
-                        # add a slice with all possible values (main selection will be preapplied)
-                        refSelection.append(slice(0,self.getAxisLen(axisName), None))
-                        # for the return selection use the "main" selection for the return axes
-                        returnSelection.append(self.selection[j])
+            for blockStart, dataVals, weigthVals in getBlocks():
+                for blockAxisIdx in np.ndindex(dataVals.shape[:len(iterAxesPos)]):
+                    thisAxesVals, returnSelection = getCoordSelection([i+s for i, s in zip(blockAxisIdx, blockStart)])
+                    if weight:
+                        yield (dataVals[blockAxisIdx], weigthVals[blockAxisIdx], thisAxesVals, returnSelection)
                     else:
-                        #TODO: the iteration axes are not into a 1 element array, is it a problem?
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)[axisIdx[i]]
-                        # add this index to the refined selection, this will return a single value for this axis
-                        refSelection.append(axisIdx[i])
-                        # for the return selection use the complete axis and find the correct index
-                        returnSelection.append( list(np.where( self.getAxisValues(axisName, ignoreSelection=True) == thisAxesVals[axisName] )[0]) )
-                        i += 1
-                # costly command
-                data = dataVals[tuple(refSelection)]
-                if weight:
-                    weights = weigthVals[tuple(refSelection)]
-                    yield (data, weights, thisAxesVals, returnSelection)
-                else:
-                    yield (data, thisAxesVals, returnSelection)
+                        yield (dataVals[blockAxisIdx], thisAxesVals, returnSelection)
+
+        # generator to cycle over stacks of batchSize combinations of iterAxes
+        def gBatch():
+            for blockStart, dataVals, weigthVals in getBlocks():
+                blockIterDim = dataVals.shape[:len(iterAxesPos)]
+                # a view if the iterated axes were already the first ones
+                dataStack = np.reshape(dataVals, [int(np.prod(blockIterDim))]+returnAxesDim)
+                if weight: weigthStack = np.reshape(weigthVals, [int(np.prod(blockIterDim))]+returnAxesDim)
+                allAxisIdx = [[i+s for i, s in zip(blockAxisIdx, blockStart)] for blockAxisIdx in np.ndindex(blockIterDim)]
+                for start in xrange(0, len(allAxisIdx), batchSize):
+                    coords, selections = zip(*[getCoordSelection(axisIdx) for axisIdx in allAxisIdx[start:start+batchSize]])
+                    if weight:
+                        yield (dataStack[start:start+batchSize], weigthStack[start:start+batchSize], list(coords), list(selections))
+                    else:
+                        yield (dataStack[start:start+batchSize], list(coords), list(selections))
 
-        return g()
+        if batchSize is None: return g()
+        else: return gBatch()
@@ -12,7 +12,7 @@ It handles Gain/DirectionalGain/RotationAngle/
            Clock/TEC/CommonRotationAngle/CommonScalarPhase/CommonScalarAmpitude solution types.
 """
 
-import sys, os
+import sys, os, shutil, tempfile, cPickle
 import socket
 import numpy as np
 import logging
@@ -22,6 +22,7 @@ from losoto import _version
 from losoto import _logging
 from losoto.h5parm import solWriter
 from losoto.h5parm import h5parm as h5parm_mod
+from losoto.operations_lib import multiprocManager
 try:
     import progressbar
 except ImportError:
@@ -116,8 +117,80 @@ def parmdbToAxes(solEntry):
     return pol, dir, ant, parm
 
 
+def _readParmdb(instrumentdbFile, solTypes, spillDir, outQueue=None):
+    """
+    Read all the solution types of an instrument table in one pass.
+    The entries of each solution type are stored in a temporary file as a list of
+    [pol, dir, ant, freqs, times, values], Real and Imag values are converted in
+    Amp and Phase respectively.
+    Input:
+       instrumentdbFile - file name of the instrument table.
+       solTypes - list of the solution types to read (e.g. "*Gain:*:Real").
+       spillDir - directory of the temporary files.
+    Output:
+       the file name and a dict with, for each solution type, None if there are
+       no entries or the sets of the axes values ('pol', 'dir', 'ant', 'freq',
+       'time'), the set of the original parmdb types ('ptype') and the name of
+       the temporary file ('file').
+    """
+    pdb = lofar.parmdb.parmdb(instrumentdbFile)
+
+    # every grid is read only once (Real/Imag need each other)
+    grids = {}
+    def getGrid(solType):
+        if not solType in grids:
+            grids[solType] = pdb.getValuesGrid(solType+':*')
+        return grids[solType]
+
+    solAxes = {}
+    for solType in solTypes:
+
+        data = getGrid(solType)
+        if 'Real' in solType: dataIm = getGrid(solType.replace('Real','Imag'))
+        if 'Imag' in solType: dataRe = getGrid(solType.replace('Imag','Real'))
+
+        if len(data) == 0:
+            solAxes[solType] = None
+            continue
+
+        axes = {'pol':set(), 'dir':set(), 'ant':set(), 'freq':set(), 'time':set(), 'ptype':set()}
+        entries = []
+        for solEntry in data:
+
+            pol, dir, ant, parm = parmdbToAxes(solEntry)
+            val = data[solEntry]['values']
+
+            # convert Real and Imag in Amp and Phase respectively
+            if parm == 'Real':
+                solEntryIm = solEntry.replace('Real','Imag')
+                valI = dataIm[solEntryIm]['values']
+                val = np.sqrt((val**2)+(valI**2))
+            if parm == 'Imag':
+                solEntryRe = solEntry.replace('Imag','Real')
+                valR = dataRe[solEntryRe]['values']
+                val = np.arctan2(val, valR)
+
+            # create the axes grid, necessary if not all entries have the same axes lenght
+            if pol is not None: axes['pol'] |= set([pol])
+            if dir is not None: axes['dir'] |= set([dir])
+            if ant is not None: axes['ant'] |= set([ant])
+            axes['freq'] |= set(data[solEntry]['freqs'])
+            axes['time'] |= set(data[solEntry]['times'])
+            axes['ptype'] |= set([solEntry.split(':')[0]]) # original parmdb solution type
+
+            entries.append([pol, dir, ant, data[solEntry]['freqs'], data[solEntry]['times'], val])
+
+        fd, axes['file'] = tempfile.mkstemp(suffix='.pckl', dir=spillDir)
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(entries, f, -1)
+        solAxes[solType] = axes
+
+    if outQueue is not None: outQueue.put([instrumentdbFile, solAxes])
+    else: return [instrumentdbFile, solAxes]
+
+
 def create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
-                  h5parmFile, complevel, solsetName, globaldbFile=None, verbose=False):
+                  h5parmFile, complevel, solsetName, globaldbFile=None, verbose=False, ncpu=0):
     """
     Create the h5parm file.
     Input:
@@ -130,6 +203,8 @@ def create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
        solsetName - Name of the solution set. Usually "sol###".
        globaldbFile (optional) - Name of the globaldbFile. Used only for 
          logging purposes.
+       ncpu (optional) - number of instrument tables read in parallel, 0 means
+         all the CPUs.
     """
     
     # open/create the h5parm file and the solution-set
@@ -182,156 +257,145 @@ def create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
         solTypes.append('*ScalarAmplitude')
     solTypes = list(set(solTypes))
 
-    # every soltype creates a different solution-table
-    for solType in solTypes:
-
-        # skip missing solTypes (not all parmdbs have e.g. TEC)
-        if len(pdb.getNames(solType+':*')) == 0: continue
+    # skip missing solTypes (not all parmdbs have e.g. TEC)
+    solTypes = [solType for solType in solTypes if len(pdb.getNames(solType+':*')) != 0]
 
-        pols = set() 
-        dirs = set() 
-        ants = set()
-        freqs = set() 
-        times = set() 
-        ptype = set()
+    # every solType is written in a different solution-table:
+    # soltype, value of missing/flagged data
+    solTypesInfo = {'*RotationAngle':('rotation', 0.), '*RotationMeasure':('rotationmeasure', 0.), \
+            '*ScalarPhase':('scalarphase', 0.), '*ScalarAmplitude':('scalaramplitude', 0.), \
+            'Clock':('clock', 0.), 'TEC':('tec', 0.), \
+            '*Gain:*:Real':('amplitude', 1.), '*Gain:*:Ampl':('amplitude', 1.), \
+            '*Gain:*:Imag':('phase', 0.), '*Gain:*:Phase':('phase', 0.)}
+    for solType in solTypes:
+        if not solType in solTypesInfo:
+            logging.warning('Solution type '+solType+' not supported, ignoring.')
+    solTypes = [solType for solType in solTypes if solType in solTypesInfo]
+
+    # read every instrument table only once for all the solTypes, in parallel. The entries
+    # are kept in temporary files and the tables are then filled one instrument table at a time,
+    # so the memory usage is bounded by a single parmdb
+    logging.info('Reading instrument tables.')
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
+
+    spillDir = tempfile.mkdtemp(prefix='losoto_import_', dir=os.path.dirname(os.path.abspath(h5parmFile)))
+    try:
+
+        def jobs():
+            for instrumentdbFile in instrumentdbFiles:
+                yield [instrumentdbFile, solTypes, spillDir]
+
+        if ncpu > 1:
+            mpm = multiprocManager(ncpu, _readParmdb)
+            results = mpm.imap(jobs(), skipErrors=True)
+        else:
+            results = (_readParmdb(*job) for job in jobs())
 
-        logging.info('Reading '+solType+'.')
+        axes = dict([(solType, {'pol':set(), 'dir':set(), 'ant':set(), 'freq':set(), 'time':set(), 'ptype':set()}) for solType in solTypes])
+        spillFiles = dict([(solType, []) for solType in solTypes])
+        freqWidth = dict([(solType, np.inf) for solType in solTypes]) # min number of freqs of an instrument table
 
         pbar = progressbar.ProgressBar(maxval=len(instrumentdbFiles)).start()
         ipbar = 0
 
-        for instrumentdbFile in sorted(instrumentdbFiles):
+        for instrumentdbFile, solAxes in results:
 
-            pdb = lofar.parmdb.parmdb(instrumentdbFile)
-
-            # create the axes grid, necessary if not all entries have the same axes lenght
-            data = pdb.getValuesGrid(solType+':*')
+            for solType in solTypes:
 
-            # check good instrument table
-            if len(data) == 0:
-                logging.error('Instrument table %s is empty, ignoring.' % instrumentdbFile)
+                # check good instrument table
+                if solAxes[solType] is None:
+                    logging.error('Instrument table %s is empty, ignoring.' % instrumentdbFile)
+                    continue
 
-            for solEntry in data:
+                for axisName in axes[solType]:
+                    axes[solType][axisName] |= solAxes[solType][axisName]
+                spillFiles[solType].append(solAxes[solType]['file'])
+                freqWidth[solType] = min(freqWidth[solType], len(solAxes[solType]['freq']))
 
-                pol, dir, ant, parm = parmdbToAxes(solEntry)
-                if pol is not None: pols |= set([pol])
-                if dir is not None: dirs |= set([dir])
-                if ant is not None: ants |= set([ant])
-                freqs |= set(data[solEntry]['freqs'])
-                times |= set(data[solEntry]['times'])
-                pbar.update(ipbar)
             ipbar += 1
+            pbar.update(ipbar)
 
         pbar.finish()
 
-        pols = np.sort(list(pols)) 
-        dirs = np.sort(list(dirs)) 
-        ants = np.sort(list(ants)) 
-        freqs = np.sort(list(freqs)) 
-        times = np.sort(list(times))
-        shape = [i for i in (len(pols), len(dirs), len(ants), len(freqs), len(times)) if i != 0]
-        vals = np.empty(shape)
-        vals[:] = np.nan
-        weights = np.zeros(shape, dtype=np.float16)
-
-        logging.info('Filling table.')
-        pbar = progressbar.ProgressBar(maxval=len(instrumentdbFiles)).start()
-        ipbar = 0
-
-        for instrumentdbFile in instrumentdbFiles:
+        if ipbar != len(instrumentdbFiles):
+            logging.critical('Failed reading some instrument tables.')
+            sys.exit(1)
 
-            pdb = lofar.parmdb.parmdb(instrumentdbFile)
+        # every soltype creates a different solution-table
+        for solType in solTypes:
 
-            # fill the values
-            data = pdb.getValuesGrid(solType+':*')
-            if 'Real' in solType: dataIm = pdb.getValuesGrid(solType.replace('Real','Imag')+':*')
-            if 'Imag' in solType: dataRe = pdb.getValuesGrid(solType.replace('Imag','Real')+':*')
-            for solEntry in data:
+            soltype, flagVal = solTypesInfo[solType]
+            axesNames = [axisName for axisName in ['pol','dir','ant','freq','time'] if len(axes[solType][axisName]) != 0]
+            axesVals = [np.sort(list(axes[solType][axisName])) for axisName in axesNames]
+            freqs = axesVals[-2]
+            times = axesVals[-1]
 
-                pol, dir, ant, parm = parmdbToAxes(solEntry)
-                ptype |= set([solEntry.split(':')[0]]) # original parmdb solution type
+            # empty table, never written data are flagged
+            # chunks are not wider along freq than an instrument table, so that each
+            # chunk is written once, the table is rechunked for the operations when filled
+            chunkShape = h5parm._planChunkShape(axesNames, [len(axisVals) for axisVals in axesVals], \
+                    accessAxes=[axisName for axisName in axesNames if axisName != 'freq'])
+            chunkShape[-2] = min(chunkShape[-2], freqWidth[solType])
+            soltab = h5parm.makeSoltab(solset, soltype, axesNames=axesNames, axesVals=axesVals, chunkShape=chunkShape, \
+                    parmdbType=', '.join(list(axes[solType]['ptype'])), fillVal=flagVal)
 
-                freq = data[solEntry]['freqs']
-                time = data[solEntry]['times']
+            logging.info('Filling table.')
+            pbar = progressbar.ProgressBar(maxval=len(spillFiles[solType])).start()
+            ipbar = 0
+            weightNonZero = 0
 
-                val = data[solEntry]['values']
+            for spillFile in spillFiles[solType]:
 
-                # convert Real and Imag in Amp and Phase respectively
-                if parm == 'Real':
-                    solEntryIm = solEntry.replace('Real','Imag')
-                    valI = dataIm[solEntryIm]['values']
-                    val = np.sqrt((val**2)+(valI**2))
-                if parm == 'Imag':
-                    solEntryRe = solEntry.replace('Imag','Real')
-                    valR = dataRe[solEntryRe]['values']
-                    val = np.arctan2(val, valR)
+                with open(spillFile, 'rb') as f:
+                    entries = cPickle.load(f)
+                os.remove(spillFile)
 
                 coords = []
-                if pol is not None:
-                    polCoord = np.searchsorted(pols, pol)
-                    coords.append(polCoord)
-                if dir is not None:
-                    dirCoord = np.searchsorted(dirs, dir)
-                    coords.append(dirCoord)
-                if ant is not None:
-                    antCoord = np.searchsorted(ants, ant)
-                    coords.append(antCoord)
-                freqCoord = np.searchsorted(freqs, freq)
-                timeCoord = np.searchsorted(times, time)
-                vals[tuple(coords)][np.ix_(freqCoord,timeCoord)] = val.T
-                weights[tuple(coords)][np.ix_(freqCoord,timeCoord)] = 1
+                for pol, dir, ant, freq, time, val in entries:
+                    coord = []
+                    for axisName, axisVal in zip(['pol','dir','ant'], [pol, dir, ant]):
+                        if axisVal is not None: coord.append(np.searchsorted(axesVals[axesNames.index(axisName)], axisVal))
+                    coords.append([tuple(coord), np.searchsorted(freqs, freq), np.searchsorted(times, time)])
+
+                # read/write only the block of freqs/times of this instrument table
+                freqMin = min([freqCoord.min() for coord, freqCoord, timeCoord in coords])
+                freqMax = max([freqCoord.max() for coord, freqCoord, timeCoord in coords])
+                timeMin = min([timeCoord.min() for coord, freqCoord, timeCoord in coords])
+                timeMax = max([timeCoord.max() for coord, freqCoord, timeCoord in coords])
+                block = tuple([slice(None)]*(len(axesNames)-2) + [slice(freqMin, freqMax+1), slice(timeMin, timeMax+1)])
+                vals = soltab.val[block]
+                weights = soltab.weight[block]
+                # blocks of different instrument tables may overlap: count the change of unflagged data
+                weightNonZero -= np.count_nonzero(weights)
+
+                # fill the values
+                for (coord, freqCoord, timeCoord), (pol, dir, ant, freq, time, val) in zip(coords, entries):
+                    vals[coord][np.ix_(freqCoord-freqMin,timeCoord-timeMin)] = val.T
+                    weights[coord][np.ix_(freqCoord-freqMin,timeCoord-timeMin)] = 1
+
+                np.putmask(vals, ~np.isfinite(vals), 0) # put inf and nans to 0
+                if flagVal != 0: np.putmask(vals, vals == 0, flagVal) # nans were put to 0, set them to the flag value
+                np.putmask(weights, vals == flagVal, 0) # flag where val=flag value
+
+                soltab.val[block] = vals
+                soltab.weight[block] = weights
+                weightNonZero += np.count_nonzero(weights)
+                del entries, vals, weights
+
+                ipbar += 1
                 pbar.update(ipbar)
-            ipbar += 1
 
-        np.putmask(vals, ~np.isfinite(vals), 0) # put inf and nans to 0
-        #vals = np.nan_to_num(vals) # replace nans with 0 (flagged later)
+            pbar.finish()
 
-        pbar.finish()
-        if solType == '*RotationAngle':
-            np.putmask(weights, vals == 0., 0) # flag where val=0
-            h5parm.makeSoltab(solset, 'rotation', axesNames=['dir','ant','freq','time'], \
-                    axesVals=[dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        if solType == '*RotationMeasure':
-            np.putmask(weights, vals == 0., 0) # flag where val=0
-            h5parm.makeSoltab(solset, 'rotationmeasure', axesNames=['dir','ant','freq','time'], \
-                    axesVals=[dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == '*ScalarPhase':
-            np.putmask(weights, vals == 0., 0)
-            h5parm.makeSoltab(solset, 'scalarphase', axesNames=['dir','ant','freq','time'], \
-                    axesVals=[dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == '*ScalarAmplitude':
-            np.putmask(weights, vals == 0., 0)
-            h5parm.makeSoltab(solset, 'scalaramplitude', axesNames=['dir','ant','freq','time'], \
-                    axesVals=[dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == 'Clock':
-            np.putmask(weights, vals == 0., 0)
-            # clock may be diag or scalar
-            if len(pols) == 0:
-                h5parm.makeSoltab(solset, 'clock', axesNames=['ant','freq','time'], \
-                    axesVals=[ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-            else:
-                h5parm.makeSoltab(solset, 'clock', axesNames=['pol','ant','freq','time'], \
-                    axesVals=[pol,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == 'TEC':
-            np.putmask(weights, vals == 0., 0)
-            # tec may be diag or scalar
-            if len(pols) == 0:
-                h5parm.makeSoltab(solset, 'tec', axesNames=['dir','ant','freq','time'], \
-                    axesVals=[dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-            else:
-                h5parm.makeSoltab(solset, 'tec', axesNames=['pol','dir','ant','freq','time'], \
-                    axesVals=[pols,dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == '*Gain:*:Real' or solType == '*Gain:*:Ampl':
-            np.putmask(vals, vals == 0, 1) # nans were put to 0 before, set them to 1
-            np.putmask(weights, vals == 1., 0) # flag where val=1
-            h5parm.makeSoltab(solset, 'amplitude', axesNames=['pol','dir','ant','freq','time'], \
-                    axesVals=[pols,dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-        elif solType == '*Gain:*:Imag' or solType == '*Gain:*:Phase':
-            np.putmask(weights, vals == 0., 0) # falg where val=0
-            h5parm.makeSoltab(solset, 'phase', axesNames=['pol','dir','ant','freq','time'], \
-                    axesVals=[pols,dirs,ants,freqs,times], vals=vals, weights=weights, parmdbType=', '.join(list(ptype)))
-
-        logging.info('Flagged data: %.3f%%' % (100.*(len(weights.flat)-np.count_nonzero(weights))/len(weights.flat)))
+            weightLen = np.prod(soltab.weight.shape)
+            logging.info('Flagged data: %.3f%%' % (100.*(weightLen-weightNonZero)/weightLen))
+
+            h5parm.rechunkSoltab(soltab=soltab)
+
+    finally:
+        shutil.rmtree(spillDir, ignore_errors=True)
 
     logging.info('Collecting information from the ANTENNA table.')
     antennaTable = pt.table(antennaFile, ack=False)
@@ -21,6 +21,8 @@ def run( step, parset, H ):
     axesToClip = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Axes"]), [] )
     clipLevel = parset.getFloat('.'.join(["LoSoTo.Steps", step, "ClipLevel"]), 0. )
     log = parset.getBool('.'.join(["LoSoTo.Steps", step, "Log"]), True )
+    maxMemory = parset.getInt('.'.join(["LoSoTo.MaxMemory"]), 0 )
+    if maxMemory == 0: maxMemory = None
     
     if len(axesToClip) < 1:
         logging.error("Please specify axes to clip.")
@@ -33,7 +35,7 @@ def run( step, parset, H ):
 
         logging.info("Clipping soltab: "+soltab._v_name)
 
-        sf = solFetcher(soltab)
+        sf = solFetcher(soltab, maxMemory=maxMemory)
 
         # axis selection
         userSel = {}
@@ -51,7 +53,7 @@ def run( step, parset, H ):
             logging.error('CLIP is for "amplitude" tables, not %s.' % sf.getType())
             continue
 
-        sw = solWriter(soltab, useCache=True) # remember to flush()
+        sw = solWriter(soltab, useCache=True, maxMemory=maxMemory) # remember to flush()
 
         before_count=0
         after_count=0
@@ -77,8 +79,7 @@ def run( step, parset, H ):
             after_count+=(len(weights)-np.count_nonzero(weights))
 
             # writing back the solutions
-            sw.selection = selection
-            sw.setValues(weights, weight=True)
+            sw.bufferValues(weights, selection, weight=True)
 
         sw.addHistory('CLIP (over %s with %s sigma cut)' % (axesToClip, clipLevel))
         logging.info('Clip, flagged data: %f %% -> %f %%' \
@@ -33,6 +33,11 @@ def run( step, parset, H ):
     fit3rdorder=parset.getBool('.'.join(["LoSoTo.Steps", step, "Fit3rdOrder"]), False )
     circular=parset.getBool('.'.join(["LoSoTo.Steps", step, "Circular"]), False )
     reverse=parset.getBool('.'.join(["LoSoTo.Steps", step, "Reverse"]), False )
+    stationGroups=parset.getInt('.'.join(["LoSoTo.Steps", step, "StationGroups"]), 1 )
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 0 )
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
 
     # do something on every soltab (use the openSoltab LoSoTo function)
     #for soltab in openSoltabs( H, soltabs ):
@@ -87,7 +92,7 @@ def run( step, parset, H ):
                 flags = np.swapaxes(np.swapaxes(flags, 0, axes.index('time'))[::-1], 0, axes.index('time'))
 
             result=doFit(vals,flags==0,freqs,stations,station_positions,axes,\
-                             flagBadChannels=flagBadChannels,flagcut=flagCut,chi2cut=chi2cut,combine_pol=combinePol,removePhaseWraps=removePhaseWraps,fit3rdorder=fit3rdorder,circular=circular)
+                             flagBadChannels=flagBadChannels,flagcut=flagCut,chi2cut=chi2cut,combine_pol=combinePol,removePhaseWraps=removePhaseWraps,fit3rdorder=fit3rdorder,circular=circular,stationGroups=stationGroups,ncpu=ncpu)
             if fit3rdorder:
                 clock,tec,offset,tec3rd=result
                 if reverse: 
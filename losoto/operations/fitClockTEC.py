@@ -147,6 +147,86 @@ def unwrapPhases(phases,fitdata=None,maskrange=15,doFlag=True,flagfitdata=False)
     return phases
 
 
+def gridSearch(data, A, par, steps, ranges, blockLen=2**20):
+    """
+    Brute-force search of the parameters par + offsets*steps, with integer offsets on the grid
+    given by ranges (as np.mgrid), which minimize the variance of the residuals wrt the masked data.
+    The result is the same of evaluating the variance on the whole grid but memory is bounded
+    and it is much faster: the variance is a quadratic function of the offsets, so it is first
+    computed analytically on the grid (coarse), then the exact residual variance is evaluated
+    (in blocks) only on the points within the numerical errors from the minimum (fine).
+
+    Keyword arguments:
+    data -- masked array of phases (nF) or a stack of stations (nSt x nF)
+    A -- design matrix (nF x npar)
+    par -- initial parameters (npar) or one set per station (nSt x npar)
+    steps -- parameter steps corresponding to a 2pi phase wrap (npar) or (nSt x npar)
+    ranges -- (start, stop) offsets for each parameter
+    blockLen -- max number of elements (grid points x nF) of the exact evaluation
+    """
+    single = (np.ndim(data) == 1)
+    data = np.ma.array(data, ndmin=2)
+    nSt, nF = data.shape
+    npar = len(ranges)
+    Adata = np.ma.getdata(A).astype(np.float)
+    parSt = np.ma.getdata(par).reshape(-1, npar) * np.ones((nSt, 1))
+    stepsSt = np.ma.getdata(steps).reshape(-1, npar) * np.ones((nSt, 1))
+
+    shape = tuple(stop - start for start, stop in ranges)
+    offsets = np.indices(shape).reshape(npar, -1).T + np.array([start for start, stop in ranges])
+
+    bestPar = np.zeros((nSt, npar))
+    for ist in xrange(nSt):
+        w = ~np.ma.getmaskarray(data[ist])
+        d = np.ma.getdata(data[ist]).astype(np.float)
+        cnt = w.sum()
+        if cnt == 0:
+            bestPar[ist] = offsets[0] * stepsSt[ist] + parSt[ist]
+            continue
+
+        # coarse: variance = (R + 2*off.g + off.H.off)/cnt, with centred residuals
+        r0 = np.dot(Adata[w], parSt[ist]) - d[w]
+        U = Adata[w].T * stepsSt[ist][:, np.newaxis]
+        r0 -= r0.mean()
+        U -= U.mean(axis=1)[:, np.newaxis]
+        R = np.dot(r0, r0)
+        g = np.dot(U, r0)
+        H = np.dot(U, U.T)
+        if np.all(np.isfinite(H)) and np.all(np.isfinite(g)) and np.isfinite(R):
+            q = (R + 2 * np.dot(offsets, g) + np.einsum('pi,ij,pj->p', offsets, H, offsets)) / cnt
+            # bound of the rounding errors of both evaluations
+            absOff = np.abs(offsets)
+            mag = (R + 2 * np.dot(absOff, np.abs(g)) + np.einsum('pi,ij,pj->p', absOff, np.abs(H), absOff)) / cnt
+            M = np.dot(np.abs(offsets * stepsSt[ist] + parSt[ist]), np.abs(Adata[w]).max(axis=0)) + np.abs(d[w]).max()
+            tol = 1e-9 * mag + 1e-12 * M * (np.sqrt(np.abs(q)) + M)
+            candidates = np.nonzero(q - tol <= np.min(q + tol))[0]
+        else:
+            candidates = np.arange(len(offsets))
+
+        # fine: exact masked variance of the residuals (same operations of the full grid evaluation)
+        bestVar = np.inf
+        bestIdx = candidates[0]
+        bStep = max(1, blockLen // nF)
+        for b in xrange(0, len(candidates), bStep):
+            idx = candidates[b:b+bStep]
+            bigdata = offsets[idx] * stepsSt[ist] + parSt[ist]
+            diffdata = np.dot(bigdata, Adata.T) - d
+            mean = np.where(w, diffdata, 0.).sum(axis=-1) * 1. / cnt
+            danom = np.where(w, diffdata - mean[:, np.newaxis], 0.)
+            var = (danom * danom).sum(axis=-1) / cnt
+            i = np.argmin(var)
+            if np.isnan(var[i]):
+                bestIdx = idx[i]
+                break
+            if var[i] < bestVar:
+                bestVar = var[i]
+                bestIdx = idx[i]
+        bestPar[ist] = offsets[bestIdx] * stepsSt[ist] + parSt[ist]
+
+    if single: return bestPar[0]
+    return bestPar
+
+
 def getInitPar(
     data,
     freqs, 
@@ -171,7 +251,7 @@ def getInitPar(
         A=np.ma.zeros((freqs.shape[0],2),dtype=np.float64)
         A[:,1]=2*np.pi*1e-9*freqs
         A[:,0]=-8.44797245e9/freqs
-    a=np.mgrid[int(-nrTEC/2):int(nrTEC/2)+1,-int(nrClock/2):int(nrClock/2)+1]
+    ranges=[(int(-nrTEC/2),int(nrTEC/2)+1),(-int(nrClock/2),int(nrClock/2)+1)]
     if len(initsol)>=2 and not (initsol[0]==0 and initsol[1]==0) and not (initsol[0]==-10 and initsol[1]==-10)  :
         #print "unwrapping with initsol",initsol
         fitdata=np.dot(initsol,A.T)
@@ -196,12 +276,7 @@ def getInitPar(
     #get initial guess, first only for first two parameters
     par=np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T,A[:,:2])),np.ma.dot(A[:,:2].T,data))
     
-    #print "intial guess",par,"min 0",a[0][0,0]*steps[0]+par[0],"max 0",a[0][-1,0]*steps[0]+par[0],"min 1",a[1][0,0]*steps[1]+par[1],"max 1",a[1][0,-1]*steps[1]+par[1]
-    bigdata=np.concatenate(tuple([a[i][np.newaxis,:]*steps[i]+par[i] for i  in range(2)]),axis=0).transpose(1,2,0)
-    diffdata=np.dot(bigdata,A[:,:2].T)
-    diffdata-=data[np.newaxis,np.newaxis]
-    idx=np.unravel_index(np.argmin(np.ma.var(diffdata,axis=-1)),diffdata.shape[:-1])     
-    par=bigdata[idx]
+    par=gridSearch(data,A[:,:2],par,steps,ranges)
     fitdata=np.dot(par,A[:,:2].T)
     data=unwrapPhases(data,fitdata,doFlag=doFlag,flagfitdata=True)
     if data.mask.sum()<0.5*data.size:
@@ -210,12 +285,8 @@ def getInitPar(
     if nrthird>0:
         steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A.T, A)), A.T), 2 * np.pi * np.ones((freqs.shape[0], ), dtype=np.float))
         par=np.ma.dot(np.linalg.inv(np.ma.dot(A.T,A)),np.ma.dot(A.T,data))
-        a=np.mgrid[max(-1,int(-nrTEC/2)):min(2,int(nrTEC/2)+1),max(-1,int(-nrClock/2)):min(2,int(nrClock/2)+1),-int(nrthird/2):int(nrthird/2)+1] #assume dTEC and dClock are already close
-        bigdata=np.concatenate(tuple([a[i][np.newaxis,:]*steps[i]+par[i] for i  in range(3)]),axis=0).transpose(1,2,3,0)
-        diffdata=np.ma.dot(bigdata,A.T)
-        diffdata-=data[np.newaxis,np.newaxis,np.newaxis]
-        idx=np.unravel_index(np.argmin(np.ma.var(diffdata,axis=-1)),diffdata.shape[:-1])     
-        par=bigdata[idx]
+        #assume dTEC and dClock are already close
+        par=gridSearch(data,A,par,steps,[(max(-1,int(-nrTEC/2)),min(2,int(nrTEC/2)+1)),(max(-1,int(-nrClock/2)),min(2,int(nrClock/2)+1)),(-int(nrthird/2),int(nrthird/2)+1)])
         fitdata=np.dot(par,A.T)
         data=unwrapPhases(data,fitdata,doFlag=doFlag)
     return par,data
@@ -307,6 +378,9 @@ def getClockTECFit(
                     sol[ist, :] = par[:]
                 #if itm%100==0:
                     #logging.debug("Getting init par for station %d:%d "%(itm,ist)+str(sol[ist]))
+        fitSt = []
+        fitdataall = np.zeros((nF, nSt), dtype=np.float)
+        fitweights = np.zeros((nF, nSt), dtype=np.float)
         for ist in xrange(nSt):
             #now do the real fitting
             datatmpist=datatmp[:,ist]
@@ -318,16 +392,21 @@ def getClockTECFit(
             datatmpist=unwrapPhases(datatmpist,fitdata)
             #if itm%100==0:
             #    logging.debug(" init par for station itm %d:%d "%(itm,ist)+str(sol[ist]))
-            mymask=datatmpist.mask
-            maskedfreq=np.ma.array(freq,mask=mymask)
-            A2=np.ma.array(A,mask=np.tile(mymask,(A.shape[1],1)).T)
-            sol[ist] = np.ma.dot(np.linalg.inv(np.ma.dot(A2.T, A2)), np.ma.dot(A2.T, datatmpist)).T
-            if initprevsol[ist] and np.abs((sol[ist,1]-prevsol[ist,1])/steps[1])>0.5 and (np.abs((sol[ist,1]-prevsol[ist,1])/steps[1])>0.75 or np.abs(np.sum((sol[ist]-prevsol[ist])/steps,axis=-1))>0.5*A2.shape[0]):
-                #logging.debug("removing jumps, par for station %d , itm %d"%(ist,itm)+str(sol[ist])+str(prevsol[ist])+str(steps))
-                sol[ist,:]-=np.round((sol[ist,1]-prevsol[ist,1])/steps[1])*steps
-                #logging.debug("removed jumps, par for station %d "%ist+str(sol[ist])+str(prevsol[ist]))
-            #if itm%100==0:
-            #    logging.debug("par for station itm %d:%d "%(itm,ist)+str(sol[ist]))
+            fitSt.append(ist)
+            fitweights[:, ist] = ~np.ma.getmaskarray(datatmpist)
+            fitdataall[:, ist] = np.ma.filled(datatmpist, 0.)
+        if len(fitSt) > 0:
+            # normal equations (flagged channels have weight 0) for all the stations at once
+            w = fitweights[:, fitSt]
+            AtA = np.einsum('fs,fi,fj->sij', w, A, A)
+            Atd = np.einsum('fs,fi->si', w * fitdataall[:, fitSt], A)
+            newsol = np.einsum('sij,sj->si', np.linalg.inv(AtA), Atd)
+            # remove jumps wrt the previous solution
+            jump = (newsol[:, 1] - prevsol[fitSt, 1]) / steps[1]
+            jumpselect = initprevsol[fitSt] & (np.abs(jump) > 0.5) & \
+                ((np.abs(jump) > 0.75) | (np.abs(np.sum((newsol - prevsol[fitSt]) / steps, axis=-1)) > 0.5 * nF))
+            newsol[jumpselect] -= np.round(jump[jumpselect])[:, np.newaxis] * steps
+            sol[fitSt] = newsol
          # calculate chi2 per station
         residual = data[itm] - np.dot(A, sol.T)
         tmpresid = residual - residual[:, 0][:, np.newaxis]  # residuals relative to station 0
@@ -464,6 +543,70 @@ def get_first_good(data,axis=1,check=lambda x:np.logical_and(x!=-10,x !=0)):
         ndata.append(np.take(data,a[abs(1-axis)][idx],axis=abs(1-axis))[i])
     return np.array(ndata)
 
+def _getClockTECFitJob(pol, idx, data, mask, freq, stations, initSol, returnResiduals, chi2cut, fit3rdorder, double_search_space, outQueue=None):
+    """
+    Run getClockTECFit() on a group of stations of one polarization (for multiprocManager)
+    """
+    result = getClockTECFit(np.ma.array(data, mask=mask), freq, stations, initSol=initSol,
+        returnResiduals=returnResiduals, chi2cut=chi2cut, fit3rdorder=fit3rdorder,
+        double_search_space=double_search_space)
+    if outQueue is not None:
+        outQueue.put([pol, idx] + list(result))
+    else:
+        return [pol, idx] + list(result)
+
+def fitClockTECParallel(
+    data,
+    freq,
+    stations,
+    initSols,
+    returnResiduals=True,
+    chi2cut=1e8,
+    fit3rdorder=False,
+    double_search_space=False,
+    stationGroups=1,
+    ncpu=1
+    ):
+    """
+    Run getClockTECFit() on every polarization of data (time x freq x ant x pol),
+    returns the list of results (one per polarization).
+    Polarizations are independent and are fitted in parallel on ncpu processes.
+    If stationGroups > 1 the stations are also split in groups fitted separately (each group
+    contains station 0, which is the reference for the chi2): this is not identical to a single
+    fit since a failed fit triggers a new initial-parameter search for all the stations
+    in the group, but only for them.
+    initSols: list with the initial solutions (see getClockTECFit) of each polarization
+    """
+    from losoto.operations_lib import multiprocManager
+
+    nT, nF, nSt, npol = data.shape
+    nGroups = max(1, min(stationGroups, (nSt - 1) // 2)) # at least 2 stations per group
+    groups = [np.concatenate(([0], g)).astype(int) if g[0] != 0 else g for g in np.array_split(np.arange(nSt), nGroups) if len(g) > 0]
+
+    def jobs():
+        for pol in xrange(npol):
+            for idx in groups:
+                groupInitSol = [initSols[pol][i] for i in idx if i < len(initSols[pol])]
+                polData = data[:, :, idx, pol]
+                yield [pol, idx, np.ma.getdata(polData).copy(), np.ma.getmaskarray(polData).copy(), freq, stations[idx],
+                    groupInitSol, returnResiduals, chi2cut, fit3rdorder, double_search_space]
+
+    if ncpu > 1 and npol * len(groups) > 1:
+        mpm = multiprocManager(ncpu, _getClockTECFitJob)
+        jobResults = mpm.imap(jobs())
+    else:
+        jobResults = (_getClockTECFitJob(*job) for job in jobs())
+
+    # merge the station groups
+    results = [None] * npol
+    for jobResult in jobResults:
+        pol, idx, result = jobResult[0], jobResult[1], jobResult[2:]
+        if results[pol] is None:
+            results[pol] = [np.zeros(r.shape[:-1] + (nSt,), dtype=r.dtype) for r in result]
+        for r, rGroup in zip(results[pol], result):
+            r[..., idx] = rGroup
+    return results
+
 def doFit(
     phases,
     mask,
@@ -481,6 +624,8 @@ def doFit(
     circular=False,
     initSol=[],
     initoffsets=[],
+    stationGroups=1,
+    ncpu=1
     ):
     # make sure order of axes is as expected
     stidx = axes.index('ant')
@@ -579,34 +724,19 @@ def doFit(
         tec3rd = np.zeros((nT, nSt, npol), dtype=np.float32)
    
     # better not to use fitoffset
+    # get a good guesss without offset
+    initialchi2cut = chi2cut  # user defined
+    if removePhaseWraps:
+        initialchi2cut = 30000.  # this number is quite arbitrary
+    results = fitClockTECParallel(data, freqs, stations, [initSol]*npol, returnResiduals=True,
+                fit3rdorder=fit3rdorder, chi2cut=initialchi2cut, double_search_space=circular and combine_pol,
+                stationGroups=stationGroups, ncpu=ncpu)
+    initsols = []
     for pol in xrange(npol):
-        # get a good guesss without offset
-        # logging.debug("sending masked data "+str(data[:,:,:,pol].count()))
-        initialchi2cut = chi2cut  # user defined
-        if removePhaseWraps:
-            initialchi2cut = 30000.  # this number is quite arbitrary
         if fit3rdorder:
-            (tecarray, clockarray, residualarray,tec3rdarray) = getClockTECFit(
-                np.ma.copy(data[:, :, :, pol]),
-                freqs,
-                stations,
-                initSol=initSol,
-                returnResiduals=True,
-                fit3rdorder=True,
-                chi2cut=initialchi2cut,
-                double_search_space=circular and combine_pol
-                )
+            (tecarray, clockarray, residualarray,tec3rdarray) = results[pol]
         else:
-            (tecarray, clockarray, residualarray) = getClockTECFit(
-                np.ma.copy(data[:, :, :, pol]),
-                freqs,
-                stations,
-                initSol=initSol,
-                returnResiduals=True,
-                fit3rdorder=False,
-                chi2cut=initialchi2cut,
-                double_search_space=circular and combine_pol
-                )
+            (tecarray, clockarray, residualarray) = results[pol]
         if removePhaseWraps:
             # correctfrist times only,try to make init correct ?
             #corrects wraps based on spatial correlation (averaged in time), only works for long time observations, not testted for LBA
@@ -630,37 +760,29 @@ def doFit(
             initsol[:, 1] = get_first_good(clockarray[:, :]) + wraps * steps[1]
             logging.debug('Initsol TEC, pol %d: ' % pol + str(initsol[:, 0]))
             logging.debug('Initsol clock, pol %d: ' % pol + str(initsol[:, 1]))
-            tecarray = 0
-            clockarray = 0
-            residualarray = 0
-            # is it needed to redo the fitting? this is the time bottleneck
-            if fit3rdorder:
-                (tec[:, :, pol], clock[:, :, pol],tec3rd[:, :, pol]) = getClockTECFit(
-                    np.ma.copy(data[:, :, :, pol]),
-                    freqs,
-                    stations,
-                    initSol=initsol,
-                    returnResiduals=False,
-                    fit3rdorder=True,
-                    chi2cut=chi2cut,
-                    double_search_space=circular and combine_pol
-                    )
-            else:
-                (tec[:, :, pol], clock[:, :, pol]) = getClockTECFit(
-                    np.ma.copy(data[:, :, :, pol]),
-                    freqs,
-                    stations,
-                    initSol=initsol,
-                    returnResiduals=False,
-                    fit3rdorder=False,
-                    chi2cut=chi2cut,
-                    double_search_space=circular and combine_pol
-                    )
+            initsols.append(initsol)
         else:
             tec[:, :, pol] = tecarray[:, :]+ wraps * steps[0]
             clock[:, :, pol] = clockarray[:, :]+ wraps * steps[1]
             if fit3rdorder:
               tec3rd[:, :, pol]  = tec3rdarray[:, :]+ wraps * steps[2]
+    results = 0
+    tecarray = 0
+    clockarray = 0
+    residualarray = 0
+
+    if removePhaseWraps:
+        # is it needed to redo the fitting? this is the time bottleneck
+        results = fitClockTECParallel(data, freqs, stations, initsols, returnResiduals=False,
+                fit3rdorder=fit3rdorder, chi2cut=chi2cut, double_search_space=circular and combine_pol,
+                stationGroups=stationGroups, ncpu=ncpu)
+        for pol in xrange(npol):
+            if fit3rdorder:
+                (tec[:, :, pol], clock[:, :, pol],tec3rd[:, :, pol]) = results[pol]
+            else:
+                (tec[:, :, pol], clock[:, :, pol]) = results[pol]
+
+    for pol in xrange(npol):
         logging.debug('TEC iter 2, pol %d: ' % pol + str(tec[0, :, pol]))
         logging.debug('Clock iter 2, pol %d: ' % pol + str(clock[0, :, pol]))
     if not 'LBA' in stations[0] and len(initSol) < 1:
@@ -8,7 +8,6 @@ import logging
 from losoto.operations_lib import *
 import numpy as np
 import itertools
-from scipy.ndimage import generic_filter
 import scipy.interpolate
 
 logging.debug('Loading FLAG module.')
@@ -141,7 +140,7 @@ def flag(vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, ma
             if mode == 'smooth':
                 vals_smooth = np.copy(vals)
                 np.putmask(vals_smooth, weights==0, np.nan)
-                vals_smooth = generic_filter(vals_smooth, np.nanmedian, size=order)
+                vals_smooth = runningMedian(vals_smooth, order)
                 vals_detrend = vals - vals_smooth
             elif mode == 'poly':
                 # get polynomia and values
@@ -306,6 +305,8 @@ def run( step, parset, H ):
     if ncpu == 0:
         import multiprocessing
         ncpu = multiprocessing.cpu_count()
+    maxMemory = parset.getInt('.'.join(["LoSoTo.MaxMemory"]), 0 )
+    if maxMemory == 0: maxMemory = None
 
     if ref == '': ref = None
 
@@ -332,8 +333,13 @@ def run( step, parset, H ):
 
         logging.info("Flagging soltab: "+soltab._v_name)
 
-        sf = solFetcher(soltab)
-        sw = solWriter(soltab, useCache=True) # remember to flush!
+        sf = solFetcher(soltab, maxMemory=maxMemory)
+        # results are written while the table is still being read: do not overwrite
+        # the reference antenna values before all the data have been fetched
+        if ref is not None and replace:
+            sw = solWriter(soltab, useCache=True) # remember to flush!
+        else:
+            sw = solWriter(soltab, useCache=True, maxMemory=maxMemory) # remember to flush!
 
         # axis selection
         userSel = {}
@@ -355,20 +361,20 @@ def run( step, parset, H ):
 
         solType = sf.getType()
 
-        # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToFlag, weight=True, reference=ref):
-            mpm.put([vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRmsNoise, replace, axesToFlag, selection])
+        # feed the queue (note that sf and sw cannot be put into a queue since they have file references)
+        # and write the results back as they come
+        jobs = ([vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRmsNoise, replace, axesToFlag, selection] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToFlag, weight=True, reference=ref))
 
-        mpm.wait()
-        
-        for v, w, sel in mpm.get():
-            sw.selection = sel
+        for v, w, sel in mpm.imap(jobs):
             if replace:
                 # rewrite solutions (flagged values are overwritten)
-                sw.setValues(v, weight=False)
+                vals, weight = v, False
             else:
-                sw.setValues(w, weight=True)
-        
+                vals, weight = w, True
+            # results may be views of shared memory: copy them to release it
+            sw.bufferValues(np.array(vals), sel, weight=weight)
+
         sw.flush()
         sw.addHistory('FLAG (over %s with %s sigma cut)' % (axesToFlag, maxRms))
 
@@ -61,6 +61,8 @@ def run( step, parset, H ):
     if ncpu == 0:
         import multiprocessing
         ncpu = multiprocessing.cpu_count()
+    maxMemory = parset.getInt('.'.join(["LoSoTo.MaxMemory"]), 0 )
+    if maxMemory == 0: maxMemory = None
     
     if axesToExt == []:
         logging.error("Please specify at least one axis to extend flag.")
@@ -73,8 +75,8 @@ def run( step, parset, H ):
 
         logging.info("Extending flag on soltab: "+soltab._v_name)
 
-        sf = solFetcher(soltab)
-        sw = solWriter(soltab)
+        sf = solFetcher(soltab, maxMemory=maxMemory)
+        sw = solWriter(soltab, maxMemory=maxMemory)
 
         # axis selection
         userSel = {}
@@ -88,16 +90,15 @@ def run( step, parset, H ):
                 mpm.wait()
                 return 1
 
-        # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToExt, weight=True):
-            mpm.put([weights, coord, axesToExt, selection, percent, size, cycles])
+        # feed the queue (note that sf and sw cannot be put into a queue since they have file references)
+        # and write the results back as they come
+        jobs = ([weights, coord, axesToExt, selection, percent, size, cycles] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToExt, weight=True))
 
-        mpm.wait()
-
-        logging.info('Writing solutions')
-        for w,sel in mpm.get():
-            sw.selection = sel
-            sw.setValues(w, weight=True) # convert back to np.float16
+        for weights, selection in mpm.imap(jobs):
+            # results may be views of shared memory: copy them to release it
+            sw.bufferValues(np.array(weights), selection, weight=True) # convert back to np.float16
+        sw.flush()
 
         sw.addHistory('FLAG EXTENDED (over %s)' % (str(axesToExt)))
         del sf
@@ -20,13 +20,15 @@ def run( step, parset, H ):
 
     normVal = parset.getFloat('.'.join(["LoSoTo.Steps", step, "NormVal"]), 1. )
     normAxes = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "NormAxes"]), ['time'] )
+    maxMemory = parset.getInt('.'.join(["LoSoTo.MaxMemory"]), 0 )
+    if maxMemory == 0: maxMemory = None
 
     for soltab in openSoltabs( H, soltabs ):
 
         logging.info("Normalizing soltab: "+soltab._v_name)
 
-        tr = solFetcher(soltab)
-        tw = solWriter(soltab, useCache = True) # remember to flush!
+        tr = solFetcher(soltab, maxMemory = maxMemory)
+        tw = solWriter(soltab, useCache = True, maxMemory = maxMemory) # remember to flush!
 
         axesNames = tr.getAxesNames()
         for normAxis in normAxes:
@@ -50,8 +52,7 @@ def run( step, parset, H ):
             logging.debug("Rescaling by: "+str(normVal/valsMean))
 
             # writing back the solutions
-            tw.selection = selection
-            tw.setValues(vals)
+            tw.bufferValues(vals, selection)
 
         tw.flush()
         tw.addHistory('NORM (on axis %s)' % (normAxes))
@@ -9,10 +9,65 @@ from losoto.operations_lib import *
 
 logging.debug('Loading PLOT module.')
 
-def plot(Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals, xlabelunit, ylabelunit, datatype, filename, titles, log, dataCube, minZ, maxZ, plotflag, makeMovie, antCoords, outQueue):
+def _sliceIter(vals, weights, axesNames, axesVals, returnAxes):
+    """
+    In-memory equivalent of solFetcher.getValuesIter(weight=True) on values/weights already read:
+    yields the values and weights with axes = returnAxes (views), the axes values (as getValuesIter)
+    and the sub-arrays of values/weights and axes values with the iterated axes of length 1
+    (to iterate again on them)
+    vals, weights -- arrays with axes axesNames
+    axesVals -- dict with the values of each axis
+    returnAxes -- axes of the returned arrays, all others are cycled
+    """
+    import numpy as np
+    iterAxesPos = [j for j, axisName in enumerate(axesNames) if not axisName in returnAxes]
+    returnAxesVals = dict([(axisName, axesVals[axisName]) for axisName in axesNames if axisName in returnAxes])
+    for axisIdx in np.ndindex(*[vals.shape[j] for j in iterAxesPos]):
+        idx = [slice(None)]*len(axesNames)
+        subIdx = [slice(None)]*len(axesNames)
+        thisAxesVals = {}
+        subAxesVals = dict(axesVals)
+        for i, j in zip(axisIdx, iterAxesPos):
+            idx[j] = i
+            subIdx[j] = slice(i, i+1)
+            thisAxesVals[axesNames[j]] = axesVals[axesNames[j]][i]
+            subAxesVals[axesNames[j]] = axesVals[axesNames[j]][i:i+1]
+        for axisName, axisVals in returnAxesVals.iteritems():
+            # operations are allowed to modify the coordinates in place
+            thisAxesVals[axisName] = axisVals.copy()
+        yield vals[tuple(idx)], weights[tuple(idx)], thisAxesVals, \
+            vals[tuple(subIdx)], weights[tuple(subIdx)], subAxesVals
+
+
+def _plotHash(items):
+    """
+    Return an hash of the parameters of a figure, used as key of the plot cache
+    items -- list of the parameters given to plot(), arrays are hashed by content
+    """
+    import hashlib
+    import numpy as np
+    from losoto import _version
+    md5 = hashlib.md5(_version.__version__)
+    def update(item):
+        if isinstance(item, np.ndarray):
+            md5.update('%s%s' % (item.dtype.str, str(item.shape)))
+            if item.dtype == object: md5.update(repr(item.tolist()))
+            else: md5.update(np.ascontiguousarray(item).tostring())
+        elif isinstance(item, (list, tuple)):
+            md5.update('[')
+            for subItem in item: update(subItem)
+            md5.update(']')
+        else:
+            md5.update(repr(item))
+    update(items)
+    return md5.hexdigest()
+
+
+def plot(Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals, xlabelunit, ylabelunit, datatype, filename, titles, log, dataCube, dataMask, minZ, maxZ, plotflag, makeMovie, antCoords, outQueue):
         import os
         from itertools import cycle, chain
         import numpy as np
+        dataCube = np.ma.masked_array(dataCube, mask=dataMask)
         # avoids error if re-setting "agg" a second run of plot
         if not 'matplotlib' in sys.modules:
             import matplotlib as mpl
@@ -136,10 +191,13 @@ def plot(Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals,
             figgrid.savefig(filename+'.png')
         plt.close()
 
+        # return the saved figure (used by the plot cache)
+        if outQueue is not None: outQueue.put(filename)
+
 
 def run( step, parset, H ):
 
-    import os, random
+    import os, random, json, time
     import numpy as np
     from losoto.h5parm import solFetcher, solHandler
 
@@ -177,6 +235,7 @@ def run( step, parset, H ):
     makeAntPlot = parset.getBool('.'.join(["LoSoTo.Steps", step, "MakeAntPlot"]), False )
     makeMovie = parset.getBool('.'.join(["LoSoTo.Steps", step, "MakeMovie"]), False )
     prefix = parset.getString('.'.join(["LoSoTo.Steps", step, "Prefix"]), '' )
+    useCache = parset.getBool('.'.join(["LoSoTo.Steps", step, "Cache"]), False )
 
     ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 0 )
     if ncpu == 0:
@@ -185,13 +244,27 @@ def run( step, parset, H ):
 
     if makeMovie: 
         prefix = prefix+'__tmp__'
+        if useCache:
+            logging.warning('Plot cache not used with MakeMovie (figures are removed after the movie is made).')
+            useCache = False
 
     if os.path.dirname(prefix) != '' and not os.path.exists(os.path.dirname(prefix)):
         logging.debug('Creating '+os.path.dirname(prefix)+'.')
         os.makedirs(os.path.dirname(prefix))
 
+    # plot cache: figures whose data and parameters did not change since the last run are not redrawn
+    cacheFile = prefix+'plotcache.json'
+    cache = {'figures':{}}
+    if useCache and os.path.exists(cacheFile):
+        try:
+            cache = json.load(open(cacheFile))
+        except ValueError:
+            logging.warning('Corrupted plot cache '+cacheFile+', all figures will be redrawn.')
+
     if ref == '': ref = None
     sfsAdd = [ solFetcher(soltab) for soltab in openSoltabs(H, tablesToAdd) ]
+    # tables to add are read only once
+    valsAddAlls = [ sfAdd.getValues(retAxesVals=False, weight=False, reference=ref) for sfAdd in sfsAdd ]
 
     for soltab in openSoltabs( H, soltabs ):
 
@@ -253,12 +326,20 @@ def run( step, parset, H ):
             
         datatype = sf.getType()
 
+        # read the data only once, figures/tables/colors are then sliced in memory
+        valsAll, axesValsAll = sf.getValues(reference=ref)
+        weightsAll = sf.getValues(retAxesVals=False, weight=True)
+
         # start processes for multi-thread
         mpm = multiprocManager(ncpu, plot)
 
         # cycle on files
         if makeMovie: pngs = [] # store png filenames
-        for vals, coord, selection in sf.getValuesIter(returnAxes=axisInDiff+axisInTable+axisInCol+axesInPlot):
+        figHashes = {} # hashes of the figures being drawn
+        savedFigs = [] # figures drawn without errors
+        Nskipped = 0
+        for vals, weight, coord, valsFile, weightsFile, axesValsFile in \
+                _sliceIter(valsAll, weightsAll, sf.getAxesNames(), axesValsAll, axisInDiff+axisInTable+axisInCol+axesInPlot):
            
             # set filename
             filename = ''
@@ -319,13 +400,12 @@ def run( step, parset, H ):
                 yvals = None
                 ylabelunit = None
 
-            sf2 = solFetcher(soltab)
-            sf2.selection = selection
             # cycle on tables
             titles = []
             dataCube = []
             weightCube = []
-            for Ntab, (vals, coord, selection) in enumerate(sf2.getValuesIter(returnAxes=axisInDiff+axisInCol+axesInPlot)):
+            for Ntab, (vals, weight, coord, valsTab, weightsTab, axesValsTab) in \
+                    enumerate(_sliceIter(valsFile, weightsFile, sf.getAxesNames(), axesValsFile, axisInDiff+axisInCol+axesInPlot)):
                 dataCube.append([])
                 weightCube.append([])
 
@@ -336,13 +416,13 @@ def run( step, parset, H ):
                     titles[Ntab] += axis+':'+str(coord[axis])+' '
                 titles[Ntab] = titles[Ntab][:-1] # remove last ' '
 
-                sf3 = solFetcher(soltab)
-                sf3.selection = selection
                 # cycle on colors
-
-                for Ncol, (vals, weight, coord, selection) in enumerate(sf3.getValuesIter(returnAxes=axisInDiff+axesInPlot, weight=True, reference=ref)):
+                for Ncol, (vals, weight, coord, _, _, _) in \
+                        enumerate(_sliceIter(valsTab, weightsTab, sf.getAxesNames(), axesValsTab, axisInDiff+axesInPlot)):
                     dataCube[Ntab].append([])
                     weightCube[Ntab].append([])
+                    # slices are views on the data read once
+                    vals = vals.copy()
         
                     # differential plot
                     if axisInDiff != []:
@@ -368,16 +448,25 @@ def run( step, parset, H ):
  
 
                     # add tables if required (e.g. phase/tec)
-                    for sfAdd in sfsAdd:
+                    for sfAdd, valsAddAll in zip(sfsAdd, valsAddAlls):
                         newCoord = {}
-                        for axisName in coord.keys():
-                            if axisName in sfAdd.getAxesNames():
+                        addIdx = []
+                        for axisName in sfAdd.getAxesNames():
+                            axisVals = sfAdd.getAxisValues(axisName)
+                            if axisName in coord.keys():
                                 if type(coord[axisName]) is np.ndarray:
                                     newCoord[axisName] = coord[axisName]
                                 else:
                                     newCoord[axisName] = [coord[axisName]] # avoid being interpreted as regexp, faster
-                        sfAdd.setSelection(**newCoord)
-                        valsAdd = np.squeeze(sfAdd.getValues(retAxesVals=False, weight=False, reference=ref))
+                                # same indexes of sfAdd.setSelection(**newCoord)
+                                selVal = np.array(newCoord[axisName], dtype=sfAdd.getAxisType(axisName))
+                                if len(selVal) == 1: idx = [axisVals.tolist().index(selVal)]
+                                else: idx = [i for i, item in enumerate(axisVals) if item in selVal]
+                                if len(idx) == 0: idx = range(len(axisVals))
+                            else:
+                                idx = range(len(axisVals))
+                            addIdx.append(idx)
+                        valsAdd = np.squeeze(valsAddAll[np.ix_(*addIdx)])
                         if sfAdd.getType() == 'clock':
                             valsAdd = 2. * np.pi * valsAdd * newCoord['freq']
                         elif sfAdd.getType() == 'tec':
@@ -396,7 +485,7 @@ def run( step, parset, H ):
                             valsAdd = np.addaxes(valsAdd, polAxisPos)
 
                         if valsAdd.shape != vals.shape:
-                            logging.error('Cannot combine the table '+sfAdd.getType()+' with '+sf4.getType()+'. Wrong shape.')
+                            logging.error('Cannot combine the table '+sfAdd.getType()+' with '+sf.getType()+'. Wrong shape.')
                             mpm.wait()
                             return 1
 
@@ -412,19 +501,44 @@ def run( step, parset, H ):
                     
                     # is user requested axis in an order that is different from h5parm, we need to transpose
                     if len(axesInPlot) == 2:
-                        if sf3.getAxesNames().index(axesInPlot[0]) < sf3.getAxesNames().index(axesInPlot[1]): vals = vals.T
+                        if sf.getAxesNames().index(axesInPlot[0]) < sf.getAxesNames().index(axesInPlot[1]): vals = vals.T
 
                     dataCube[Ntab][Ncol] = np.ma.masked_array(vals, mask=(weight == 0))
 
+            # plain arrays (values and flags) are passed to the workers through shared memory
+            dataMask = np.array([[np.ma.getmaskarray(data) for data in dataTab] for dataTab in dataCube])
+            dataCube = np.array([[np.ma.getdata(data) for data in dataTab] for dataTab in dataCube])
+
+            args = [Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals, xlabelunit, ylabelunit, datatype, prefix+filename, titles, log, dataCube, dataMask, minZ, maxZ, plotflag, makeMovie, antCoords]
+
+            if useCache:
+                figHash = _plotHash(args)
+                cached = cache['figures'].get(prefix+filename)
+                if cached is not None and cached['hash'] == figHash and os.path.exists(prefix+filename+'.png'):
+                    logging.debug('Figure '+prefix+filename+'.png unchanged, not redrawn.')
+                    Nskipped += 1
+                    continue
+                figHashes[prefix+filename] = figHash
+
             # if dataCube too large (> 500 MB) do not go parallel
-            if np.array(dataCube).nbytes > 1024*1024*500: 
+            if dataCube.nbytes > 1024*1024*500: 
                 logging.debug('Big plot, parallel not possible.')
-                plot(Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals, xlabelunit, ylabelunit, datatype, prefix+filename, titles, log, dataCube, minZ, maxZ, plotflag, makeMovie, antCoords, None)
+                plot(*(args+[None]))
+                savedFigs.append(prefix+filename)
             else:
-                mpm.put([Nplots, NColFig, figSize, cmesh, axesInPlot, axisInTable, xvals, yvals, xlabelunit, ylabelunit, datatype, prefix+filename, titles, log, dataCube, minZ, maxZ, plotflag, makeMovie, antCoords])
+                mpm.put(args)
             if makeMovie: pngs.append(prefix+filename+'.png')
 
-        mpm.wait()
+        # wait for all the figures (errors in the workers are reported)
+        savedFigs += list(mpm.get())
+
+        if useCache:
+            # the manifest records what was drawn, failed figures are not stored and will be redrawn
+            for savedFig in savedFigs:
+                cache['figures'][savedFig] = {'hash':figHashes[savedFig], 'step':step, 'soltab':soltab._v_parent._v_name+'/'+soltab._v_name, \
+                        'file':savedFig+'.png', 'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+            json.dump(cache, open(cacheFile, 'w'), indent=1, sort_keys=True)
+            logging.info('Plot cache: %i figures drawn, %i unchanged.' % (len(savedFigs), Nskipped))
 
         if makeMovie:
             def long_substr(strings):
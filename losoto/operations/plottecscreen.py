@@ -12,9 +12,13 @@ logging.debug('Loading PLOTTECSCREEN module.')
 
 def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
     source_names, times, height, order, beta_val, r_0, prefix = 'frame_',
-    remove_gradient=True, show_source_names=False, min_tec=None, max_tec=None):
+    remove_gradient=True, show_source_names=False, min_tec=None, max_tec=None,
+    ncpu=1, preview=False):
     """Makes plots of TEC screens
 
+    Screens are evaluated on the whole image grid at once for each timeslot,
+    frames are rendered in parallel on ncpu processes.
+
     Keyword arguments:
     pp -- array of piercepoint locations
     tec_screen -- array of TEC screen values at the piercepoints
@@ -31,22 +35,16 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
     show_source_names -- label sources on screen plots
     min_tec -- minimum TEC value for plot range
     max_tec -- maximum TEC value for plot range
+    ncpu -- number of processes
+    preview -- make lower-resolution preview frames (half the pixels and low
+        dpi) instead of the full ones
     """
     from numpy import kron, concatenate, newaxis
     from numpy.linalg import pinv, norm
     import numpy as np
     import os
     from losoto.operations.tecscreen import calc_piercepoint
-    # avoids error if re-setting "agg" a second run of plot
-    if not 'matplotlib' in sys.modules:
-        import matplotlib as mpl
-        mpl.rc('font',size =8 )
-        mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22 )
-        mpl.use("Agg")
-    import matplotlib as mpl
-    import matplotlib.pyplot as plt # after setting "Agg" to speed up
-    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
- 
+
     try:
         import progressbar
     except ImportError:
@@ -56,6 +54,8 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
     if root_dir == '':
         root_dir = './'
     prestr = os.path.basename(prefix) + 'screen_'
+    if preview:
+        prestr += 'preview_'
     try:
         os.makedirs(root_dir)
     except OSError:
@@ -97,9 +97,12 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
     residuals = residuals.transpose([0, 2, 1]).reshape(N_piercepoints, N_times)
     fitted_tec1 = tec_screen.transpose([0, 2, 1]).reshape(N_piercepoints, N_times) + residuals
 
-    Nx = 24
+    if preview:
+        Nx, Ny_min, dpi = 12, 10, 50
+    else:
+        Nx, Ny_min, dpi = 24, 20, None
     Ny = 0
-    while Ny < 20:
+    while Ny < Ny_min:
         pix_per_m = Nx / im_extent_m[0]
         m_per_pix = 1.0 / pix_per_m
         Ny = int(im_extent_m[1] * pix_per_m)
@@ -136,21 +139,20 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
         D2 = np.sum(D**2, axis=2)
         C = -(D2 / r_0**2)**(beta_val / 2.0) / 2.0
         f = np.dot(pinv(C), tec_screen[:, k, :].reshape(N_piercepoints))
-        for i, xi in enumerate(xr[0: Nx]):
-            for j, yi in enumerate(yr[0: Ny]):
-                p, airmass = calc_piercepoint(np.dot(np.array([xi, yi]), np.array([east, north])), up, height)
-                d2 = np.sum(np.square(pp[k, :, :] - p), axis=1)
-                c = -(d2 / ( r_0**2 ))**(beta_val / 2.0) / 2.0
-                screen[i, j, k] = airmass * np.dot(c, f)
+
+        # evaluate the screen on the whole grid at once
+        xr = xr[0: Nx]
+        yr = yr[0: Ny]
+        xg, yg = np.meshgrid(xr, yr, indexing='ij')
+        p, airmass = calc_piercepoint(xg[:, :, newaxis] * east + yg[:, :, newaxis] * north, up, height)
+        d2 = np.sum(np.square(pp[k, newaxis, newaxis, :, :] - p[:, :, newaxis, :]), axis=3)
+        c = -(d2 / ( r_0**2 ))**(beta_val / 2.0) / 2.0
+        screen[0: len(xr), 0: len(yr), k] = airmass * np.dot(c, f)
 
         # Fit and remove a gradient.
         if remove_gradient:
             xscr, yscr = np.indices(screen.shape[0:2])
-            zs = screen[:, :, k]
-            XYZ = []
-            for xf, yf in zip(xscr.flatten().tolist(), yscr.flatten().tolist()):
-                XYZ.append([xf, yf, zs[xf, yf]])
-            XYZ = np.array(XYZ)
+            XYZ = np.array([xscr.flatten(), yscr.flatten(), screen[:, :, k].flatten()]).T
             a, b, c = fitPLaneLTSQ(XYZ)
             grad_plane = a * xscr + b * yscr + c
             gradient[:, :, k] = grad_plane
@@ -158,10 +160,9 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
             screen[:, :, k] = screen[:, :, k] - np.mean(screen[:, :, k])
 
             # Match fitted values to gradient-free screen
-            for t in range(fitted_tec1.shape[0]):
-                xs_pt = (x[t] * 1000.0 - lower[0]) / m_per_pix
-                ys_pt = (y[t] * 1000.0 - lower[1]) / m_per_pix
-                fitted_tec1[t, k] = screen[xs_pt, ys_pt, k] + residuals[t, k]
+            xs_pt = ((np.array(x) * 1000.0 - lower[0]) / m_per_pix).astype(int)
+            ys_pt = ((np.array(y) * 1000.0 - lower[1]) / m_per_pix).astype(int)
+            fitted_tec1[:, k] = screen[xs_pt, ys_pt, k] + residuals[:, k]
 
         pbar.update(ipbar)
         ipbar += 1
@@ -176,75 +177,120 @@ def make_tec_screen_plots(pp, tec_screen, residuals, station_positions,
         vmax = max_tec
 
     logging.info('Plotting TEC screens...')
-    fig, ax = plt.subplots(figsize=[7, 7])
+    def jobs():
+        for k in range(N_times):
+            yield [k, screen[:, :, k], gradient[:, :, k], fitted_tec1[:, k],
+                residuals[:, k], np.dot(pp[k, :, :], T), x, y, source_names,
+                N_stations, lower, upper, m_per_pix, vmin, vmax, remove_gradient,
+                show_source_names, root_dir+'/'+prestr+'frame%0.4i.png' % k, dpi]
+
+    if ncpu > 1 and N_times > 1:
+        mpm = multiprocManager(ncpu, _plot_tec_screen_frame)
+        results = mpm.imap(jobs())
+    else:
+        results = (_plot_tec_screen_frame(*job) for job in jobs())
+
     pbar = progressbar.ProgressBar(maxval=N_times).start()
-    ipbar = 0
+    for ipbar, k in enumerate(results):
+        pbar.update(ipbar)
+    pbar.finish()
+
+
+def _plot_tec_screen_frame(k, screen, gradient, fitted_tec1, residuals, pp1,
+    x, y, source_names, N_stations, lower, upper, m_per_pix, vmin, vmax,
+    remove_gradient, show_source_names, filename, dpi=None, outQueue=None):
+    """Renders a TEC screen frame
+
+    Keyword arguments:
+    k -- index of the frame
+    screen -- TEC screen image
+    gradient -- gradient removed from the screen
+    fitted_tec1 -- TEC values at the piercepoints
+    residuals -- TEC screen residuals at the piercepoints
+    pp1 -- projected piercepoint locations (m)
+    x, y -- projected piercepoint locations of the first timeslot (km)
+    source_names -- array of source names
+    N_stations -- number of stations
+    lower, upper -- image extent (m)
+    m_per_pix -- pixel size (m)
+    vmin, vmax -- TEC plot range
+    remove_gradient -- plot the removed gradient
+    show_source_names -- label sources on screen plots
+    filename -- output file name
+    dpi -- resolution of the output image
+    """
+    import numpy as np
+    # avoids error if re-setting "agg" a second run of plot
+    if not 'matplotlib' in sys.modules:
+        import matplotlib as mpl
+        mpl.rc('font',size =8 )
+        mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22 )
+        mpl.use("Agg")
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt # after setting "Agg" to speed up
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+
+    fig, ax = plt.subplots(figsize=[7, 7])
     sm = plt.cm.ScalarMappable(cmap=plt.cm.jet,
         norm=mpl.colors.Normalize(vmin=vmin, vmax=vmax))
     sm._A = []
-    plt.gca().set_aspect('equal')
 
-    for k in range(N_times):
-        s = []
-        c = []
-        for j in range(fitted_tec1.shape[0]):
-            fit_screen_diff = abs(residuals[j, k])
-            s.append(max(20*fit_screen_diff/0.01, 10))
-            c.append(sm.to_rgba(fitted_tec1[j, k]))
-
-        plt.clf()
-        im = plt.imshow(screen.transpose([1, 0, 2])[:, :, k],
+    s = np.maximum(20*abs(residuals)/0.01, 10)
+    c = sm.to_rgba(fitted_tec1)
+
+    im = plt.imshow(screen.transpose([1, 0]),
+        cmap = plt.cm.jet,
+        origin = 'lower',
+        interpolation = 'nearest',
+        extent = (lower[0]/1000.0, upper[0]/1000.0, lower[1]/1000.0, upper[1]/1000.0),
+        vmin=vmin, vmax=vmax)
+
+    cbar = plt.colorbar(im)
+    cbar.set_label('TECU', rotation=270)
+
+    plt.scatter(x, y, s=s, c=c)
+    if show_source_names:
+        labels = source_names
+        for label, xl, yl in zip(labels, x[0::N_stations], y[0::N_stations]):
+            plt.annotate(
+                label,
+                xy = (xl, yl), xytext = (-2, 2),
+                textcoords = 'offset points', ha = 'right', va = 'bottom')
+
+    plt.title('Screen {0}'.format(k))
+    plt.xlim(upper[0]/1000.0, lower[0]/1000.0)
+    plt.ylim(lower[1]/1000.0, upper[1]/1000.0)
+    plt.xlabel('Projected Distance along RA (km)')
+    plt.ylabel('Projected Distance along Dec (km)')
+
+    if remove_gradient:
+        min_xy = np.amin(pp1, axis=0)
+        max_xy = np.amax(pp1, axis=0)
+        extent = max_xy - min_xy
+        lowerk = min_xy - 0.05 * extent
+        upperk = max_xy + 0.05 * extent
+        xr = np.arange(lowerk[0], upperk[0], m_per_pix)
+        yr = np.arange(lowerk[1], upperk[1], m_per_pix)
+        axins = inset_axes(ax, width="15%", height="10%", loc=2)
+        axins.imshow(gradient.transpose([1, 0]),
             cmap = plt.cm.jet,
             origin = 'lower',
             interpolation = 'nearest',
-            extent = (lower[0]/1000.0, upper[0]/1000.0, lower[1]/1000.0, upper[1]/1000.0),
+            extent = (xr[0]/1000.0, xr[-1]/1000.0, yr[0]/1000.0, yr[-1]/1000.0),
             vmin=vmin, vmax=vmax)
+        plt.xticks(visible=False)
+        plt.yticks(visible=False)
+        axins.set_xlim(xr[-1]/1000.0, xr[0]/1000.0)
+        axins.set_ylim(yr[0]/1000.0, yr[-1]/1000.0)
 
-        cbar = plt.colorbar(im)
-        cbar.set_label('TECU', rotation=270)
-
-        plt.scatter(x, y, s=s, c=c)
-        if show_source_names:
-            labels = source_names
-            for label, xl, yl in zip(labels, x[0::N_stations], y[0::N_stations]):
-                plt.annotate(
-                    label,
-                    xy = (xl, yl), xytext = (-2, 2),
-                    textcoords = 'offset points', ha = 'right', va = 'bottom')
-
-        plt.title('Screen {0}'.format(k))
-        plt.xlim(upper[0]/1000.0, lower[0]/1000.0)
-        plt.ylim(lower[1]/1000.0, upper[1]/1000.0)
-        plt.xlabel('Projected Distance along RA (km)')
-        plt.ylabel('Projected Distance along Dec (km)')
-
-        if remove_gradient:
-            pp1 = np.dot(pp[k, :, :], T)
-            min_xy = np.amin(pp1, axis=0)
-            max_xy = np.amax(pp1, axis=0)
-            extent = max_xy - min_xy
-            lowerk = min_xy - 0.05 * extent
-            upperk = max_xy + 0.05 * extent
-            xr = np.arange(lowerk[0], upperk[0], m_per_pix)
-            yr = np.arange(lowerk[1], upperk[1], m_per_pix)
-            axins = inset_axes(ax, width="15%", height="10%", loc=2)
-            axins.imshow(gradient.transpose([1, 0, 2])[:, : ,k],
-                cmap = plt.cm.jet,
-                origin = 'lower',
-                interpolation = 'nearest',
-                extent = (xr[0]/1000.0, xr[-1]/1000.0, yr[0]/1000.0, yr[-1]/1000.0),
-                vmin=vmin, vmax=vmax)
-            plt.xticks(visible=False)
-            plt.yticks(visible=False)
-            axins.set_xlim(xr[-1]/1000.0, xr[0]/1000.0)
-            axins.set_ylim(yr[0]/1000.0, yr[-1]/1000.0)
-
-        plt.savefig(root_dir+'/'+prestr+'frame%0.4i.png' % k)
-        pbar.update(ipbar)
-        ipbar += 1
-    pbar.finish()
+    plt.savefig(filename, dpi=dpi)
     plt.close(fig)
 
+    if outQueue is not None:
+        outQueue.put(k)
+    else:
+        return k
+
 
 def fitPLaneLTSQ(XYZ):
     """Fits a plane to an XYZ point cloud
@@ -275,6 +321,11 @@ def run( step, parset, H ):
     minZ, maxZ = parset.getDoubleVector('.'.join(["LoSoTo.Steps", step, "MinMax"]), [0,0] )
     prefix = parset.getString('.'.join(["LoSoTo.Steps", step, "Prefix"]), '' )
     remove_gradient = parset.getBool('.'.join(["LoSoTo.Steps", step, "RemoveGradient"]), False )
+    preview = parset.getBool('.'.join(["LoSoTo.Steps", step, "Preview"]), False )
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 0 )
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
 
     # Plot various TEC-screen properties
 
@@ -320,6 +371,6 @@ def run( step, parset, H ):
             np.array(station_positions), np.array(source_names), times,
             height, order, beta_val, r_0, prefix=prefix,
             remove_gradient=remove_gradient, show_source_names=False, min_tec=min_tec,
-            max_tec=max_tec)
+            max_tec=max_tec, ncpu=ncpu, preview=preview)
 
     return 0
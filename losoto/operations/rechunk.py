@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This operation rewrites the tables with a chunk shape suited
+# to the way they are read by the following steps
+# WEIGHT: no need for weight
+
+import logging
+from losoto.operations_lib import *
+
+logging.debug('Loading RECHUNK module.')
+
+def run( step, parset, H ):
+    """
+    Rechunk the val/weight arrays of the soltabs.
+    If Axes is not given, the access axes are taken from the first
+    following step which iterates on the table (e.g. Axes of a FLAG step).
+    """
+    soltabs = getParSoltabs( step, parset, H )
+
+    accessAxes = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Axes"]), [] )
+    chunkShape = parset.getIntVector('.'.join(["LoSoTo.Steps", step, "ChunkShape"]), [] )
+
+    for soltab in openSoltabs( H, soltabs ):
+
+        logging.info("Rechunking soltab: "+soltab._v_name)
+
+        axesNames = soltab.val.attrs['AXES'].split(',')
+
+        if chunkShape != []:
+            if len(chunkShape) != len(axesNames):
+                logging.error('ChunkShape must have one value per axis: '+str(axesNames)+'.')
+                return 1
+            H.rechunkSoltab(soltab=soltab, chunkShape=chunkShape)
+            continue
+
+        thisAccessAxes = accessAxes
+        if thisAccessAxes == []:
+            thisAccessAxes = getParAccessAxes( step, parset, H, soltab._v_parent._v_name+'/'+soltab._v_name )
+            if thisAccessAxes is None:
+                logging.warning('No following step iterates on '+soltab._v_name+' and no Axes given. Using default chunking.')
+
+        for axis in thisAccessAxes or []:
+            if axis not in axesNames:
+                logging.warning('Axis \"'+axis+'\" not found. Ignoring.')
+
+        H.rechunkSoltab(soltab=soltab, accessAxes=thisAccessAxes)
+
+    return 0
@@ -14,13 +14,14 @@ def run( step, parset, H ):
 #    import scipy.ndimage.filters
     import numpy as np
     from losoto.h5parm import solFetcher, solWriter
-    from scipy.ndimage import generic_filter
 
     soltabs = getParSoltabs( step, parset, H )
 
     axesToSmooth = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Axes"]), [] )
     FWHM = parset.getIntVector('.'.join(["LoSoTo.Steps", step, "FWHM"]), [] )
     mode = parset.getString('.'.join(["LoSoTo.Steps", step, "Mode"]), "runningmedian" )
+    maxMemory = parset.getInt('.'.join(["LoSoTo.MaxMemory"]), 0 )
+    if maxMemory == 0: maxMemory = None
 
     if mode == "runningmedian" and len(axesToSmooth) != len(FWHM):
         logging.error("Axes and FWHM lenghts must be equal.")
@@ -36,8 +37,8 @@ def run( step, parset, H ):
 
         logging.info("Smoothing soltab: "+soltab._v_name)
 
-        sf = solFetcher(soltab)
-        sw = solWriter(soltab, useCache = True) # remember to flush!
+        sf = solFetcher(soltab, maxMemory = maxMemory)
+        sw = solWriter(soltab, useCache = True, maxMemory = maxMemory) # remember to flush!
 
         # axis selection
         userSel = {}
@@ -55,7 +56,7 @@ def run( step, parset, H ):
 
             if mode == 'runningmedian':
                 np.putmask(vals, weights==0, np.nan)
-                valsnew = generic_filter(vals, np.nanmedian, size=FWHM)
+                valsnew = runningMedian(vals, FWHM)
                 #valsnew = scipy.ndimage.filters.median_filter(vals, FWHM)
             elif mode == 'median':
                 valsnew = np.median( vals[(weights!=0)] )
@@ -65,8 +66,7 @@ def run( step, parset, H ):
                 logging.error('Mode must be: runningmedian, median or mean')
                 return 1
 
-            sw.selection = selection
-            sw.setValues(valsnew)
+            sw.bufferValues(valsnew, selection)
 
         sw.flush()
         sw.addHistory('SMOOTH (over %s with mode = %s)' % (axesToSmooth, mode))
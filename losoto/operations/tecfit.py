@@ -338,11 +338,13 @@ def average_phase(phase, nslots, times=None):
 
 
 def fit_tec_per_source_pair(phases, flags, mask, freqs, init_sols=None,
-    init_sols_per_pair=False, propagate=False, nband_min=2):
+    init_sols_per_pair=False, propagate=False, nband_min=2, ncpu=1):
     """Fits TEC values to phase solutions per source pair
 
     Returns TEC solutions as array of shape (N_sources, N_times, N_stations)
 
+    Source pairs are independent and are fitted in parallel on ncpu processes.
+
     Keyword arguments:
     phases -- array of phase solutions
     flags -- phase solution flags (0 = use, 1 = flagged)
@@ -352,84 +354,73 @@ def fit_tec_per_source_pair(phases, flags, mask, freqs, init_sols=None,
     init_sols_per_pair -- init_sols are per source pair (not per source)
     propagate -- propagate solutions from previous solution
     nband_min -- min number of bands for a source to be used
+    ncpu -- number of processes
     """
     from pylab import pinv, newaxis, find
     import numpy as np
-    from lofar.expion import baselinefitting
     try:
         import progressbar
     except ImportError:
         import losoto.progressbar as progressbar
 
-    sols_list = []
-    eq_list = []
     vars_list = []
     var_eq_list = []
 
     N_sources = phases.shape[0]
     N_stations = phases.shape[1]
     N_times = phases.shape[3]
-    N_pairs = 0
+    source_pairs = []
     for i in xrange(N_sources):
         for j in xrange(i):
             subband_selection = find(mask[i, :] * mask[j, :])
             if len(subband_selection) < nband_min:
                 continue
-            N_pairs += 1
+            source_pairs.append((i, j, subband_selection))
+    N_pairs = len(source_pairs)
 
     if init_sols is None and not init_sols_per_pair:
         init_sols = np.zeros((N_sources, N_times, N_stations), dtype = np.float)
     elif init_sols is None and init_sols_per_pair:
         init_sols = np.zeros((N_pairs, N_times, N_stations), dtype = np.float)
-    source_pairs = []
 
-    k = 0
-    ipbar = 0
-    logging.info('Fitting TEC values...')
-    pbar = progressbar.ProgressBar(maxval=N_pairs*N_times).start()
-    for i in xrange(N_sources):
-        for j in xrange(i):
-            subband_selection = find(mask[i, :] * mask[j, :])
-            if len(subband_selection) < nband_min:
-                continue
-            source_pairs.append((i, j))
+    def jobs():
+        for k, (i, j, subband_selection) in enumerate(source_pairs):
             p = phases[i, :, subband_selection, :] - phases[j, :, subband_selection, :]
             A = np.zeros((len(subband_selection), 1))
             A[:, 0] = 8.44797245e9/freqs[subband_selection]
 
             flags_source_pair = flags[i, :, subband_selection, :] * flags[j, :,
                 subband_selection, :]
-            constant_parms = np.zeros((1, N_stations), dtype = np.bool)
-            sols = np.zeros((N_times, N_stations), dtype = np.float)
 
+            # initial guesses for each timeslot (only the first is used if propagate)
             if init_sols_per_pair:
-                p_0 = init_sols[k, 0, :][newaxis, :]
+                p_0 = init_sols[k, :, :]
             else:
-                p_0 = (init_sols[i, 0, :] - init_sols[j, 0, :])[newaxis, :]
-
-            for t_idx in xrange(N_times):
-                x = p[:, :, t_idx].copy()
-                f = flags_source_pair[:, :, t_idx].copy()
-                if not propagate:
-                    if init_sols_per_pair:
-                        p_0 = init_sols[k, t_idx, :][newaxis, :]
-                    else:
-                        p_0 = (init_sols[i, t_idx, :] - init_sols[j, 0, :])[newaxis, :]
-                sol = baselinefitting.fit(x, A, p_0, f, constant_parms)
-                if propagate:
-                    p_0 = sol.copy()
-                sols[t_idx, :] = sol[0, :]
-                ipbar += 1
-                pbar.update(ipbar)
-            sols = sols[:, :] - np.mean(sols[:, :], axis=1)[:, newaxis]
-
-            weight = len(subband_selection)
-            sols_list.append(sols*weight)
-            eq = np.zeros(N_sources)
-            eq[i] = weight
-            eq[j] = -weight
-            eq_list.append(eq)
-            k += 1
+                p_0 = init_sols[i, :, :] - init_sols[j, 0, :][newaxis, :]
+
+            yield [k, p, A, flags_source_pair, p_0, propagate]
+
+    logging.info('Fitting TEC values...')
+    if ncpu > 1 and N_pairs > 1:
+        mpm = multiprocManager(ncpu, _fit_tec_pair)
+        results = mpm.imap(jobs())
+    else:
+        results = (_fit_tec_pair(*job) for job in jobs())
+
+    sols_list = [None] * N_pairs
+    eq_list = [None] * N_pairs
+    pbar = progressbar.ProgressBar(maxval=N_pairs*N_times).start()
+    for ipbar, (k, sols) in enumerate(results):
+        i, j, subband_selection = source_pairs[k]
+        sols = sols[:, :] - np.mean(sols[:, :], axis=1)[:, newaxis]
+
+        weight = len(subband_selection)
+        sols_list[k] = sols*weight
+        eq = np.zeros(N_sources)
+        eq[i] = weight
+        eq[j] = -weight
+        eq_list[k] = eq
+        pbar.update((ipbar+1)*N_times)
     pbar.finish()
 
     sols = np.array(sols_list)
@@ -446,15 +437,56 @@ def fit_tec_per_source_pair(phases, flags, mask, freqs, init_sols=None,
     return r, source_selection
 
 
+def _fit_tec_pair(k, p, A, flags_source_pair, p_0, propagate=False, outQueue=None):
+    """Fits TEC values to the phase differences of a source pair
+
+    Returns k and the TEC solutions as array of shape (N_times, N_stations)
+
+    Keyword arguments:
+    k -- index of the source pair
+    p -- array of phase differences (N_freqs, N_stations, N_times)
+    A -- design matrix (N_freqs, 1)
+    flags_source_pair -- flags of the phase differences (0 = use, 1 = flagged)
+    p_0 -- initial guesses (N_times, N_stations), only the first is used if
+        propagate is True
+    propagate -- propagate solutions from previous solution
+    """
+    import numpy as np
+    from lofar.expion import baselinefitting
+
+    N_freqs, N_stations, N_times = p.shape
+    sols = np.zeros((N_times, N_stations), dtype = np.float)
+
+    constant_parms = np.zeros((1, N_stations), dtype = np.bool)
+    p_0_t = p_0[0:1, :]
+    for t_idx in xrange(N_times):
+        x = p[:, :, t_idx].copy()
+        f = flags_source_pair[:, :, t_idx].copy()
+        if not propagate:
+            p_0_t = p_0[t_idx:t_idx+1, :]
+        sol = baselinefitting.fit(x, A, p_0_t, f, constant_parms)
+        if propagate:
+            p_0_t = sol.copy()
+        sols[t_idx, :] = sol[0, :]
+
+    if outQueue is not None:
+        outQueue.put([k, sols])
+    else:
+        return k, sols
+
+
 def add_stations(station_selection, phases0, phases1, flags, mask,
     station_names, station_positions, source_names, source_selection,
     times, freqs, r, nband_min=2, soln_type='phase', nstations_max=None,
     excluded_stations=None, t_step=5, tec_step1=5, tec_step2=21,
-    search_full_tec_range=True):
+    search_full_tec_range=True, ncpu=1):
     """
     Adds stations to TEC fitting using an iterative initial-guess search to
     ensure the global min is found
 
+    For each added station, source pairs are fitted in parallel on ncpu
+    processes.
+
     Keyword arguments:
     station_selection -- indices of stations to use in fitting
     phases0 -- XX phase solutions
@@ -475,10 +507,10 @@ def add_stations(station_selection, phases0, phases1, flags, mask,
     tec_step1 -- number of steps in TEC subrange (+/- last TEC fit value)
     tec_step2 -- number of steps in full TEC range (-0.1 -- 0.1)
     search_full_tec_range -- always search the full TEC range (-0.1 -- 0.1)
+    ncpu -- number of processes
     """
     from pylab import pinv, newaxis, find, amin
     import numpy as np
-    from lofar.expion import baselinefitting
     try:
         import progressbar
     except ImportError:
@@ -534,161 +566,55 @@ def add_stations(station_selection, phases0, phases1, flags, mask,
         eq_list = []
         min_e_list = []
 
-        ipbar = 0
         logging.info('Fitting TEC values with {0} included...'.format(
             station_names[station_to_add]))
-        pbar = progressbar.ProgressBar(maxval=N_pairs*N_times).start()
-        for ii, i in enumerate(source_selection):
-            for jj, j in enumerate(source_selection):
-                if j == i:
-                    break
-                subband_selection = find(mask[i,:] * mask[j,:])
-                if len(subband_selection) < nband_min:
-                    continue
-                logging.debug('Adding {0} for source pair: {1}-{2}'.format(
-                    station_names[station_to_add], i, j))
-                p0 = phases0[i, station_selection1[:,newaxis],
-                    subband_selection[newaxis,:], :] - phases0[j,
-                    station_selection1[:,newaxis], subband_selection[newaxis,:], :]
-                p0 = p0 - np.mean(p0, axis=0)[newaxis,:,:]
-                if soln_type != 'scalarphase':
-                    p1 = phases1[i, station_selection1[:,newaxis],
-                        subband_selection[newaxis,:], :] - phases1[j,
+
+        def jobs():
+            for ii, i in enumerate(source_selection):
+                for jj, j in enumerate(source_selection):
+                    if j == i:
+                        break
+                    subband_selection = find(mask[i,:] * mask[j,:])
+                    if len(subband_selection) < nband_min:
+                        continue
+                    logging.debug('Adding {0} for source pair: {1}-{2}'.format(
+                        station_names[station_to_add], i, j))
+                    p0 = phases0[i, station_selection1[:,newaxis],
+                        subband_selection[newaxis,:], :] - phases0[j,
                         station_selection1[:,newaxis], subband_selection[newaxis,:], :]
-                    p1 = p1 - np.mean(p1, axis=0)[newaxis, :, :]
-                A = np.zeros((len(subband_selection), 1))
-                A[:, 0] = 8.44797245e9 / freqs[subband_selection]
-                sd = (0.1 * 30e6) / freqs[subband_selection] # standard deviation of phase solutions as function of frequency (rad)
-
-                flags_source_pair = flags[i, station_selection1[:,newaxis],
-                    subband_selection[newaxis,:], :] * flags[j,
-                    station_selection1[:,newaxis], subband_selection[newaxis,:], :]
-                constant_parms = np.zeros((1, N_stations_selected1), dtype = np.bool)
-                sols = np.zeros((N_times, N_stations_selected1), dtype = np.float)
-                p_0_best = None
-                for t_idx in xrange(N_times):
-                    if np.mod(t_idx, t_step) == 0:
-                        min_e = np.Inf
-                        if p_0_best is not None and not search_full_tec_range:
-                            min_tec = p_0_best[0, -1] - 0.02
-                            max_tec = p_0_best[0, -1] + 0.02
-                            nsteps = tec_step1
-                        else:
-                            min_tec = -0.1
-                            max_tec = 0.1
-                            nsteps = tec_step2
-                        logging.debug('  Trying initial guesses between {0} and '
-                            '{1} TECU'.format(min_tec, max_tec))
-                        for offset in np.linspace(min_tec, max_tec, nsteps):
-                            p_0 = np.zeros((1, N_stations_selected1), np.double)
-                            p_0[0, :N_stations_selected1-1] = (q[ii, t_idx, :] -
-                                q[jj, t_idx, :])[newaxis,:]
-                            p_0[0, -1] = offset
-
-                            x = p0[:,:,t_idx].copy()
-                            f = flags_source_pair[:, :, t_idx].copy()
-                            sol0 = baselinefitting.fit(x.T, A, p_0, f, constant_parms)
-                            sol0 -= np.mean(sol0)
-                            residual = np.mod(np.dot(A, sol0) - x.T + np.pi,
-                                2 * np.pi) - np.pi
-                            e = np.var(residual[f.T==0])
-
-                            if soln_type != 'scalarphase':
-                                x = p1[:,:,t_idx].copy()
-                                f = flags_source_pair[:, :, t_idx].copy()
-                                sol1 = baselinefitting.fit(x.T, A, p_0, f,
-                                    constant_parms)
-                                sol1 -= np.mean(sol1)
-                                residual = np.mod(np.dot(A, sol1) - x.T + np.pi,
-                                    2 * np.pi) - np.pi
-                                residual = residual[f.T==0]
-                                e += np.var(residual)
-                            else:
-                                sol1 = sol0
-
-                            if e < min_e:
-                                logging.debug('  Found new min variance of {0} '
-                                    'with initial guess of {1} TECU'.format(e,
-                                    p_0[0, -1]))
-                                min_e = e
-                                p_0_best = p_0
-                                sols[t_idx, :] = (sol0[0, :] + sol1[0, :])/2
+                    p0 = p0 - np.mean(p0, axis=0)[newaxis,:,:]
+                    if soln_type != 'scalarphase':
+                        p1 = phases1[i, station_selection1[:,newaxis],
+                            subband_selection[newaxis,:], :] - phases1[j,
+                            station_selection1[:,newaxis], subband_selection[newaxis,:], :]
+                        p1 = p1 - np.mean(p1, axis=0)[newaxis, :, :]
                     else:
-                        # Use previous init
-                        x = p0[:, :, t_idx].copy()
-                        f = flags_source_pair[:, :, t_idx].copy()
-                        sol0 = baselinefitting.fit(x.T, A, p_0_best, f,
-                            constant_parms)
-                        sol0 -= np.mean(sol0)
-
-                        if soln_type != 'scalarphase':
-                            x = p1[:, :, t_idx].copy()
-                            f = flags_source_pair[:, :, t_idx].copy()
-                            sol1 = baselinefitting.fit(x.T, A, p_0_best, f,
-                                constant_parms)
-                            sol1 -= np.mean(sol1)
-                        else:
-                            sol1 = sol0
-                        sols[t_idx, :] = (sol0[0, :] + sol1[0, :])/2
-
-                    ipbar += 1
-                    pbar.update(ipbar)
-
-                ### Remove outliers
-                logging.debug('  Searching for outliers...')
-                for kk in xrange(10):
-                    s = sols[:, -1].copy()
-                    selection = np.zeros(len(s), np.bool)
-                    for t_idx in xrange(len(s)):
-                        start_idx = np.max([t_idx-10, 0])
-                        end_idx = np.min([t_idx+10, len(s)])
-                        selection[t_idx] = np.sum(abs(s[start_idx:end_idx] -
-                            s[t_idx]) < 0.02) > (end_idx - start_idx - 8)
-                    outliers = find(np.logical_not(selection))
-                    if len(outliers) == 0:
-                        break
-                    for t_idx in outliers:
-                        try:
-                            idx0 = find(selection[:t_idx])[-1]
-                        except IndexError:
-                            idx0 = -1
-                        try:
-                            idx1 = find(selection[t_idx+1:])[0] + t_idx + 1
-                        except IndexError:
-                            idx1 = -1
-                        if idx0 == -1:
-                            s[t_idx] = s[idx1]
-                        elif idx1 == -1:
-                            s[t_idx] = s[idx0]
-                        else:
-                            s[t_idx] = (s[idx0] * (idx1-t_idx) + s[idx1] *
-                                (t_idx-idx0)) / (idx1-idx0)
-
-                        p_0 = np.zeros((1, N_stations_selected1), np.double)
-                        p_0[0,:] = sols[t_idx,:]
-                        p_0[0,-1] = s[t_idx]
-
-                        x = p0[:,:,t_idx].copy()
-                        f = flags_source_pair[:,:,t_idx].copy()
-                        sol0 = baselinefitting.fit(x.T, A, p_0, f, constant_parms)
-                        sol0 -= np.mean(sol0)
-
-                        if soln_type != 'scalarphase':
-                            x = p1[:,:,t_idx].copy()
-                            sol1 = baselinefitting.fit(x.T, A, p_0, f,
-                                constant_parms)
-                            sol1 -= np.mean(sol1)
-                        else:
-                            sol1 = sol0
-                        sols[t_idx, :] = (sol0[0,:] + sol1[0,:])/2
+                        p1 = None
+                    A = np.zeros((len(subband_selection), 1))
+                    A[:, 0] = 8.44797245e9 / freqs[subband_selection]
 
-                weight = 1.0
-                sols_list.append(weight*sols)
-                min_e_list.append(min_e)
-                eq = np.zeros(N_sources)
-                eq[ii] = weight
-                eq[jj] = -weight
-                eq_list.append(eq)
+                    flags_source_pair = flags[i, station_selection1[:,newaxis],
+                        subband_selection[newaxis,:], :] * flags[j,
+                        station_selection1[:,newaxis], subband_selection[newaxis,:], :]
+                    yield [ii, jj, p0, p1, A, flags_source_pair, q[ii, :, :] - q[jj, :, :],
+                        t_step, tec_step1, tec_step2, search_full_tec_range]
+
+        if ncpu > 1 and N_pairs > 1:
+            mpm = multiprocManager(ncpu, _add_station_pair)
+            results = mpm.imap(jobs())
+        else:
+            results = (_add_station_pair(*job) for job in jobs())
+
+        pbar = progressbar.ProgressBar(maxval=N_pairs*N_times).start()
+        for ipair, (ii, jj, sols, min_e) in enumerate(results):
+            weight = 1.0
+            sols_list.append(weight*sols)
+            min_e_list.append(min_e)
+            eq = np.zeros(N_sources)
+            eq[ii] = weight
+            eq[jj] = -weight
+            eq_list.append(eq)
+            pbar.update((ipair+1)*N_times)
 
         sols = np.array(sols_list)
         B = np.array(eq_list)
@@ -704,6 +630,155 @@ def add_stations(station_selection, phases0, phases1, flags, mask,
     return station_selection1, q
 
 
+def _add_station_pair(ii, jj, p0, p1, A, flags_source_pair, q_diff, t_step=5,
+    tec_step1=5, tec_step2=21, search_full_tec_range=True, outQueue=None):
+    """
+    Fits TEC values of a source pair with the added station (last one) using an
+    iterative initial-guess search
+
+    Returns ii, jj, the TEC solutions (N_times, N_stations) and the min variance
+    of the last initial-guess search
+
+    Keyword arguments:
+    ii, jj -- indices of the sources of the pair in the source selection
+    p0 -- XX phase differences (N_stations, N_freqs, N_times)
+    p1 -- YY phase differences (None for scalarphase)
+    A -- design matrix (N_freqs, 1)
+    flags_source_pair -- flags of the phase differences (0 = use, 1 = flagged)
+    q_diff -- TEC differences of the previous fit (N_times, N_stations-1)
+    t_step -- try full TEC range every t_step number of solution times
+    tec_step1 -- number of steps in TEC subrange (+/- last TEC fit value)
+    tec_step2 -- number of steps in full TEC range (-0.1 -- 0.1)
+    search_full_tec_range -- always search the full TEC range (-0.1 -- 0.1)
+    """
+    from pylab import find
+    import numpy as np
+    from lofar.expion import baselinefitting
+
+    N_stations_selected1, N_freqs, N_times = p0.shape
+    constant_parms = np.zeros((1, N_stations_selected1), dtype = np.bool)
+    sols = np.zeros((N_times, N_stations_selected1), dtype = np.float)
+    min_e = np.Inf
+    p_0_best = None
+    for t_idx in xrange(N_times):
+        f = flags_source_pair[:, :, t_idx].copy()
+        if np.mod(t_idx, t_step) == 0:
+            min_e = np.Inf
+            if p_0_best is not None and not search_full_tec_range:
+                min_tec = p_0_best[0, -1] - 0.02
+                max_tec = p_0_best[0, -1] + 0.02
+                nsteps = tec_step1
+            else:
+                min_tec = -0.1
+                max_tec = 0.1
+                nsteps = tec_step2
+            logging.debug('  Trying initial guesses between {0} and '
+                '{1} TECU'.format(min_tec, max_tec))
+            offsets = np.linspace(min_tec, max_tec, nsteps)
+            p_0s = np.zeros((nsteps, 1, N_stations_selected1), np.double)
+            p_0s[:, 0, :N_stations_selected1-1] = q_diff[t_idx, :]
+            p_0s[:, 0, -1] = offsets
+
+            # baselinefitting.fit() takes a single initial guess, so the guesses
+            # are fitted one by one; the wrapped residuals and their variance
+            # over the unflagged data are then computed for all of them at once
+            unflagged = (f.T == 0)
+            x0 = p0[:, :, t_idx].copy()
+            sol0s = np.array([baselinefitting.fit(x0.T, A, p_0, f.copy(), constant_parms) for p_0 in p_0s])
+            sol0s -= np.mean(sol0s, axis=(1, 2))[:, np.newaxis, np.newaxis]
+            residual = np.mod(A[np.newaxis] * sol0s - x0.T[np.newaxis] + np.pi,
+                2 * np.pi) - np.pi
+            e = np.var(residual[:, unflagged], axis=1)
+
+            if p1 is not None:
+                x1 = p1[:, :, t_idx].copy()
+                sol1s = np.array([baselinefitting.fit(x1.T, A, p_0, f.copy(), constant_parms) for p_0 in p_0s])
+                sol1s -= np.mean(sol1s, axis=(1, 2))[:, np.newaxis, np.newaxis]
+                residual = np.mod(A[np.newaxis] * sol1s - x1.T[np.newaxis] + np.pi,
+                    2 * np.pi) - np.pi
+                e += np.var(residual[:, unflagged], axis=1)
+            else:
+                sol1s = sol0s
+
+            # first initial guess with the min variance
+            for k in xrange(nsteps):
+                if e[k] < min_e:
+                    min_e = e[k]
+                    p_0_best = p_0s[k]
+                    sols[t_idx, :] = (sol0s[k, 0, :] + sol1s[k, 0, :])/2
+            if p_0_best is not None:
+                logging.debug('  Found min variance of {0} with initial guess '
+                    'of {1} TECU'.format(min_e, p_0_best[0, -1]))
+        else:
+            # Use previous init
+            x = p0[:, :, t_idx].copy()
+            sol0 = baselinefitting.fit(x.T, A, p_0_best, f.copy(),
+                constant_parms)
+            sol0 -= np.mean(sol0)
+
+            if p1 is not None:
+                x = p1[:, :, t_idx].copy()
+                sol1 = baselinefitting.fit(x.T, A, p_0_best, f.copy(),
+                    constant_parms)
+                sol1 -= np.mean(sol1)
+            else:
+                sol1 = sol0
+            sols[t_idx, :] = (sol0[0, :] + sol1[0, :])/2
+
+    ### Remove outliers
+    logging.debug('  Searching for outliers...')
+    for kk in xrange(10):
+        s = sols[:, -1].copy()
+        selection = np.zeros(len(s), np.bool)
+        for t_idx in xrange(len(s)):
+            start_idx = np.max([t_idx-10, 0])
+            end_idx = np.min([t_idx+10, len(s)])
+            selection[t_idx] = np.sum(abs(s[start_idx:end_idx] -
+                s[t_idx]) < 0.02) > (end_idx - start_idx - 8)
+        outliers = find(np.logical_not(selection))
+        if len(outliers) == 0:
+            break
+        for t_idx in outliers:
+            try:
+                idx0 = find(selection[:t_idx])[-1]
+            except IndexError:
+                idx0 = -1
+            try:
+                idx1 = find(selection[t_idx+1:])[0] + t_idx + 1
+            except IndexError:
+                idx1 = -1
+            if idx0 == -1:
+                s[t_idx] = s[idx1]
+            elif idx1 == -1:
+                s[t_idx] = s[idx0]
+            else:
+                s[t_idx] = (s[idx0] * (idx1-t_idx) + s[idx1] *
+                    (t_idx-idx0)) / (idx1-idx0)
+
+            p_0 = np.zeros((1, N_stations_selected1), np.double)
+            p_0[0,:] = sols[t_idx,:]
+            p_0[0,-1] = s[t_idx]
+
+            x = p0[:,:,t_idx].copy()
+            f = flags_source_pair[:,:,t_idx].copy()
+            sol0 = baselinefitting.fit(x.T, A, p_0, f, constant_parms)
+            sol0 -= np.mean(sol0)
+
+            if p1 is not None:
+                x = p1[:,:,t_idx].copy()
+                sol1 = baselinefitting.fit(x.T, A, p_0, f,
+                    constant_parms)
+                sol1 -= np.mean(sol1)
+            else:
+                sol1 = sol0
+            sols[t_idx, :] = (sol0[0,:] + sol1[0,:])/2
+
+    if outQueue is not None:
+        outQueue.put([ii, jj, sols, min_e])
+    else:
+        return [ii, jj, sols, min_e]
+
+
 def run( step, parset, H ):
     """
     Fit phase solutions to obtain TEC values per direction.
@@ -746,6 +821,10 @@ def run( step, parset, H ):
     nstations_max = int(parset.getString('.'.join(["LoSoTo.Steps", step, "MaxStations"]), '100' ))
     outSolset = parset.getString('.'.join(["LoSoTo.Steps", step, "OutSoltab"]), '' ).split('/')[0]
     outSoltab = parset.getString('.'.join(["LoSoTo.Steps", step, "OutSoltab"]), '' ).split('/')[1]
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 0 )
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
 
     # Collect solutions, etc. into arrays for fitting.
     (phases0, phases1, flags, mask, station_names, station_positions,
@@ -849,18 +928,18 @@ def run( step, parset, H ):
             r, source_selection = fit_tec_per_source_pair(
                 phases0[:, station_selection, :, :],
                 flags[:, station_selection, :, :],
-                mask, freqs, propagate=True, nband_min=nband_min)
+                mask, freqs, propagate=True, nband_min=nband_min, ncpu=ncpu)
             if r is None:
                 return 1
         else:
             r0, source_selection = fit_tec_per_source_pair(
                 phases0[:, station_selection, :, :],
                 flags[:, station_selection, :, :],
-                mask, freqs, propagate=True, nband_min=nband_min)
+                mask, freqs, propagate=True, nband_min=nband_min, ncpu=ncpu)
             r1, source_selection = fit_tec_per_source_pair(
                 phases1[:, station_selection, :, :],
                 flags[:, station_selection, :, :],
-                mask, freqs, propagate=True, nband_min=nband_min)
+                mask, freqs, propagate=True, nband_min=nband_min, ncpu=ncpu)
             if r0 is None or r1 is None:
                 return 1
 
@@ -872,7 +951,7 @@ def run( step, parset, H ):
         phases1, flags, mask, station_names, station_positions, source_names,
         source_selection, times, freqs, r, nband_min=nband_min,
         soln_type=soln_type, nstations_max=nstations_max, excluded_stations=
-        excluded_stations, search_full_tec_range=False)
+        excluded_stations, search_full_tec_range=False, ncpu=ncpu)
 
     # Save TEC values to the output solset
     solset = H.makeSolset(outSolset)
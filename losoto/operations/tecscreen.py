@@ -9,16 +9,15 @@ from losoto.operations_lib import *
 logging.debug('Loading TECSCREEN module.')
 
 
-def calculate_piercepoints(station_positions, source_positions, times, height = 200e3):
+def calculate_directions(station_positions, source_positions, times):
     """
-    Returns array of piercepoint locations and airmass values for a
-    screen at the given height (in m)
+    Returns array of the ITRF directions (unit vectors) of the sources
+    as seen from the first station, with shape times x sources x 3
 
     Keyword arguments:
     station_positions -- array of station positions
     source_positions -- array of source positions
     times -- array of times
-    height -- height of screen (m)
     """
     import pyrap.measures
     import numpy as np
@@ -27,10 +26,7 @@ def calculate_piercepoints(station_positions, source_positions, times, height =
     except ImportError:
         import losoto.progressbar as progressbar
 
-    logging.info('Calculating screen pierce-point locations and airmass values...')
     N_sources = source_positions.shape[0]
-    N_stations = station_positions.shape[0]
-    N_piercepoints = N_stations * N_sources
     N_times = len(times)
 
     me = pyrap.measures.measures()
@@ -38,15 +34,13 @@ def calculate_piercepoints(station_positions, source_positions, times, height =
         '%fm' % station_positions[0,1], '%fm' % station_positions[0,2])
     me.doframe(position)
 
-    pp = np.zeros((N_times, N_piercepoints,3))
-    airmass = np.zeros((N_times, N_piercepoints))
+    directions = np.zeros((N_times, N_sources, 3))
 
     pbar = progressbar.ProgressBar(maxval=N_times).start()
     ipbar = 0
     for k in range(N_times):
         epoch = me.epoch('UTC', '%fs' % times[k])
         me.doframe(epoch)
-        pp_idx = 0
         for i in range(N_sources):
             ra = source_positions[i,0]
             dec = source_positions[i,1]
@@ -57,16 +51,46 @@ def calculate_piercepoints(station_positions, source_positions, times, height =
             dx = np.cos(theta)*np.cos(phi)
             dy = np.cos(theta)*np.sin(phi)
             dz = np.sin(theta)
-            direction = np.array((dx,dy,dz))
-            for station_position in station_positions:
-                pp[k, pp_idx, :], airmass[k, pp_idx] = calc_piercepoint(
-                    station_position, direction, height)
-                pp_idx += 1
+            directions[k, i, :] = (dx,dy,dz)
         pbar.update(ipbar)
         ipbar += 1
     pbar.finish()
 
-    return pp, airmass
+    return directions
+
+
+def calculate_piercepoints(station_positions, source_positions, times, height = 200e3, directions = None):
+    """
+    Returns array of piercepoint locations and airmass values for a
+    screen at the given height (in m)
+
+    Piercepoints are computed for all times, sources and stations at once.
+    The source directions can be computed once with calculate_directions()
+    and passed in, e.g. when trying several heights.
+
+    Keyword arguments:
+    station_positions -- array of station positions
+    source_positions -- array of source positions
+    times -- array of times
+    height -- height of screen (m)
+    directions -- source directions from calculate_directions() (default: computed here)
+    """
+    import numpy as np
+
+    logging.info('Calculating screen pierce-point locations and airmass values...')
+    N_sources = source_positions.shape[0]
+    N_stations = station_positions.shape[0]
+    N_piercepoints = N_stations * N_sources
+    N_times = len(times)
+
+    if directions is None:
+        directions = calculate_directions(station_positions, source_positions, times)
+
+    # times x sources x stations
+    pp, airmass = calc_piercepoint(station_positions[np.newaxis, np.newaxis, :, :],
+        directions[:, :, np.newaxis, :], height)
+
+    return pp.reshape((N_times, N_piercepoints, 3)), airmass.reshape((N_times, N_piercepoints))
 
 
 def calc_piercepoint(pos, direction, height):
@@ -74,13 +98,17 @@ def calc_piercepoint(pos, direction, height):
     Calculates pierce point locations and airmass values for given station
     position, source direction, and height (in m)
 
+    Positions and directions can be arrays of 3-vectors (last axis) which are
+    broadcast against each other.
+
     Keyword arguments:
     pos -- array of station positions
     direction -- array of source directions
     height -- height of screen (m)
     """
     import numpy as np
-    pp = np.zeros(3)
+    pos = np.asarray(pos, dtype=float)
+    direction = np.asarray(direction, dtype=float)
     earth_ellipsoid_a = 6378137.0
     earth_ellipsoid_a2 = earth_ellipsoid_a * earth_ellipsoid_a
     earth_ellipsoid_b = 6356752.3142
@@ -92,21 +120,21 @@ def calc_piercepoint(pos, direction, height):
     ion_ellipsoid_b = earth_ellipsoid_b + height
     ion_ellipsoid_b2_inv = 1.0 / (ion_ellipsoid_b * ion_ellipsoid_b)
 
-    x = pos[0] / ion_ellipsoid_a
-    y = pos[1] / ion_ellipsoid_a
-    z = pos[2] / ion_ellipsoid_b
+    x = pos[..., 0] / ion_ellipsoid_a
+    y = pos[..., 1] / ion_ellipsoid_a
+    z = pos[..., 2] / ion_ellipsoid_b
     c = x*x + y*y + z*z - 1.0
 
-    dx = direction[0] / ion_ellipsoid_a
-    dy = direction[1] / ion_ellipsoid_a
-    dz = direction[2] / ion_ellipsoid_b
+    dx = direction[..., 0] / ion_ellipsoid_a
+    dy = direction[..., 1] / ion_ellipsoid_a
+    dz = direction[..., 2] / ion_ellipsoid_b
     a = dx*dx + dy*dy + dz*dz
     b = x*dx + y*dy  + z*dz
     alpha = (-b + np.sqrt(b*b - a*c)) / a
-    pp = pos[0] + alpha * direction
-    normal_x = pp[0] * ion_ellipsoid_a2_inv
-    normal_y = pp[1] * ion_ellipsoid_a2_inv
-    normal_z = pp[2] * ion_ellipsoid_b2_inv
+    pp = pos[..., 0:1] + alpha[..., np.newaxis] * direction
+    normal_x = pp[..., 0] * ion_ellipsoid_a2_inv
+    normal_y = pp[..., 1] * ion_ellipsoid_a2_inv
+    normal_z = pp[..., 2] * ion_ellipsoid_b2_inv
     norm_normal2 = normal_x*normal_x + normal_y*normal_y + normal_z*normal_z
     norm_normal = np.sqrt(norm_normal2)
     sin_lat2 = normal_z*normal_z / norm_normal2
@@ -122,38 +150,41 @@ def calc_piercepoint(pos, direction, height):
     z_offset = ((1.0 - earth_ellipsoid_e2) * N + height - (1.0 -
         local_ion_ellipsoid_e2) * (N+height)) * np.sqrt(sin_lat2)
 
-    x1 = pos[0] / local_ion_ellipsoid_a
-    y1 = pos[1] / local_ion_ellipsoid_a
-    z1 = (pos[2] - z_offset) / local_ion_ellipsoid_b
+    x1 = pos[..., 0] / local_ion_ellipsoid_a
+    y1 = pos[..., 1] / local_ion_ellipsoid_a
+    z1 = (pos[..., 2] - z_offset) / local_ion_ellipsoid_b
     c1 = x1*x1 + y1*y1 + z1*z1 - 1.0
 
-    dx = direction[0] / local_ion_ellipsoid_a
-    dy = direction[1] / local_ion_ellipsoid_a
-    dz = direction[2] / local_ion_ellipsoid_b
+    dx = direction[..., 0] / local_ion_ellipsoid_a
+    dy = direction[..., 1] / local_ion_ellipsoid_a
+    dz = direction[..., 2] / local_ion_ellipsoid_b
     a = dx*dx + dy*dy + dz*dz
     b = x1*dx + y1*dy  + z1*dz
     alpha = (-b + np.sqrt(b*b - a*c1)) / a
 
-    pp = pos + alpha * direction
+    pp = pos + alpha[..., np.newaxis] * direction
 
-    normal_x = pp[0] * ion_ellipsoid_a2_inv
-    normal_y = pp[1] * ion_ellipsoid_a2_inv
-    normal_z = (pp[2] - z_offset) * ion_ellipsoid_b2_inv
+    normal_x = pp[..., 0] * ion_ellipsoid_a2_inv
+    normal_y = pp[..., 1] * ion_ellipsoid_a2_inv
+    normal_z = (pp[..., 2] - z_offset) * ion_ellipsoid_b2_inv
 
     norm_normal2 = normal_x*normal_x + normal_y*normal_y + normal_z*normal_z
     norm_normal = np.sqrt(norm_normal2)
 
-    airmass = norm_normal / (direction[0]*normal_x + direction[1]*normal_y +
-        direction[2]*normal_z)
+    airmass = norm_normal / (direction[..., 0]*normal_x + direction[..., 1]*normal_y +
+        direction[..., 2]*normal_z)
 
     return pp, airmass
 
 
 def fit_screen_to_tec(station_names, source_names, pp, airmass, rr, times,
-    height, order, r_0, beta):
+    height, order, r_0, beta, ncpu=1, pp_tol=0.):
     """
     Fits a screen to given TEC values using Karhunen-Lo`eve base vectors
 
+    Timeslots are fitted in blocks with stacked linear algebra, blocks are
+    distributed over ncpu processes.
+
     Keyword arguments:
     station_names -- array of station names
     source_names -- array of source names
@@ -166,9 +197,12 @@ def fit_screen_to_tec(station_names, source_names, pp, airmass, rr, times,
     r_0 -- scale size of phase fluctuations (m)
     beta -- power-law index for phase structure function (5/3 =>
         pure Kolmogorov turbulence)
+    ncpu -- number of processes
+    pp_tol -- KL base vectors are reused for the following timeslots as long as
+        no pierce point moved more than this (m)
     """
     import numpy as np
-    from pylab import kron, concatenate, pinv, norm, newaxis, find, amin, svd, eye
+    from pylab import kron, concatenate, pinv, eye
     try:
         import progressbar
     except ImportError:
@@ -188,40 +222,115 @@ def fit_screen_to_tec(station_names, source_names, pp, airmass, rr, times,
     N_piercepoints = N_sources * N_stations
     P = eye(N_piercepoints) - np.dot(np.dot(A, pinv(np.dot(A.T, A))), A.T)
 
-    pbar = progressbar.ProgressBar(maxval=N_times).start()
-    ipbar = 0
-    for k in range(N_times):
-        try:
-            D = np.resize(pp[k, :, :], (N_piercepoints, N_piercepoints, 3))
-            D = np.transpose(D, (1, 0, 2)) - D
-            D2 = np.sum(D**2, axis=2)
-            C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
-            P1 = eye(N_piercepoints) - np.ones((N_piercepoints, N_piercepoints)) / N_piercepoints
-            C1 = np.dot(np.dot(P1, C), P1)
-            U, S, V = svd(C1)
-
-            B = np.dot(P, np.dot(np.diag(airmass[k, :]), U[:, :order]))
-            pinvB = pinv(B, rcond=1e-3)
-
-            rr1 = np.dot(P, rr[:, k])
-            tec_fit = np.dot(U[:, :order], np.dot(pinvB, rr1))
-            tec_fit_all[k, :, :] = tec_fit.reshape((N_sources, N_stations))
-
-            residual = rr1 - np.dot(P, tec_fit)
-            residual_all[k, :, :] = residual.reshape((N_sources, N_stations))
-        except:
-            # Set screen to zero if fit did not work
-            logging.debug('Tecscreen fit failed for timeslot {0}'.format(k))
-            tec_fit_all[k, :, :] = np.zeros((N_sources, N_stations))
-            residual_all[k, :, :] = np.ones((N_sources, N_stations))
+    # limit the size of the stacked N_piercepoints x N_piercepoints matrices
+    blockLen = max(1, 2**24 // (5 * N_piercepoints**2))
+    if ncpu > 1: blockLen = min(blockLen, max(1, N_times // (4 * ncpu)))
+    blocks = [(k, min(k + blockLen, N_times)) for k in range(0, N_times, blockLen)]
+    jobs = ([pp[k0:k1], airmass[k0:k1], rr[:, k0:k1], P, order, r_0, beta, pp_tol, k0] for k0, k1 in blocks)
 
-        pbar.update(ipbar)
-        ipbar += 1
+    if ncpu > 1 and len(blocks) > 1:
+        mpm = multiprocManager(ncpu, _fit_screen_block)
+        results = mpm.imap(jobs)
+    else:
+        results = (_fit_screen_block(*job) for job in jobs)
+
+    pbar = progressbar.ProgressBar(maxval=N_times).start()
+    nDone = 0
+    for k0, tec_fit, residual in results:
+        k1 = k0 + tec_fit.shape[0]
+        tec_fit_all[k0:k1, :, :] = tec_fit.reshape((k1 - k0, N_sources, N_stations))
+        residual_all[k0:k1, :, :] = residual.reshape((k1 - k0, N_sources, N_stations))
+        nDone += k1 - k0
+        pbar.update(nDone)
     pbar.finish()
 
     return tec_fit_all, residual_all
 
 
+def _screen_basis(pp, order, r_0, beta):
+    """
+    Returns the first "order" KL base vectors for each set of pierce points
+
+    Keyword arguments:
+    pp -- array of piercepoint locations (times x piercepoints x 3)
+    order -- order of screen (i.e., number of KL base vectors to keep)
+    r_0 -- scale size of phase fluctuations (m)
+    beta -- power-law index for phase structure function
+    """
+    import numpy as np
+
+    D2 = np.sum((pp[:, :, np.newaxis, :] - pp[:, np.newaxis, :, :])**2, axis=3)
+    C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
+    # P1.C.P1 with P1 = I - 1/N, i.e. remove row and column means
+    C1 = C - C.mean(axis=2)[:, :, np.newaxis] - C.mean(axis=1)[:, np.newaxis, :] \
+        + C.mean(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    # C1 is symmetric and positive semi-definite: its eigenvectors with the
+    # largest eigenvalues are the first singular vectors
+    S, U = np.linalg.eigh(C1)
+    return U[:, :, ::-1][:, :, :order]
+
+
+def _fit_screen_block(pp, airmass, rr, P, order, r_0, beta, pp_tol=0., k0=0, U=None, outQueue=None):
+    """
+    Fits the screens of a block of timeslots, returns k0, the fitted TEC and the
+    residuals (times x piercepoints). Timeslots where the fit fails have a zero
+    screen and residuals set to one.
+
+    Keyword arguments:
+    pp -- array of piercepoint locations (times x piercepoints x 3)
+    airmass -- array of airmass values (times x piercepoints)
+    rr -- array of TEC solutions (piercepoints x times)
+    P -- projector removing the per-source and per-station offsets
+    order, r_0, beta -- see fit_screen_to_tec()
+    pp_tol -- reuse the KL base vectors while pierce points move less than this (m)
+    k0 -- index of the first timeslot of the block
+    U -- KL base vectors, if already computed (times x piercepoints x order)
+    outQueue -- if given, results are put there instead of returned
+    """
+    import numpy as np
+
+    N_times, N_piercepoints = airmass.shape
+
+    if U is None:
+        # timeslots whose base vectors are computed, the others reuse the previous ones
+        refs = []
+        refIdx = np.zeros(N_times, dtype=int)
+        for k in range(N_times):
+            if refs == [] or not np.all(np.abs(pp[k] - pp[refs[-1]]) <= pp_tol):
+                refs.append(k)
+            refIdx[k] = len(refs) - 1
+        try:
+            U = _screen_basis(pp[refs], order, r_0, beta)[refIdx]
+        except Exception:
+            pass
+
+    try:
+        if U is None: raise ValueError('Cannot compute KL base vectors.')
+        B = np.matmul(P, airmass[:, :, np.newaxis] * U)
+        pinvB = np.linalg.pinv(B, rcond=1e-3)
+
+        rr1 = np.dot(P, rr).T
+        tec_fit = np.matmul(U, np.matmul(pinvB, rr1[:, :, np.newaxis]))[:, :, 0]
+        residual = rr1 - np.dot(tec_fit, P.T)
+    except Exception:
+        if N_times > 1:
+            # fit timeslots one by one to isolate the failing ones
+            results = [_fit_screen_block(pp[k:k+1], airmass[k:k+1], rr[:, k:k+1], P, order,
+                r_0, beta, pp_tol, k0+k, None if U is None else U[k:k+1]) for k in range(N_times)]
+            tec_fit = np.concatenate([r[1] for r in results])
+            residual = np.concatenate([r[2] for r in results])
+        else:
+            # Set screen to zero if fit did not work
+            logging.debug('Tecscreen fit failed for timeslot {0}'.format(k0))
+            tec_fit = np.zeros((1, N_piercepoints))
+            residual = np.ones((1, N_piercepoints))
+
+    if outQueue is not None:
+        outQueue.put([k0, tec_fit, residual])
+    else:
+        return k0, tec_fit, residual
+
+
 def run( step, parset, H ):
     """
     Fits a screen to TEC values derived by the TECFIT operation.
@@ -257,6 +366,11 @@ def run( step, parset, H ):
     outSoltabs = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "OutSoltab"]), [] )
     height = np.array(parset.getDoubleVector('.'.join(["LoSoTo.Steps", step, "Height"]), [200e3] ))
     order = int(parset.getString('.'.join(["LoSoTo.Steps", step, "Order"]), '15' ))
+    ppTolerance = parset.getDouble('.'.join(["LoSoTo.Steps", step, "PPTolerance"]), 0. )
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 0 )
+    if ncpu == 0:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
 
     # Load TEC values from TECFIT operation
     indx = 0
@@ -306,19 +420,22 @@ def run( step, parset, H ):
         heights.sort()
         if len(heights) > 1:
             logging.info('Trying range of heights: {0} m'.format(heights))
+        # source directions do not depend on the height
+        directions = calculate_directions(np.array(station_positions),
+            np.array(source_positions), np.array(times))
         for i, height in enumerate(heights):
             # Find pierce points and airmass values for given screen height
             logging.info('Using height = {0} m and order = {1}'.format(height, order))
             if height < 100e3:
                 logging.warning("Height is less than 100e3 m.")
             pp, airmass = calculate_piercepoints(np.array(station_positions),
-                np.array(source_positions), np.array(times), height)
+                np.array(source_positions), np.array(times), height, directions)
 
             # Fit a TEC screen
             r_0 = 10e3
             beta = 5.0 / 3.0
             tec_screen, residual = fit_screen_to_tec(station_names, source_names,
-                pp, airmass, rr, times, height, order, r_0, beta)
+                pp, airmass, rr, times, height, order, r_0, beta, ncpu, ppTolerance)
             total_resid = np.sum(np.abs(residual))
             if i > 0:
                 if total_resid < best_resid:
@@ -3,39 +3,219 @@
 
 # Some utilities for operations
 
-import sys
+import os, sys, atexit, cPickle, shutil, tempfile, itertools, traceback, mmap, Queue
 import logging
+import numpy as np
 from losoto.h5parm import solFetcher
 import multiprocessing
 
+# jobs whose arrays are smaller than this (bytes) are simply pickled
+_shmMinSize = 2**16
+_shmAlign = 64
+
+def _toShm(items, path):
+    """
+    Copy the numpy arrays in a list of job parameters/results into a memory-mapped
+    file and replace them with (offset, dtype, shape) references.
+    Return the new list and the file path (None if nothing was moved)
+
+    Keyword arguments:
+    items -- list of parameters
+    path -- memory-mapped file to create
+    """
+    if not isinstance(items, (list, tuple)): return items, None
+
+    offsets = {}
+    size = 0
+    for i, item in enumerate(items):
+        if type(item) is np.ndarray and item.dtype != object:
+            offsets[i] = size
+            size += -(-item.nbytes // _shmAlign) * _shmAlign
+    if size < _shmMinSize: return items, None
+
+    with open(path, 'w+b') as f:
+        f.truncate(size)
+        mm = mmap.mmap(f.fileno(), size)
+    items = list(items)
+    for i, offset in offsets.iteritems():
+        a = items[i]
+        np.frombuffer(mm, dtype=a.dtype, count=a.size, offset=offset).reshape(a.shape)[...] = a
+        items[i] = ('__shm__', offset, a.dtype.str, a.shape)
+    mm.close()
+    return items, path
+
+
+def _fromShm(items, path):
+    """
+    Inverse of _toShm(): map the file and replace the references with arrays
+    which are views on the mapped memory. The file is removed.
+
+    Keyword arguments:
+    items -- list of parameters as returned by _toShm()
+    path -- memory-mapped file (if None items is returned as it is)
+    """
+    if path is None: return items
+
+    with open(path, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+    os.unlink(path)
+    items = list(items)
+    for i, item in enumerate(items):
+        if type(item) is tuple and len(item) == 4 and item[0] == '__shm__':
+            offset, dtype, shape = item[1:]
+            dtype = np.dtype(dtype)
+            items[i] = np.frombuffer(mm, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return items
+
+
+def _unlinkShm(paths):
+    """
+    Remove the memory-mapped files of jobs/results which are not going to be read
+
+    Keyword arguments:
+    paths -- list of file paths (None are skipped)
+    """
+    for path in paths:
+        if path is None: continue
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
 class multiprocManager(object):
 
     class multiThread(multiprocessing.Process):
         """
-        This class is a working thread which load parameters from a queue and
-        return in the output queue
+        This class is a working thread which load jobs from a queue and
+        return the results in the output queue. Threads are persistent and
+        shared among all the multiprocManager instances.
         """
 
-        def __init__(self, inQueue, outQueue, funct):
+        def __init__(self, inQueue, outQueue):
             multiprocessing.Process.__init__(self)
+            self.daemon = True
             self.inQueue = inQueue
             self.outQueue = outQueue
-            self.funct = funct
+            # (token, jobId) of the job being run, read by the parent if the thread dies
+            self.current = multiprocessing.RawArray('l', [-1, -1])
 
         def run(self):
 
+            jobs = itertools.count()
             while True:
-                parms = self.inQueue.get()
+                job = self.inQueue.get()
 
                 # poison pill
-                if parms is None:
+                if job is None:
                     self.inQueue.task_done()
                     break
 
-                self.funct(*parms, outQueue=self.outQueue)
+                # the job is unpickled here, so that a failure is reported and does not kill the thread
+                token, jobId, shm, job = job
+                self.current[:] = [token, jobId]
+                outQueue = multiprocManager.outCollector('%s/out%i_%i' % (multiprocManager._shmDir, os.getpid(), jobs.next()))
+                try:
+                    funct, parms = cPickle.loads(job)
+                    funct(*_fromShm(parms, shm), outQueue=outQueue)
+                    error = None
+                except BaseException:
+                    # also sys.exit() is reported as a failed job
+                    error = traceback.format_exc()
+                    _unlinkShm([shm] + [path for items, path in outQueue.results])
+                    outQueue.results = []
+                self.outQueue.put([token, jobId, outQueue.results, error])
+                self.current[:] = [-1, -1]
                 self.inQueue.task_done()
 
 
+    class resultQueue(object):
+        """
+        Queue of the results: unlike multiprocessing.Queue, put() writes synchronously
+        (no feeder thread) so a thread dying after put() cannot leave the queue locked
+        """
+
+        def __init__(self):
+            self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+            self.lock = multiprocessing.Lock()
+
+        def put(self, item):
+            with self.lock:
+                self.writer.send(item)
+
+        def get(self, timeout=None):
+            if not self.reader.poll(timeout): raise Queue.Empty
+            return self.reader.recv()
+
+
+    class outCollector(object):
+        """
+        Stand-in for the output queue passed to the function: results are
+        collected and their arrays moved to shared memory
+        """
+
+        def __init__(self, prefix):
+            self.prefix = prefix
+            self.results = []
+
+        def put(self, item):
+            self.results.append(_toShm(item, self.prefix+'_'+str(len(self.results))))
+
+
+    # persistent pool, started at the first use and shared by all the steps
+    _threads = []
+    _inQueue = None
+    _outQueue = None
+    _shmDir = None
+    _tokens = itertools.count()
+    _lost = set() # (token, jobId) of the jobs whose thread died
+    _pollTime = 1. # s between checks of the threads while waiting for results
+
+    @classmethod
+    def startPool(cls, procs):
+        """
+        Start the worker pool (or grow it to "procs" threads)
+        """
+        if cls._inQueue is None:
+            cls._inQueue = multiprocessing.JoinableQueue()
+            cls._outQueue = cls.resultQueue()
+            # use shared memory if available
+            cls._shmDir = tempfile.mkdtemp(prefix='losoto_', dir='/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+            atexit.register(cls.stopPool, os.getpid())
+
+        for t in cls._threads:
+            if not t.is_alive():
+                logging.error('A parallel thread died (exit code: %s).' % str(t.exitcode))
+                if t.current[0] != -1: cls._lost.add(tuple(t.current))
+        cls._threads = [t for t in cls._threads if t.is_alive()]
+        if len(cls._threads) < procs:
+            logging.debug('Spawning %i threads...' % (procs - len(cls._threads)))
+        while len(cls._threads) < procs:
+            t = cls.multiThread(cls._inQueue, cls._outQueue)
+            cls._threads.append(t)
+            t.start()
+
+    @classmethod
+    def stopPool(cls, pid=None):
+        """
+        Send poison pills to the threads and wait for them to finish
+        """
+        if pid is not None and pid != os.getpid(): return
+        if cls._inQueue is None: return
+        cls._threads = [t for t in cls._threads if t.is_alive()]
+        for t in cls._threads:
+            cls._inQueue.put(None)
+        for t in cls._threads:
+            t.join()
+        cls._threads = []
+        shutil.rmtree(cls._shmDir, ignore_errors=True)
+        # the pool can be started again
+        cls._inQueue = None
+        cls._outQueue = None
+        cls._shmDir = None
+        cls._lost = set()
+
+
     def __init__(self, procs=1, funct=None):
         """
         Manager for multiprocessing
@@ -44,23 +224,57 @@ class multiprocManager(object):
         and it will be linked to the output queue
         """
         self.procs = procs
-        self._threads = []
-        self.inQueue = multiprocessing.JoinableQueue()
-        self.outQueue = multiprocessing.Queue()
-        self.runs = 0
-        
-        logging.debug('Spawning %i threads...' % self.procs)
-        for proc in xrange(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
-            self._threads.append(t)
-            t.start()
+        self.funct = funct
+        self.token = self._tokens.next()
+        self.runs = 0 # jobs not yet returned
+        self.jobs = 0 # jobs sent
+        self.pending = set() # ids of the jobs not yet returned
+        self.startPool(procs)
 
     def put(self, args):
         """
         Parameters to give to the next jobs sent into queue
+        Large arrays are passed through shared memory
         """
-        self.inQueue.put(args)
+        args, shm = _toShm(args, self._shmIn(self.jobs))
+        self._inQueue.put([self.token, self.jobs, shm, cPickle.dumps((self.funct, args), -1)])
+        self.pending.add(self.jobs)
         self.runs += 1
+        self.jobs += 1
+
+    def _shmIn(self, jobId):
+        """
+        Memory-mapped file of the parameters of a job
+        """
+        return '%s/in%i_%i_%i' % (self._shmDir, os.getpid(), self.token, jobId)
+
+    def _getJob(self):
+        """
+        Wait for the next finished job and return its id and results
+        If the job failed (or the thread running it died) results is None
+        """
+        while True:
+            try:
+                token, jobId, results, error = self._outQueue.get(timeout=self._pollTime)
+            except Queue.Empty:
+                # check for dead threads (and replace them)
+                self.startPool(self.procs)
+                lost = [jobId for token, jobId in self._lost if token == self.token and jobId in self.pending]
+                if lost == []: continue
+                jobId = lost[0]
+                self._lost.discard((self.token, jobId))
+                _unlinkShm([self._shmIn(jobId)])
+                results, error = [], 'Thread died while running the job.'
+                break
+            # results left behind by another manager (or of a job already given up)
+            if token == self.token and jobId in self.pending: break
+            _unlinkShm([path for items, path in results])
+        self.pending.remove(jobId)
+        self.runs -= 1
+        if error is not None:
+            logging.error('Error in a parallel job:\n'+error)
+            return jobId, None
+        return jobId, [_fromShm(items, shm) for items, shm in results]
 
     def get(self):
         """
@@ -68,19 +282,60 @@ class multiprocManager(object):
         """
         # NOTE: do not use queue.empty() check which is unreliable
         # https://docs.python.org/2/library/multiprocessing.html
-        for run in xrange(self.runs):
-            yield self.outQueue.get()
+        while self.runs > 0:
+            jobId, results = self._getJob()
+            if results is None: continue
+            for items in results:
+                yield items
 
-    def wait(self):
+    def imap(self, argsIter, window=None, skipErrors=False):
         """
-        Send poison pills to jobs and wait for them to finish
-        The join() should kill all the processes
+        Send the parameters in argsIter to the jobs and return the results as an iterator,
+        in the same order of argsIter. Results are returned as soon as they are ready and
+        at most "window" jobs are queued or waiting to be consumed, so the memory usage does
+        not grow with the number of jobs.
+        argsIter: iterable of parameters, as for put()
+        window: max number of jobs in flight (default: twice the number of processors)
+        skipErrors: if False an exception is raised when a job fails (after waiting for the
+        jobs in flight), if True the failed jobs are skipped: use it only if the results
+        identify their job and the caller checks that none is missing
         """
-        for t in self._threads:
-            self.inQueue.put(None)
+        if window is None: window = 2*self.procs
+        argsIter = iter(argsIter)
+        firstJob = nextJob = self.jobs
+        done = {} # jobs finished out of order
+        exhausted = False
+
+        while True:
+            # fill the window
+            while not exhausted and self.jobs - nextJob < window:
+                try:
+                    self.put(argsIter.next())
+                except StopIteration:
+                    exhausted = True
+
+            if nextJob == self.jobs: break
+
+            while nextJob not in done:
+                jobId, results = self._getJob()
+                done[jobId] = results
+            results = done.pop(nextJob)
+            if results is None:
+                if not skipErrors:
+                    self.wait()
+                    raise Exception('Parallel job %i failed.' % (nextJob - firstJob))
+                results = []
+            for items in results:
+                yield items
+            nextJob += 1
 
-        # wait for all jobs to finish
-        self.inQueue.join()
+    def wait(self):
+        """
+        Wait for all the jobs to finish, their results are discarded
+        Threads are kept alive for the next operations
+        """
+        while self.runs > 0:
+            jobId, results = self._getJob()
 
 
 def getParSolsets( step, parset, H ):
@@ -238,6 +493,54 @@ def getParAxis( step, parset, H, axisName ):
     return axisVals
 
 
+# axes returned by getValuesIter() for each operation, as parset parameters (with their default)
+# or as fixed lists, used to plan the chunk shape of the tables
+accessAxesPar = {
+    'CLIP': [('Axes', [])],
+    'CLOCKTEC': ['ant','freq','pol','time'],
+    'CROSSDELAY': ['freq','pol','time'],
+    'FARADAY': ['freq','pol','time'],
+    'FLAG': [('Axes', ['time'])],
+    'FLAGEXTEND': [('Axes', ['freq','time'])],
+    'INTERP': [('InterpAxes', ['time','freq'])],
+    'NORM': [('NormAxes', ['time'])],
+    'PLOT': [('DiffAxis', []), ('TableAxis', []), ('ColorAxis', []), ('Axes', [])],
+    'RESIDUALS': ['freq'],
+    'SMOOTH': [('Axes', [])],
+    'SMOOTHCLOCK': ['time'],
+    'TECJUMP': ['time'],
+}
+
+def getParAccessAxes( step, parset, H, soltab ):
+    """
+    Return the axes which the first step after "step" operating on "soltab"
+    reads together (the returnAxes of its getValuesIter()), or None if no
+    following step iterates on this table.
+    Keyword arguments:
+    soltab -- 'solution-set/solution-tab' string
+    """
+    steps = parset.getStringVector( "LoSoTo.Steps", [] )
+    if not step in steps: return None
+
+    for nextStep in steps[steps.index(step)+1:]:
+        op = parset.getString( '.'.join( [ "LoSoTo.Steps", nextStep, "Operation" ] ), '' )
+        if not op in accessAxesPar: continue
+        if not soltab in getParSoltabs( nextStep, parset, H ): continue
+
+        accessAxes = []
+        for par in accessAxesPar[op]:
+            if type(par) is tuple:
+                accessAxes += parset.getStringVector( '.'.join( [ "LoSoTo.Steps", nextStep, par[0] ] ), par[1] )
+            else:
+                accessAxes.append(par)
+        if accessAxes == []: continue
+
+        logging.debug('Access axes from step \"'+nextStep+'\" ('+op+'): '+str(accessAxes))
+        return accessAxes
+
+    return None
+
+
 def openSoltabs( H, ss_sts ):
     """
     Return a list of soltab objects
@@ -393,3 +696,45 @@ def unwrap_huib( x, window = 10, alpha = 0.01, iterations = 3,
         xx = xx[ : : -1 ].copy()
     xx = xx - xx[ 0 ] + xs
     return xx
+
+
+def runningMedian(vals, size, blockLen=2**22):
+    """
+    NaN-aware running median. Same result of
+    scipy.ndimage.generic_filter(vals, np.nanmedian, size=size) (with the default
+    'reflect' boundary) but vectorized: the windows are strided views on the padded
+    array, sorted in blocks (NaNs go to the end) and the median is taken at the
+    position given by the number of valid values in each window.
+
+    Keyword arguments:
+    vals -- n-dim array
+    size -- window size, an int (same for all the axes) or one value per axis
+    blockLen -- max number of elements (windows x window size) sorted at once
+    """
+    from numpy.lib.stride_tricks import as_strided
+
+    vals = np.asarray(vals)
+    if np.isscalar(size): size = [size]*vals.ndim
+    size = tuple(int(s) for s in size)
+    if len(size) != vals.ndim:
+        raise ValueError('Running median: size must have one value per axis (%i).' % vals.ndim)
+    if vals.size == 0 or vals.ndim == 0: return vals.copy()
+
+    # scipy "reflect" is numpy "symmetric", the window is centred at size//2
+    padded = np.pad(vals.astype(np.float64), [(s//2, s-1-s//2) for s in size], mode='symmetric')
+    windows = as_strided(padded, shape=vals.shape+size, strides=padded.strides*2)
+
+    winLen = int(np.prod(size))
+    rowLen = int(np.prod(vals.shape[1:]))
+    step = max(1, blockLen // (winLen*rowLen))
+    out = np.empty(vals.shape, dtype=np.float64)
+    for start in xrange(0, vals.shape[0], step):
+        block = np.array(windows[start:start+step]).reshape(-1, winLen) # windows overlap: sort a copy
+        block.sort(axis=1)
+        nValid = winLen - np.isnan(block).sum(axis=1)
+        rows = np.arange(len(block))
+        med = 0.5 * (block[rows, np.maximum((nValid-1)//2, 0)] + block[rows, nValid//2])
+        med[nValid == 0] = np.nan
+        out[start:start+step] = med.reshape(out[start:start+step].shape)
+
+    return out.astype(vals.dtype, copy=False)
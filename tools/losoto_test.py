@@ -59,6 +59,10 @@ logging.info('Get a soltab object')
 st=H5.getSoltab(ss,'stTest')
 logging.info('Get all soltabs:')
 print H5.getSoltabs(ss)
+logging.info('Rechunk soltab for access along axis1 (exp: (4, 10, 100) axis1 True)')
+H5.rechunkSoltab(ss, 'stTest', accessAxes=['axis1'])
+print st.val.chunkshape, st._v_attrs['chunk_axes']
+print (st.val[:] == vals).all()
 
 print "###########################################"
 logging.info('### solFetcher/solWriter - General')
@@ -114,6 +118,14 @@ for matrix, coord, sel in Hsf.getValuesIter(returnAxes=['axis2','axis3']):
     print coord
     i += 1
 print "Iterations:", i
+logging.info('Get Vaues Iter in batches of 16 (exp: 1 batch of 4x10)')
+i=0
+for matrix, coords, sels in Hsf.getValuesIter(returnAxes=['axis3'], batchSize=16):
+    print matrix.shape, len(coords), len(sels)
+    i += 1
+print "Iterations:", i
+logging.info('Writing back an iteration in batch')
+Hsw.setValuesBatch([(matrix, sel) for matrix, coord, sel in Hsf.getValuesIter(returnAxes=['axis3'])])
 
 
 print "###########################################"
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This tool compares the running median used by FLAG and SMOOTH (runningMedian)
+# with the scipy generic_filter + nanmedian implementation.
+
+# Authors:
+# Francesco de Gasperin
+_author = "Francesco de Gasperin (fdg@hs.uni-hamurg.de)"
+
+import sys, os, time
+import warnings
+import numpy as np
+import logging
+from scipy.ndimage import generic_filter
+from losoto import _version
+from losoto import _logging
+from losoto.operations_lib import runningMedian
+
+# Options
+import optparse
+opt = optparse.OptionParser(usage='%prog [-f 60] [-t 1000] [-s 5,11] [-n 0.1]\n'\
+                +_author, version='%prog '+_version.__version__)
+opt.add_option('-f', '--nfreq', help='Number of frequencies (default=60)', type=int, default=60)
+opt.add_option('-t', '--ntime', help='Number of times (default=1000)', type=int, default=1000)
+opt.add_option('-s', '--size', help='Window size along freq,time (default=5,11)', type='string', default='5,11')
+opt.add_option('-n', '--nanfrac', help='Fraction of flagged (NaN) data (default=0.1)', type=float, default=0.1)
+(options, args) = opt.parse_args()
+
+_logging.setLevel('info')
+warnings.simplefilter('ignore', RuntimeWarning) # all-NaN windows
+
+size = [int(s) for s in options.size.split(',')]
+np.random.seed(0)
+vals = np.random.normal(size=(options.nfreq, options.ntime))
+vals[np.random.rand(*vals.shape) < options.nanfrac] = np.nan
+
+cases = [('1-D (time)', vals[0], size[-1]), ('2-D (freq x time)', vals, size)]
+
+for name, data, s in cases:
+    logging.info('Running median %s: shape %s, window %s' % (name, str(data.shape), str(s)))
+
+    start = time.time()
+    ref = generic_filter(data, np.nanmedian, size=s)
+    tRef = time.time() - start
+    logging.info('generic_filter + nanmedian: %.3f s' % tRef)
+
+    start = time.time()
+    new = runningMedian(data, s)
+    tNew = time.time() - start
+    logging.info('runningMedian: %.3f s (x%.1f)' % (tNew, tRef/tNew))
+
+    if not np.array_equal(np.isnan(ref), np.isnan(new)) or not (ref[~np.isnan(ref)] == new[~np.isnan(new)]).all():
+        logging.error('Results differ!')
+        sys.exit(1)
+
+logging.info('Done.')